@@ -0,0 +1,78 @@
+# MIT License
+#
+# Copyright (c) 2024 Tskit Developers
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Test cases for compiling and caching numba kernels
+"""
+
+import os
+import pathlib
+
+import numba
+import pytest
+
+import tsdate
+from tsdate import accelerate
+
+
+class TestNumbaCache:
+    def test_cache_dir_versions(self):
+        if os.environ.get("NUMBA_CACHE_DIR"):
+            pytest.skip("Cache directory set by NUMBA_CACHE_DIR")
+        cache_dir = accelerate.numba_cache_dir()
+        assert cache_dir.parent.parent == tsdate.get_cache_dir()
+        assert tsdate.__version__ in cache_dir.name
+        assert numba.__version__ in cache_dir.name
+
+    def test_cache_dir_used(self):
+        if not accelerate.CACHE_NUMBA:
+            pytest.skip("Numba caching disabled")
+        if os.environ.get("NUMBA_CACHE_DIR"):
+            pytest.skip("Cache directory set by NUMBA_CACHE_DIR")
+        kernel = os.path.join(accelerate._TsdateCacheLocator.package_dir, "prior.py")
+        locator = accelerate._TsdateCacheLocator.from_function(
+            accelerate.numba_cache_dir, kernel
+        )
+        cache_path = pathlib.Path(locator.get_cache_path())
+        assert accelerate.numba_cache_dir() in cache_path.parents
+
+    def test_global_cache_dir_unchanged(self):
+        # Other libraries' compiled code is not cached in the tsdate directory
+        if os.environ.get("NUMBA_CACHE_DIR"):
+            pytest.skip("Cache directory set by NUMBA_CACHE_DIR")
+        assert not numba.config.CACHE_DIR
+        assert (
+            accelerate._TsdateCacheLocator.from_function(pytest.skip, pytest.__file__)
+            is None
+        )
+
+    def test_warmup_tree_sequence(self):
+        ts = accelerate._warmup_tree_sequence()
+        assert ts.num_individuals == 4
+        assert ts.num_mutations == ts.num_edges
+        assert ts.num_sites == ts.num_edges
+
+    def test_warmup(self):
+        if not accelerate.CACHE_NUMBA:
+            pytest.skip("Numba caching disabled")
+        cache_dir = tsdate.warmup()
+        assert cache_dir == accelerate.numba_cache_dir()
+        assert any(cache_dir.rglob("*.nbi"))
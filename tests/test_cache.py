@@ -2,14 +2,17 @@
 Tests for the cache management code.
 """
 
+import logging
 import os
 import pathlib
 import unittest
 
 import appdirs
 import numpy as np
+import pytest
 
 import tsdate
+from tsdate import cache
 from tsdate.prior import ConditionalCoalescentTimes
 
 
@@ -53,3 +56,51 @@ class TestSetCacheDir(unittest.TestCase):
             + "should have been "
             + "deleted, but has not been. Please delete it"
         )
+
+
+class TestPrecalculatedPriors:
+    @pytest.fixture(autouse=True)
+    def _tmp_cache_dir(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(cache, "get_cache_dir", lambda: tmp_path)
+
+    def test_memmapped(self):
+        fn = ConditionalCoalescentTimes.get_precalc_cache(10)
+        assert fn.endswith(".npy")
+        priors = ConditionalCoalescentTimes(10)
+        assert os.path.isfile(fn)
+        cached = ConditionalCoalescentTimes(10)
+        assert isinstance(cached.approx_priors, np.memmap)
+        assert np.array_equal(cached.approx_priors, priors.approx_priors)
+        # No temporary files are left behind
+        assert not any(f.endswith(".tmp") for f in os.listdir(os.path.dirname(fn)))
+
+    def test_unreadable(self, caplog):
+        fn = ConditionalCoalescentTimes.get_precalc_cache(10)
+        with open(fn, "w") as file:
+            file.write("not a numpy file")
+        with caplog.at_level(logging.WARNING):
+            priors = ConditionalCoalescentTimes(10)
+        assert "Ignoring unreadable" in caplog.text
+        assert np.array_equal(np.load(fn), priors.approx_priors)
+
+    def test_wrong_shape(self, caplog):
+        fn = ConditionalCoalescentTimes.get_precalc_cache(10)
+        np.save(fn, np.zeros((5, 2)))
+        with caplog.at_level(logging.WARNING):
+            ConditionalCoalescentTimes(10)
+        assert "wrong shape" in caplog.text
+        assert np.load(fn).shape == (10, 2)
+
+    def test_list_and_clear_all(self, tmp_path):
+        assert ConditionalCoalescentTimes.list_precalculated_priors() == {}
+        ConditionalCoalescentTimes(10)
+        ConditionalCoalescentTimes(20)
+        (tmp_path / "prior_10df_0.0.1.txt").write_text("0 0\n")
+        sizes = ConditionalCoalescentTimes.list_precalculated_priors()
+        assert set(sizes) == {10, 20}
+        fn = ConditionalCoalescentTimes.get_precalc_cache(20)
+        assert sizes[20] == os.path.getsize(fn)
+        (tmp_path / "likelihoods").mkdir()
+        ConditionalCoalescentTimes.clear_all_precalculated_priors()
+        assert ConditionalCoalescentTimes.list_precalculated_priors() == {}
+        assert [p.name for p in tmp_path.iterdir()] == ["likelihoods"]
@@ -113,6 +113,38 @@ class TestTsdateArgParser:
         )
         assert args.probability_space == "logarithmic"
 
+    def test_cache_likelihoods(self):
+        parser = cli.tsdate_cli_parser()
+        args = parser.parse_args(["date", self.infile, self.output])
+        assert not args.cache_likelihoods
+        params = ["--method", "inside_outside", "--cache-likelihoods"]
+        args = parser.parse_args(["date", self.infile, self.output, *params])
+        assert args.cache_likelihoods
+
+    def test_likelihood_threshold(self):
+        parser = cli.tsdate_cli_parser()
+        args = parser.parse_args(["date", self.infile, self.output])
+        assert args.likelihood_threshold is None
+        params = ["--method", "inside_outside", "--likelihood-threshold", "1e-10"]
+        args = parser.parse_args(["date", self.infile, self.output, *params])
+        assert args.likelihood_threshold == 1e-10
+
+    def test_memmap_dir(self):
+        parser = cli.tsdate_cli_parser()
+        args = parser.parse_args(["date", self.infile, self.output])
+        assert args.memmap_dir is None
+        params = ["--method", "inside_outside", "--memmap-dir", "tmp"]
+        args = parser.parse_args(["date", self.infile, self.output, *params])
+        assert args.memmap_dir == "tmp"
+
+    def test_refine_timepoints(self):
+        parser = cli.tsdate_cli_parser()
+        args = parser.parse_args(["date", self.infile, self.output])
+        assert args.refine_timepoints is None
+        params = ["--method", "inside_outside", "--refine-timepoints", "100"]
+        args = parser.parse_args(["date", self.infile, self.output, *params])
+        assert args.refine_timepoints == 100
+
     @pytest.mark.parametrize(("flag", "log_status"), logging_flags.items())
     def test_verbosity(self, flag, log_status):
         parser = cli.tsdate_cli_parser()
@@ -149,6 +181,13 @@ class TestTsdateArgParser:
         assert args.trim_telomeres
         assert args.split_disjoint
 
+    def test_warmup(self):
+        with mock.patch("tsdate.cli.setup_logging"):
+            parser = cli.tsdate_cli_parser()
+            args = parser.parse_args(["warmup", "-v"])
+        assert args.runner == cli.run_warmup
+        assert args.verbosity == 1
+
 
 class TestMain:
     def test_main(self, capfd):
@@ -189,6 +228,51 @@ class TestCLIErrors(RunCLI):
         with pytest.raises(SystemExit, match="FileFormatError"):
             cli.tsdate_main(cmds)
 
+    def test_warmup_without_cache(self):
+        with mock.patch("tsdate.warmup", return_value=None):
+            with pytest.raises(SystemExit, match="TSDATE_ENABLE_NUMBA_CACHE"):
+                cli.tsdate_main(["warmup"])
+
+    def test_date_many_overwrite(self, tmp_path):
+        input_filename = tmp_path / "input.trees"
+        msprime.simulate(4, random_seed=123).dump(input_filename)
+        cmd = ["date-many", str(input_filename), "-o", str(tmp_path), "-m", "1"]
+        with pytest.raises(SystemExit, match="would overwrite"):
+            cli.tsdate_main(cmd)
+
+    def test_date_many_duplicate_names(self, tmp_path):
+        inputs = [tmp_path / "a" / "input.trees", tmp_path / "b" / "input.trees"]
+        for path in inputs:
+            path.parent.mkdir()
+            msprime.simulate(4, random_seed=123).dump(path)
+        cmd = ["date-many", *map(str, inputs), "-o", str(tmp_path), "-m", "1"]
+        with pytest.raises(SystemExit, match="More than one input"):
+            cli.tsdate_main(cmd)
+
+    def test_date_many_missing_file(self, tmp_path):
+        cmd = ["date-many", str(tmp_path / "x.trees"), "-o", str(tmp_path), "-m", "1"]
+        with pytest.raises(SystemExit, match="does not exist"):
+            cli.tsdate_main(cmd)
+
+    def test_date_many_instrumentation_file(self, tmp_path):
+        input_filename = tmp_path / "input.trees"
+        msprime.simulate(4, random_seed=123).dump(input_filename)
+        cmd = ["date-many", str(input_filename), "-o", str(tmp_path / "out")]
+        cmd += ["-m", "1", "--instrumentation-file", str(tmp_path / "x.json")]
+        with pytest.raises(SystemExit, match="instrumentation file"):
+            cli.tsdate_main(cmd)
+
+    @pytest.mark.parametrize(
+        "flags", [["--checkpoint-file", "x.ckpt"], ["--checkpoint-file", "x", "--resume"]]
+    )
+    def test_date_many_checkpoint_file(self, tmp_path, flags):
+        input_filename = tmp_path / "input.trees"
+        msprime.simulate(4, random_seed=123).dump(input_filename)
+        cmd = ["date-many", str(input_filename), "-o", str(tmp_path / "out")]
+        cmd += ["-m", "1", *flags]
+        with pytest.raises(SystemExit, match="checkpoint file cannot"):
+            cli.tsdate_main(cmd)
+
     def test_bad_date_method(self, tmp_path, capfd):
         bad = "bad_method"
         input_ts = msprime.simulate(4, random_seed=123)
@@ -210,6 +294,61 @@ class TestCLIErrors(RunCLI):
         with pytest.raises(SystemExit, match="not currently used"):
             self.run_tsdate_cli(tmp_path, input_ts, params + " --max-iterations 5")
 
+    def test_bad_convergence_tolerance_io(self, tmp_path):
+        input_ts = msprime.simulate(4, random_seed=123)
+        params = f"-n {self.popsize} --method inside_outside"
+        with pytest.raises(SystemExit, match="not currently used"):
+            self.run_tsdate_cli(
+                tmp_path, input_ts, params + " --convergence-tolerance 1e-3"
+            )
+
+    def test_bad_checkpoint_io(self, tmp_path):
+        input_ts = msprime.simulate(4, random_seed=123)
+        params = f"-n {self.popsize} --method inside_outside"
+        with pytest.raises(SystemExit, match="not currently used"):
+            self.run_tsdate_cli(tmp_path, input_ts, params + " --resume")
+
+    def test_bad_warm_start_io(self, tmp_path):
+        input_ts = msprime.simulate(4, random_seed=123)
+        params = f"-n {self.popsize} --method inside_outside"
+        with pytest.raises(SystemExit, match="not currently used"):
+            self.run_tsdate_cli(tmp_path, input_ts, params + " --warm-start")
+
+    def test_bad_memmap_dir_io(self, tmp_path):
+        input_ts = msprime.simulate(4, mutation_rate=1, random_seed=123)
+        with pytest.raises(SystemExit, match="irrelevant"):
+            self.run_tsdate_cli(tmp_path, input_ts, f"-m 1 --memmap-dir {tmp_path}")
+
+    def test_bad_window_io(self, tmp_path):
+        input_ts = msprime.simulate(4, random_seed=123)
+        params = f"-n {self.popsize} --method inside_outside"
+        with pytest.raises(SystemExit, match="not currently used"):
+            self.run_tsdate_cli(tmp_path, input_ts, params + " --window-size 0.5")
+
+    def test_bad_residual_tolerance_io(self, tmp_path):
+        input_ts = msprime.simulate(4, random_seed=123)
+        params = f"-n {self.popsize} --method inside_outside"
+        with pytest.raises(SystemExit, match="not currently used"):
+            self.run_tsdate_cli(tmp_path, input_ts, params + " --residual-tolerance 1e-3")
+
+    def test_bad_cache_likelihoods_io(self, tmp_path):
+        input_ts = msprime.simulate(4, mutation_rate=1, random_seed=123)
+        with pytest.raises(SystemExit, match="irrelevant"):
+            self.run_tsdate_cli(tmp_path, input_ts, "-m 1 --cache-likelihoods")
+
+    def test_bad_likelihood_threshold_io(self, tmp_path):
+        input_ts = msprime.simulate(4, mutation_rate=1, random_seed=123)
+        with pytest.raises(SystemExit, match="irrelevant"):
+            self.run_tsdate_cli(tmp_path, input_ts, "-m 1 --likelihood-threshold 0.1")
+
+    def test_bad_refine_timepoints_io(self, tmp_path):
+        input_ts = msprime.simulate(4, mutation_rate=1, random_seed=123)
+        with pytest.raises(SystemExit, match="irrelevant"):
+            self.run_tsdate_cli(tmp_path, input_ts, "-m 1 --refine-timepoints 100")
+        params = "-m 1 -n 1 --method maximization --refine-timepoints 100"
+        with pytest.raises(SystemExit, match="only used"):
+            self.run_tsdate_cli(tmp_path, input_ts, params)
+
 
 class TestOutput(RunCLI):
     """
@@ -383,6 +522,32 @@ class TestEndToEnd(RunCLI):
         input_ts = msprime.simulate(10, random_seed=1)
         params = f"-n {self.popsize} --num-threads 2 --method inside_outside"
         self.verify(tmp_path, input_ts, params)
+        input_ts = msprime.simulate(10, mutation_rate=4, random_seed=1)
+        params = "-m 4 --num-threads 2 --method variational_gamma"
+        self.verify(tmp_path, input_ts, params)
+
+    def test_window_size(self, tmp_path):
+        input_ts = msprime.simulate(
+            10, mutation_rate=4, recombination_rate=2, random_seed=1
+        )
+        params = "-m 4 --window-size 0.5 --window-overlap 0.1 --num-processes 2"
+        self.verify(tmp_path, input_ts, params)
+
+    def test_residual_tolerance(self, tmp_path):
+        input_ts = msprime.simulate(10, mutation_rate=4, random_seed=1)
+        params = "-m 4 --residual-tolerance 1e-3 --max-edge-updates 20"
+        self.verify(tmp_path, input_ts, params)
+
+    def test_instrumentation_file(self, tmp_path):
+        input_ts = msprime.simulate(10, mutation_rate=4, random_seed=1)
+        filename = tmp_path / "instrumentation.json"
+        params = f"-m 4 --instrumentation-file {filename}"
+        self.verify(tmp_path, input_ts, params)
+        with open(filename) as file:
+            data = json.load(file)
+        assert data["method"] == "variational_gamma"
+        assert "node_posteriors" in data["stages"]
+        assert data["counts"]["ep_iterations"] > 0
 
     def test_probability_space(self, tmp_path):
         input_ts = msprime.simulate(10, random_seed=1)
@@ -426,6 +591,26 @@ class TestEndToEnd(RunCLI):
         preprocessed_ts = tsdate.preprocess_ts(input_ts)
         self.ts_equal(output_ts, preprocessed_ts, times_equal=True)
 
+    def test_date_many(self, tmp_path, capfd):
+        inputs = []
+        for seed in (1, 2):
+            inputs.append(tmp_path / f"input{seed}.trees")
+            msprime.simulate(10, mutation_rate=4, random_seed=seed).dump(inputs[-1])
+        output_dir = tmp_path / "dated"
+        cmd = ["date-many", *map(str, inputs), "-o", str(output_dir), "-m", "4"]
+        cli.tsdate_main(cmd)
+        captured = capfd.readouterr()
+        lines = captured.out.splitlines()
+        assert len(lines) == len(inputs)
+        for path, line in zip(inputs, lines):
+            source, output, seconds = line.split("\t")
+            assert source == str(path)
+            assert output == str(output_dir / path.name)
+            assert float(seconds) >= 0
+            dated_ts = tsdate.date(tskit.load(path), mutation_rate=4)
+            output_ts = tskit.load(output)
+            assert np.array_equal(dated_ts.nodes_time, output_ts.nodes_time)
+
     def test_preprocess_compare_python_api(self, tmp_path):
         input_ts = msprime.simulate(
             100,
@@ -27,6 +27,7 @@ Test cases for the python API for tsdate.
 
 import collections
 import logging
+import os
 import unittest
 
 import msprime
@@ -38,6 +39,7 @@ import utility_functions
 from utility_functions import constrain_ages_topo
 
 import tsdate
+from tsdate import discrete
 from tsdate.core import DiscreteTimeMethod, InsideOutsideMethod
 from tsdate.demography import PopulationSizeHistory
 from tsdate.discrete import BeliefPropagation, Likelihoods, LogLikelihoods
@@ -456,6 +458,20 @@ class TestMixturePrior:
         prior_grid = prior.make_discretised_prior(demography, timepoints=timepoints)
         assert np.array_equal(prior_grid.timepoints, timepoints)
 
+    def test_parameter_grid_chunked(self):
+        ts = utility_functions.two_tree_mutation_ts()
+        prior = MixturePrior(ts, prior_distribution="gamma")
+        demography = PopulationSizeHistory([1000, 2000, 3000], [500, 2500])
+        prior_pars = prior.make_parameter_grid(demography)
+        for node in prior_pars.nonfixed_nodes:
+            assert np.allclose(
+                prior_pars[node],
+                demography.gamma_to_natural(*prior.prior_params[node, :2]),
+            )
+        for rows_per_chunk in (1, 2, 100):
+            chunked = prior.make_parameter_grid(demography, rows_per_chunk=rows_per_chunk)
+            assert np.allclose(chunked.grid_data, prior_pars.grid_data)
+
 
 class TestPriorVals:
     def verify_prior_vals(self, ts, prior_distr, **kwargs):
@@ -517,6 +533,30 @@ class TestPriorVals:
         assert np.allclose(prior_vals[2], prior_vals_keep[2])
         assert np.allclose(prior_vals[2], prior_vals_delete[2])
 
+    @pytest.mark.parametrize("prior_distr", ["gamma", "lognorm"])
+    def test_chunked(self, prior_distr):
+        ts = utility_functions.two_tree_mutation_ts()
+        span_data = SpansBySamples(ts)
+        Ne = PopulationSizeHistory(0.5)
+        priors = ConditionalCoalescentTimes(None, prior_distr=prior_distr)
+        priors.add(ts.num_samples, approximate=False)
+        grid = np.linspace(0, 3, 5)
+        mixture_priors = priors.get_mixture_prior_params(span_data)
+        prior_vals = fill_priors(mixture_priors, grid, ts, Ne, prior_distr=prior_distr)
+        for rows_per_chunk in (1, 2, 100):
+            chunked = fill_priors(
+                mixture_priors,
+                grid,
+                ts,
+                Ne,
+                prior_distr=prior_distr,
+                rows_per_chunk=rows_per_chunk,
+            )
+            assert np.allclose(chunked.grid_data, prior_vals.grid_data)
+        for node in prior_vals.nonfixed_nodes:
+            assert prior_vals[node][0] == 0
+            assert np.max(prior_vals[node]) == pytest.approx(1)
+
 
 class TestLikelihoodClass:
     def poisson(self, param, x, standardize=False):
@@ -651,6 +691,98 @@ class TestLikelihoodClass:
 
                             assert upper_tri[5] == pytest.approx(expected_lik_dt[0])
 
+    @pytest.mark.parametrize("lik_class", [Likelihoods, LogLikelihoods])
+    @pytest.mark.parametrize("standardize", [False, True])
+    def test_precalc_matches_scipy(self, lik_class, standardize):
+        ts = msprime.sim_mutations(
+            msprime.sim_ancestry(
+                10,
+                sequence_length=1e5,
+                recombination_rate=1e-8,
+                population_size=1e4,
+                random_seed=4,
+            ),
+            rate=1e-8,
+            random_seed=4,
+        )
+        grid = np.array([0, 100, 1000, 10000, 100000])
+        lik = lik_class(ts, grid, 1e-8, eps=1e-6, standardize=standardize)
+        lik.keys_per_chunk = 3  # Check that the chunks are filled correctly
+        lik.precalculate_mutation_likelihoods(num_threads=2)
+        assert np.array_equal(lik.unfixed_keys, np.unique(lik.unfixed_keys))
+        assert len(lik.unfixed_keys) == len(lik.unfixed_likelihoods) > 3
+        for edge in ts.edges():
+            if edge.child in lik.fixednodes:
+                continue
+            expected = lik_class._lik(
+                lik.mut_edges[edge.id],
+                edge.span,
+                lik.timediff_lower_tri,
+                lik.mut_rate,
+                standardize=standardize,
+            )
+            assert np.allclose(lik.get_mut_lik_lower_tri(edge), expected)
+
+    @pytest.mark.parametrize("lik_class", [Likelihoods, LogLikelihoods])
+    @pytest.mark.parametrize("threshold", [0, 1e-10, 1e-3])
+    def test_likelihood_bands(self, lik_class, threshold):
+        ts = msprime.sim_mutations(
+            msprime.sim_ancestry(
+                10,
+                sequence_length=1e6,
+                recombination_rate=1e-8,
+                population_size=1e4,
+                random_seed=5,
+            ),
+            rate=1e-7,
+            random_seed=5,
+        )
+        grid = tsdate.build_prior_grid(ts, population_size=1e4, timepoints=10).timepoints
+        dense = lik_class(ts, grid, 1e-7, eps=1e-6)
+        dense.precalculate_mutation_likelihoods()
+        assert len(dense.likelihood_bands()) == 0
+        lik = lik_class(ts, grid, 1e-7, eps=1e-6, likelihood_threshold=threshold)
+        lik.precalculate_mutation_likelihoods()
+        bands = lik.likelihood_bands()
+        assert bands.shape == (len(lik.unfixed_keys), lik.grid_size, 4)
+        offsets = lik.row_indices[0]
+        for row, dense_row, band in zip(
+            lik.unfixed_likelihoods, dense.unfixed_likelihoods, bands
+        ):
+            in_band = np.zeros((lik.grid_size, lik.grid_size), dtype=bool)
+            for k in range(lik.grid_size):
+                lo, hi = band[k, 0:2]
+                expected = dense_row[offsets[k] : offsets[k] + k + 1]
+                values = row[offsets[k] : offsets[k] + k + 1]
+                assert np.all(values[lo:hi] == expected[lo:hi])
+                assert np.all(values[:lo] == lik.null_constant)
+                assert np.all(values[hi:] == lik.null_constant)
+                max_val = np.max(expected)
+                if lik_class is LogLikelihoods:
+                    assert np.all(np.exp(expected[lo:hi] - max_val) >= threshold)
+                else:
+                    assert np.all(expected[lo:hi] >= threshold * max_val)
+                in_band[k, lo:hi] = True
+            for k in range(lik.grid_size):
+                parents = np.flatnonzero(in_band[:, k])
+                if len(parents) > 0:
+                    assert band[k, 2] == parents[0]
+                    assert band[k, 3] == parents[-1] + 1
+                else:
+                    assert band[k, 2] >= band[k, 3]
+        num_in_bands = np.sum(bands[:, :, 1] - bands[:, :, 0])
+        if threshold == 0:
+            assert np.array_equal(lik.unfixed_likelihoods, dense.unfixed_likelihoods)
+            assert num_in_bands == dense.unfixed_likelihoods.size
+        else:
+            assert num_in_bands < dense.unfixed_likelihoods.size
+
+    def test_bad_likelihood_threshold(self):
+        ts = utility_functions.two_tree_mutation_ts()
+        for threshold in (-1, 1, 2):
+            with pytest.raises(ValueError, match="between 0 and 1"):
+                Likelihoods(ts, np.array([0, 1, 2]), 1, likelihood_threshold=threshold)
+
     def test_tri_functions(self):
         ts = utility_functions.two_tree_mutation_ts()
         grid = np.array([0, 1, 2])
@@ -739,6 +871,117 @@ class TestLikelihoodClass:
                     )
 
 
+class TestLikelihoodCache:
+    @pytest.fixture(autouse=True)
+    def _tmp_cache_dir(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(discrete, "likelihood_cache_dir", lambda: tmp_path)
+        self.cache_dir = tmp_path
+
+    def likelihoods(self, ts, mutation_rate=1e-8, lik_class=Likelihoods):
+        grid = np.array([0, 100, 1000, 10000, 100000])
+        lik = lik_class(ts, grid, mutation_rate, eps=1e-6)
+        lik.precalculate_mutation_likelihoods(cache_likelihoods=True)
+        return lik
+
+    def simulate(self, random_seed, num_samples=10):
+        return msprime.sim_mutations(
+            msprime.sim_ancestry(
+                num_samples,
+                sequence_length=1e5,
+                recombination_rate=1e-8,
+                population_size=1e4,
+                random_seed=random_seed,
+            ),
+            rate=1e-8,
+            random_seed=random_seed,
+        )
+
+    def test_saved(self):
+        ts = self.simulate(1)
+        lik = self.likelihoods(ts)
+        path = lik.likelihood_cache_file()
+        assert path.parent == self.cache_dir
+        with np.load(path) as data:
+            assert np.array_equal(data["muts"], lik.unfixed_keys["muts"])
+            assert np.array_equal(data["span"], lik.unfixed_keys["span"])
+            assert np.array_equal(data["likelihoods"], lik.unfixed_likelihoods)
+        assert list(self.cache_dir.iterdir()) == [path]
+
+    def test_reused(self):
+        ts = self.simulate(1)
+        lik = self.likelihoods(ts)
+        path = lik.likelihood_cache_file()
+        # Overwrite the cached values, to check that they are read back
+        with np.load(path) as data:
+            np.savez(
+                path,
+                muts=data["muts"],
+                span=data["span"],
+                likelihoods=np.full_like(data["likelihoods"], 0.5),
+            )
+        lik = self.likelihoods(ts)
+        assert np.all(lik.unfixed_likelihoods == 0.5)
+
+    def test_settings_in_key(self):
+        ts = self.simulate(1)
+        paths = {
+            self.likelihoods(ts).likelihood_cache_file(),
+            self.likelihoods(ts, mutation_rate=2e-8).likelihood_cache_file(),
+            self.likelihoods(ts, lik_class=LogLikelihoods).likelihood_cache_file(),
+        }
+        assert len(paths) == 3
+        assert set(self.cache_dir.iterdir()) == paths
+
+    def test_merged(self):
+        ts1 = self.simulate(1)
+        ts2 = self.simulate(2)
+        lik1 = self.likelihoods(ts1)
+        lik2 = self.likelihoods(ts2)
+        expected = Likelihoods(ts2, lik2.timepoints, 1e-8, eps=1e-6)
+        expected.precalculate_mutation_likelihoods()
+        assert np.array_equal(lik2.unfixed_likelihoods, expected.unfixed_likelihoods)
+        with np.load(lik2.likelihood_cache_file()) as data:
+            keys = np.rec.fromarrays((data["muts"], data["span"]), names="muts,span")
+        all_keys = np.union1d(lik1.unfixed_keys, lik2.unfixed_keys)
+        assert np.array_equal(keys, all_keys)
+
+    def test_bounded(self, monkeypatch):
+        lik = self.likelihoods(self.simulate(1))
+        first = lik.likelihood_cache_file()
+        max_bytes = first.stat().st_size * 3 // 2
+        monkeypatch.setattr(discrete, "LIKELIHOOD_CACHE_MAX_BYTES", max_bytes)
+        os.utime(first, (0, 0))  # Make this the least recently used
+        lik = self.likelihoods(self.simulate(1), mutation_rate=2e-8)
+        assert not first.exists()
+        assert list(self.cache_dir.iterdir()) == [lik.likelihood_cache_file()]
+
+    def test_unreadable(self, caplog):
+        ts = self.simulate(1)
+        lik = Likelihoods(ts, np.array([0, 100, 1000]), 1e-8, eps=1e-6)
+        path = lik.likelihood_cache_file()
+        path.write_text("not an npz file")
+        with caplog.at_level(logging.WARNING):
+            lik.precalculate_mutation_likelihoods(cache_likelihoods=True)
+        assert "unreadable" in caplog.text
+        with np.load(path) as data:
+            assert np.array_equal(data["likelihoods"], lik.unfixed_likelihoods)
+
+    @pytest.mark.parametrize("method", ["inside_outside", "maximization"])
+    def test_date(self, method):
+        ts = self.simulate(1)
+        expected = tsdate.date(ts, mutation_rate=1e-8, population_size=1e4, method=method)
+        for _ in range(2):
+            dated = tsdate.date(
+                ts,
+                mutation_rate=1e-8,
+                population_size=1e4,
+                method=method,
+                cache_likelihoods=True,
+            )
+            assert np.array_equal(dated.nodes_time, expected.nodes_time)
+        assert len(list(self.cache_dir.iterdir())) == 1
+
+
 class TestNodeTimeValuesClass:
     def test_init(self):
         num_nodes = 5
@@ -826,6 +1069,51 @@ class TestNodeTimeValuesClass:
             else:
                 assert clone[i] == 0
 
+    def test_single_precision(self):
+        num_nodes = 10
+        ids = [3, 4]
+        orig = NodeTimeValues(
+            num_nodes, np.array(ids), np.array([0, 1.2]), 0.5, dtype=np.float32
+        )
+        assert orig.grid_data.dtype == np.float32
+        assert orig.fixed_data.dtype == np.float64
+        orig.force_probability_space(LOG_GRID)
+        assert orig.grid_data.dtype == np.float32
+        assert np.allclose(orig.grid_data, np.log(0.5))
+        clone = orig.clone_with_new_data(0)
+        assert clone.grid_data.dtype == np.float32
+        clone = orig.clone_with_new_data(np.array([[1.0, 2.0], [4.0, 3.0]]))
+        assert clone.grid_data.dtype == np.float32
+        assert np.all(clone[4] == [4, 3])
+        clone = orig.clone_with_new_data(orig.grid_data, dtype=np.float64)
+        assert clone.grid_data.dtype == np.float64
+
+    def test_memmap(self, tmp_path):
+        num_nodes = 10
+        ids = [3, 4]
+        orig = NodeTimeValues(
+            num_nodes, np.array(ids), np.array([0, 1.2]), 1, memmap_dir=tmp_path
+        )
+        assert isinstance(orig.grid_data.base, np.memmap)
+        orig[3] = np.array([1, 3])
+        orig.standardize()
+        orig.force_probability_space(LOG_GRID)
+        orig.force_probability_space(LIN_GRID)
+        orig.to_probabilities()
+        assert isinstance(orig.grid_data.base, np.memmap)
+        assert np.allclose(orig[3], [0.25, 0.75])
+        for grid_data in (0, 5, np.array([[1, 2], [4, 3]])):
+            clone = orig.clone_with_new_data(grid_data)
+            assert isinstance(clone.grid_data.base, np.memmap)
+        clone = orig.clone_with_new_data(0, memmap_dir=None)
+        assert clone.memmap_dir == tmp_path
+        assert len(list(tmp_path.iterdir())) == 0
+
+    def test_empty_memmap(self, tmp_path):
+        store = NodeTimeValues(3, np.array([], dtype=int), np.array([0, 1.2]), 0)
+        clone = store.clone_with_new_data(0, memmap_dir=tmp_path)
+        assert clone.grid_data.shape == (0, 2)
+
     def test_bad_clone(self):
         num_nodes = 10
         ids = [3, 4]
@@ -1090,6 +1378,64 @@ class TestInsideAlgorithm:
         lik_lin = self.run_inside_algorithm(ts, "gamma", logspace=False)[2]
         assert np.isclose(lik_log, np.log(lik_lin))
 
+    @pytest.mark.parametrize("logspace", [False, True])
+    @pytest.mark.parametrize("mut_rate", [1e-8, None])
+    def test_matches_edge_by_edge(self, logspace, mut_rate):
+        # Compare the compiled inside pass to one calculated an edge at a time
+        ts = msprime.sim_mutations(
+            msprime.sim_ancestry(
+                8,
+                sequence_length=1e5,
+                recombination_rate=1e-8,
+                population_size=1e4,
+                random_seed=2,
+            ),
+            rate=1e-8,
+            random_seed=2,
+        )
+        priors = tsdate.build_prior_grid(ts, population_size=1e4, timepoints=10)
+        lik_class = LogLikelihoods if logspace else Likelihoods
+        lik = lik_class(ts, priors.timepoints, mut_rate, eps=1e-6)
+        if mut_rate is not None:
+            lik.precalculate_mutation_likelihoods()
+        algo = BeliefPropagation(priors, lik)
+        marginal_lik = algo.inside_pass(cache_inside=True)
+        expected = priors.clone_with_new_data(grid_data=np.nan, fixed_data=0)
+        expected.force_probability_space(lik.probability_space)
+        expected.fixed_data[:] = lik.identity_constant
+        expected_marginal_lik = lik.identity_constant
+        for parent, edges in algo.edges_by_parent_asc():
+            if parent in lik.fixednodes:
+                continue
+            val = priors[parent].copy()
+            for edge in edges:
+                spanfrac = edge.span / algo.spans[edge.child]
+                if edge.child in lik.fixednodes:
+                    daughter_val = lik.scale_geometric(spanfrac, expected[edge.child])
+                    edge_lik = lik.get_fixed(daughter_val, edge)
+                else:
+                    daughter_val = lik.scale_geometric(
+                        spanfrac, lik.make_lower_tri(expected[edge.child])
+                    )
+                    edge_lik = lik.get_inside(daughter_val, edge)
+                val = lik.combine(val, edge_lik)
+                assert np.allclose(
+                    algo.g_i[edge.id],
+                    lik.ratio(edge_lik, algo.denominator[edge.child]),
+                    equal_nan=True,
+                )
+            expected[parent] = lik.ratio(val, np.max(val))
+            expected_marginal_lik = lik.combine(expected_marginal_lik, np.max(val))
+        assert np.allclose(algo.inside.grid_data, expected.grid_data)
+        for root, span_when_root in algo.root_spans.items():
+            root_val = lik.scale_geometric(
+                span_when_root / algo.spans[root], expected[root]
+            )
+            expected_marginal_lik = lik.combine(
+                expected_marginal_lik, lik.marginalize(root_val)
+            )
+        assert np.isclose(marginal_lik, expected_marginal_lik)
+
 
 class TestOutsideAlgorithm:
     def run_outside_algorithm(
@@ -1186,6 +1532,89 @@ class TestOutsideAlgorithm:
         assert np.array_equal(ignore_oldest.outside[4], ignore_oldest.outside[5])
         assert ~np.array_equal(use_oldest.outside[4], use_oldest.outside[5])
 
+    @pytest.mark.parametrize("logspace", [False, True])
+    @pytest.mark.parametrize("standardize", [False, True])
+    @pytest.mark.parametrize("ignore_oldest_root", [False, True])
+    def test_cached_inside_matches_recalculated(
+        self, logspace, standardize, ignore_oldest_root
+    ):
+        # The outside pass recalculates the inside values for each edge when
+        # they have not been cached by the inside pass
+        ts = msprime.sim_mutations(
+            msprime.sim_ancestry(
+                8,
+                sequence_length=1e5,
+                recombination_rate=1e-8,
+                population_size=1e4,
+                random_seed=3,
+            ),
+            rate=1e-8,
+            random_seed=3,
+        )
+        priors = tsdate.build_prior_grid(ts, population_size=1e4, timepoints=10)
+        lik_class = LogLikelihoods if logspace else Likelihoods
+        lik = lik_class(ts, priors.timepoints, 1e-8, eps=1e-6)
+        lik.precalculate_mutation_likelihoods()
+        outside = []
+        for cache_inside in (False, True):
+            algo = BeliefPropagation(priors, lik)
+            algo.inside_pass(cache_inside=cache_inside)
+            algo.outside_pass(
+                standardize=standardize, ignore_oldest_root=ignore_oldest_root
+            )
+            outside.append(algo.outside.grid_data)
+        assert np.allclose(outside[0], outside[1])
+
+
+class TestLikelihoodBands:
+    @pytest.mark.parametrize("logspace", [False, True])
+    @pytest.mark.parametrize("cache_inside", [False, True])
+    def test_matches_truncated(self, logspace, cache_inside):
+        # Only visiting the bands gives the same results as using all the
+        # (truncated) likelihoods
+        ts = msprime.sim_mutations(
+            msprime.sim_ancestry(
+                8,
+                sequence_length=1e6,
+                recombination_rate=1e-8,
+                population_size=1e4,
+                random_seed=6,
+            ),
+            rate=1e-7,
+            random_seed=6,
+        )
+        priors = tsdate.build_prior_grid(ts, population_size=1e4, timepoints=10)
+        lik_class = LogLikelihoods if logspace else Likelihoods
+        results = []
+        for use_bands in (True, False):
+            lik = lik_class(
+                ts, priors.timepoints, 1e-7, eps=1e-6, likelihood_threshold=1e-6
+            )
+            lik.precalculate_mutation_likelihoods()
+            if not use_bands:
+                lik.likelihood_threshold = None
+            algo = BeliefPropagation(priors, lik)
+            marginal_lik = algo.inside_pass(cache_inside=cache_inside)
+            algo.outside_pass(standardize=True)
+            results.append((marginal_lik, algo.inside.grid_data, algo.outside.grid_data))
+        assert len(lik.unfixed_bands) > 0
+        assert np.isclose(results[0][0], results[1][0])
+        assert np.allclose(results[0][1], results[1][1])
+        assert np.allclose(results[0][2], results[1][2])
+
+    @pytest.mark.parametrize("method", ["inside_outside", "maximization"])
+    def test_date(self, method):
+        ts = utility_functions.two_tree_mutation_ts()
+        dated = tsdate.date(
+            ts,
+            mutation_rate=1,
+            population_size=1,
+            method=method,
+            likelihood_threshold=0,
+        )
+        expected = tsdate.date(ts, mutation_rate=1, population_size=1, method=method)
+        assert np.allclose(dated.nodes_time, expected.nodes_time)
+
 
 class TestTotalFunctionalValueTree:
     """
@@ -1364,6 +1793,18 @@ class TestOutsideEdgesOrdering:
         self.edges_ordering(inferred_ts, "outside_pass")
         self.edges_ordering(inferred_ts, "outside_maximization")
 
+    def test_child_desc_offsets(self):
+        ts = utility_functions.two_tree_two_mrcas()
+        priors = tsdate.build_prior_grid(ts, 0.5)
+        lls = Likelihoods(ts, priors.timepoints, 1)
+        algo = BeliefPropagation(priors, lls)
+        edges_order, child_offsets = algo.edges_by_child_desc_offsets()
+        expected = [
+            [edge.id for edge in edges] for _, edges in algo.edges_by_child_desc()
+        ]
+        groups = [sorted(ids) for ids in np.split(edges_order, child_offsets[1:-1])]
+        assert groups == [sorted(ids) for ids in expected]
+
 
 class TestMaximization:
     """
@@ -2159,6 +2600,24 @@ class TestPopulationSizeHistory:
         assert np.isclose(numer_mn, analy_mn)
         assert np.isclose(numer_va, analy_va)
 
+    def test_gamma_to_natural_vectorised(self):
+        demography = PopulationSizeHistory([1000, 2000, 3000], [500, 2500])
+        shape = np.array([0.5, 2.8, 10.0, 100.0])
+        rate = np.array([0.1, 1.7, 3.0, 50.0])
+        natural = demography.gamma_to_natural(shape, rate)
+        assert natural.shape == (shape.size, 2)
+        for i in range(shape.size):
+            assert np.allclose(natural[i], demography.gamma_to_natural(shape[i], rate[i]))
+        assert demography.gamma_to_natural(shape[0], rate[0]).shape == (2,)
+
+    def test_gamma_to_natural_single_epoch(self):
+        demography = PopulationSizeHistory(1000)
+        shape = np.array([0.5, 2.8, 10.0])
+        rate = np.array([0.1, 1.7, 3.0])
+        natural = demography.gamma_to_natural(shape, rate)
+        assert np.allclose(natural[:, 0], shape)
+        assert np.allclose(natural[:, 1], rate / 2000)
+
     def test_bad_arguments(self):
         with pytest.raises(ValueError, match="greater than 0"):
             PopulationSizeHistory([None])
@@ -0,0 +1,101 @@
+# MIT License
+#
+# Copyright (c) 2024 Tskit Developers
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Test that importing tsdate is fast, by deferring the heavy submodules
+"""
+
+import subprocess
+import sys
+import time
+
+import pytest
+
+import tsdate
+
+# Modules that should only be loaded once a dating function is used
+HEAVY_MODULES = [
+    "numba",
+    "scipy",
+    "tqdm",
+    "appdirs",
+    "tsdate.core",
+    "tsdate.prior",
+    "tsdate.discrete",
+    "tsdate.variational",
+    "tsdate.rescaling",
+]
+
+# Wall time allowed for `import tsdate` in a fresh interpreter (in seconds), which is
+# generous: loading the compiled kernels takes many times longer than this
+IMPORT_TIME_BUDGET = 5
+
+
+def run_python(code):
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, check=True, text=True
+    )
+    return output.stdout.split()
+
+
+class TestLazyImports:
+    def test_heavy_modules_not_imported(self):
+        loaded = run_python(
+            "import sys; import tsdate; "
+            f"print(*[m for m in {HEAVY_MODULES} if m in sys.modules])"
+        )
+        assert loaded == []
+
+    def test_preprocess_does_not_import_core(self):
+        loaded = run_python(
+            "import sys; import tsdate; tsdate.preprocess_ts; "
+            f"print(*[m for m in {HEAVY_MODULES} if m in sys.modules])"
+        )
+        assert "tsdate.core" not in loaded
+        assert "tsdate.prior" not in loaded
+
+    def test_import_time(self):
+        start = time.perf_counter()
+        run_python("import tsdate")
+        assert time.perf_counter() - start < IMPORT_TIME_BUDGET
+
+    @pytest.mark.parametrize(
+        ("name", "module"),
+        [
+            ("date", "tsdate.core"),
+            ("variational_gamma", "tsdate.core"),
+            ("build_prior_grid", "tsdate.prior"),
+            ("preprocess_ts", "tsdate.util"),
+            ("get_cache_dir", "tsdate.cache"),
+            ("warmup", "tsdate.accelerate"),
+        ],
+    )
+    def test_lazy_function(self, name, module):
+        assert getattr(tsdate, name).__module__ == module
+        assert name in dir(tsdate)
+
+    def test_submodule(self):
+        assert tsdate.variational.__name__ == "tsdate.variational"
+
+    def test_missing_attribute(self):
+        with pytest.raises(AttributeError, match="no attribute 'foo'"):
+            tsdate.foo  # noqa: B018
+        assert not hasattr(tsdate, "foo")
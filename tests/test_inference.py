@@ -355,6 +355,82 @@ class TestSimulated:
         self.ts_equal_except_times(ts, dated_ts)
         self.ts_equal_except_times(ts, maximized_ts)
 
+    def test_refine_timepoints(self):
+        ts = msprime.simulate(
+            sample_size=10,
+            length=2e5,
+            Ne=10000,
+            mutation_rate=1e-8,
+            recombination_rate=1e-8,
+            random_seed=11,
+        )
+        priors = tsdate.build_prior_grid(ts, population_size=10000)
+        num_timepoints = len(priors.timepoints) + 20
+        dated_ts, fit = tsdate.inside_outside(
+            ts,
+            population_size=10000,
+            mutation_rate=1e-8,
+            refine_timepoints=num_timepoints,
+            return_fit=True,
+        )
+        self.ts_equal_except_times(ts, dated_ts)
+        assert len(fit.priors.timepoints) == num_timepoints
+        # Timepoints are rescaled when the priors are rebuilt, so allow for rounding
+        i = np.searchsorted(fit.priors.timepoints, priors.timepoints * (1 - 1e-12))
+        assert np.allclose(fit.priors.timepoints[i], priors.timepoints)
+        assert fit.posterior_grid.grid_data.shape[1] == num_timepoints
+
+    def test_refine_timepoints_errors(self):
+        ts = msprime.simulate(4, mutation_rate=1, random_seed=1)
+        priors = tsdate.build_prior_grid(ts, population_size=1)
+        with pytest.raises(ValueError, match="must be greater"):
+            tsdate.inside_outside(
+                ts, population_size=1, mutation_rate=1, refine_timepoints=2
+            )
+        with pytest.raises(ValueError, match="requires a population size"):
+            tsdate.inside_outside(
+                ts, priors=priors, mutation_rate=1, refine_timepoints=100
+            )
+
+    def test_single_precision(self):
+        ts = msprime.simulate(
+            sample_size=10,
+            length=2e5,
+            Ne=10000,
+            mutation_rate=1e-8,
+            recombination_rate=1e-8,
+            random_seed=11,
+        )
+        params = dict(population_size=10000, mutation_rate=1e-8, return_fit=True)
+        dated_ts, fit = tsdate.inside_outside(ts, **params)
+        single_ts, single_fit = tsdate.inside_outside(ts, single_precision=True, **params)
+        self.ts_equal_except_times(ts, single_ts)
+        assert single_fit.posterior_grid.grid_data.dtype == np.float32
+        np.testing.assert_allclose(dated_ts.nodes_time, single_ts.nodes_time, rtol=1e-3)
+        maximized_ts, max_fit = tsdate.maximization(ts, single_precision=True, **params)
+        self.ts_equal_except_times(ts, maximized_ts)
+        assert max_fit.inside.grid_data.dtype == np.float32
+
+    def test_memmap_dir(self, tmp_path):
+        ts = msprime.simulate(
+            sample_size=10,
+            length=2e5,
+            Ne=10000,
+            mutation_rate=1e-8,
+            recombination_rate=1e-8,
+            random_seed=11,
+        )
+        params = dict(population_size=10000, mutation_rate=1e-8, return_fit=True)
+        dated_ts, fit = tsdate.inside_outside(ts, **params)
+        mmap_ts, mmap_fit = tsdate.inside_outside(
+            ts, memmap_dir=tmp_path, cache_inside=True, **params
+        )
+        assert isinstance(mmap_fit.posterior_grid.grid_data.base, np.memmap)
+        assert isinstance(mmap_fit.g_i.base, np.memmap)
+        assert np.array_equal(dated_ts.nodes_time, mmap_ts.nodes_time)
+        # The temporary files are unlinked as soon as they are made
+        assert len(list(tmp_path.iterdir())) == 0
+
     def test_with_unary(self):
         ts = msprime.simulate(
             8,
@@ -477,6 +553,369 @@ class TestVariational:
     def test_bad_arguments(self):
         with pytest.raises(ValueError, match="Maximum number of EP iterations"):
             tsdate.variational_gamma(self.ts, mutation_rate=5, max_iterations=-1)
+        with pytest.raises(ValueError, match="Convergence tolerance"):
+            tsdate.variational_gamma(self.ts, mutation_rate=5, convergence_tolerance=0)
+
+    def test_convergence_tolerance(self):
+        _, fit = tsdate.variational_gamma(
+            self.ts, mutation_rate=1e-8, max_iterations=100, return_fit=True
+        )
+        assert fit.ep_iterations == 100
+        assert len(fit.max_relative_change) == 100
+        _, fit = tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            max_iterations=100,
+            convergence_tolerance=1e-3,
+            return_fit=True,
+        )
+        assert fit.ep_iterations < 100
+        assert fit.max_relative_change[-1] < 1e-3
+        assert all(x >= 1e-3 for x in fit.max_relative_change[:-1])
+
+    def test_checkpoint_resume(self, tmp_path):
+        checkpoint = tmp_path / "ep.npz"
+        _, fit = tsdate.variational_gamma(
+            self.ts, mutation_rate=1e-8, max_iterations=10, return_fit=True
+        )
+        tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            max_iterations=4,
+            checkpoint_file=checkpoint,
+            checkpoint_interval=3,
+        )
+        _, resumed_fit = tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            max_iterations=10,
+            checkpoint_file=checkpoint,
+            resume=True,
+            return_fit=True,
+        )
+        assert resumed_fit.ep_iterations == 10
+        np.testing.assert_array_equal(
+            fit.mean_edge_logconst, resumed_fit.mean_edge_logconst
+        )
+        np.testing.assert_array_equal(fit.node_posterior, resumed_fit.node_posterior)
+        np.testing.assert_array_equal(fit.edge_factors, resumed_fit.edge_factors)
+
+    def test_checkpoint_mismatch(self, tmp_path):
+        checkpoint = tmp_path / "ep.npz"
+        tsdate.variational_gamma(
+            self.ts, mutation_rate=1e-8, max_iterations=1, checkpoint_file=checkpoint
+        )
+        other_ts = msprime.sim_mutations(
+            msprime.sim_ancestry(samples=5, sequence_length=1e5, random_seed=3),
+            rate=1e-4,
+            random_seed=3,
+        )
+        with pytest.raises(ValueError, match="does not match the tree sequence"):
+            tsdate.variational_gamma(
+                other_ts, mutation_rate=1e-8, checkpoint_file=checkpoint, resume=True
+            )
+        for params in (
+            dict(mutation_rate=2e-8),
+            dict(mutation_rate=1e-8, singletons_phased=False),
+            dict(mutation_rate=1e-8, single_precision=True),
+        ):
+            with pytest.raises(ValueError, match="does not match the parameters"):
+                tsdate.variational_gamma(
+                    self.ts, checkpoint_file=checkpoint, resume=True, **params
+                )
+        with pytest.raises(ValueError, match="checkpoint file is required"):
+            tsdate.variational_gamma(self.ts, mutation_rate=1e-8, resume=True)
+
+    @pytest.mark.parametrize("singletons_phased", [True, False])
+    def test_initialize_posteriors(self, singletons_phased):
+        _, fit = tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            singletons_phased=singletons_phased,
+            return_fit=True,
+        )
+        posteriors = fit.node_posteriors()
+        warm_fit = tsdate.variational.ExpectationPropagation(
+            self.ts, mutation_rate=1e-8, singletons_phased=singletons_phased
+        )
+        warm_fit.initialize_posteriors(posteriors["mean"], posteriors["variance"])
+        np.testing.assert_allclose(warm_fit.node_moments()[0], posteriors["mean"])
+        warm_fit.iterate(check_valid=True)
+
+    def test_warm_start(self):
+        params = dict(mutation_rate=1e-8, rescaling_intervals=0, return_fit=True)
+        dated_ts, fit = tsdate.variational_gamma(self.ts, **params)
+        params["convergence_tolerance"] = 1e-3
+        _, cold_fit = tsdate.variational_gamma(self.ts, **params)
+        for ts, initial_posteriors in [
+            (self.ts, fit.node_posteriors()),
+            (dated_ts, "metadata"),
+        ]:
+            _, warm_fit = tsdate.variational_gamma(
+                ts, initial_posteriors=initial_posteriors, **params
+            )
+            assert warm_fit.ep_iterations < cold_fit.ep_iterations
+
+    def test_bad_initial_posteriors(self):
+        with pytest.raises(ValueError, match="no node time metadata"):
+            tsdate.variational_gamma(
+                self.ts, mutation_rate=1e-8, initial_posteriors="metadata"
+            )
+        with pytest.raises(ValueError, match="must be 'metadata'"):
+            tsdate.variational_gamma(
+                self.ts, mutation_rate=1e-8, initial_posteriors="foo"
+            )
+        posteriors = np.zeros(1, dtype=[("mean", float), ("variance", float)])
+        with pytest.raises(ValueError, match="for all"):
+            tsdate.variational_gamma(
+                self.ts, mutation_rate=1e-8, initial_posteriors=posteriors
+            )
+
+    @pytest.mark.parametrize("singletons_phased", [True, False])
+    def test_single_precision(self, singletons_phased):
+        ts, fit = tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            singletons_phased=singletons_phased,
+            return_fit=True,
+        )
+        single_ts, single_fit = tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            singletons_phased=singletons_phased,
+            single_precision=True,
+            return_fit=True,
+        )
+        assert single_fit.node_posterior.dtype == np.float32
+        assert single_fit.edge_factors.dtype == np.float32
+        assert single_fit.edge_likelihoods.dtype == np.float32
+        mn, va = fit.node_moments()
+        single_mn, single_va = single_fit.node_moments()
+        np.testing.assert_allclose(mn, single_mn, rtol=1e-3)
+        np.testing.assert_allclose(va, single_va, rtol=1e-2)
+        np.testing.assert_allclose(ts.nodes_time, single_ts.nodes_time, rtol=1e-3)
+
+    def test_single_precision_threaded(self):
+        _, fit = tsdate.variational_gamma(
+            self.ts, mutation_rate=1e-8, single_precision=True, return_fit=True
+        )
+        _, threaded_fit = tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            single_precision=True,
+            num_threads=2,
+            return_fit=True,
+        )
+        np.testing.assert_array_equal(fit.node_posterior, threaded_fit.node_posterior)
+
+    def test_genomic_windows(self):
+        core, extended = tsdate.variational.genomic_windows(100, 30, 5)
+        np.testing.assert_array_equal(core, [[0, 30], [30, 60], [60, 90], [90, 100]])
+        np.testing.assert_array_equal(extended, [[0, 35], [25, 65], [55, 95], [85, 100]])
+
+    @pytest.mark.parametrize("singletons_phased", [True, False])
+    def test_single_window(self, singletons_phased):
+        ts = tsdate.variational_gamma(
+            self.ts, mutation_rate=1e-8, singletons_phased=singletons_phased
+        )
+        windowed_ts = tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            singletons_phased=singletons_phased,
+            window_size=self.ts.sequence_length,
+        )
+        np.testing.assert_allclose(ts.nodes_time, windowed_ts.nodes_time)
+        np.testing.assert_allclose(ts.mutations_time, windowed_ts.mutations_time)
+        np.testing.assert_array_equal(ts.mutations_node, windowed_ts.mutations_node)
+
+    @pytest.mark.parametrize("singletons_phased", [True, False])
+    def test_windows(self, singletons_phased):
+        ts = tsdate.variational_gamma(
+            self.ts, mutation_rate=1e-8, singletons_phased=singletons_phased
+        )
+        windowed_ts = tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            singletons_phased=singletons_phased,
+            window_size=5e4,
+        )
+        assert np.all(np.isfinite(windowed_ts.nodes_time))
+        assert np.all(np.isfinite(windowed_ts.mutations_time))
+        free = np.full(ts.num_nodes, True)
+        free[list(ts.samples())] = False
+        corr = np.corrcoef(
+            np.log(ts.nodes_time[free]), np.log(windowed_ts.nodes_time[free])
+        )
+        assert corr[0, 1] > 0.95
+
+    @pytest.mark.parametrize("num_threads", [None, 2])
+    def test_windows_num_processes(self, num_threads):
+        # worker processes are spawned, so can be combined with numba threads
+        ts = tsdate.variational_gamma(self.ts, mutation_rate=1e-8, window_size=5e4)
+        pooled_ts = tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            window_size=5e4,
+            num_processes=2,
+            num_threads=num_threads,
+        )
+        np.testing.assert_array_equal(ts.nodes_time, pooled_ts.nodes_time)
+
+    def test_bad_windows(self, tmp_path):
+        with pytest.raises(ValueError, match="Window size"):
+            tsdate.variational_gamma(self.ts, mutation_rate=1e-8, window_size=0)
+        with pytest.raises(ValueError, match="Window overlap"):
+            tsdate.variational_gamma(
+                self.ts, mutation_rate=1e-8, window_size=1e4, window_overlap=-1
+            )
+        with pytest.raises(ValueError, match="Checkpointing"):
+            tsdate.variational_gamma(
+                self.ts,
+                mutation_rate=1e-8,
+                window_size=1e4,
+                checkpoint_file=tmp_path / "checkpoint.npz",
+            )
+        with pytest.raises(ValueError, match="fit object"):
+            tsdate.variational_gamma(
+                self.ts, mutation_rate=1e-8, window_size=1e4, return_fit=True
+            )
+
+    @pytest.mark.parametrize("num_threads", [1, 2])
+    @pytest.mark.parametrize("singletons_phased", [True, False])
+    def test_num_threads(self, num_threads, singletons_phased):
+        ts, fit = tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            singletons_phased=singletons_phased,
+            return_fit=True,
+        )
+        threaded_ts, threaded_fit = tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            singletons_phased=singletons_phased,
+            num_threads=num_threads,
+            return_fit=True,
+        )
+        np.testing.assert_array_equal(fit.node_posterior, threaded_fit.node_posterior)
+        np.testing.assert_array_equal(fit.edge_factors, threaded_fit.edge_factors)
+        np.testing.assert_array_equal(fit.block_factors, threaded_fit.block_factors)
+        np.testing.assert_array_equal(
+            fit.mutation_posterior, threaded_fit.mutation_posterior
+        )
+        np.testing.assert_array_equal(fit.mutation_phase, threaded_fit.mutation_phase)
+        np.testing.assert_array_equal(fit.mutation_nodes, threaded_fit.mutation_nodes)
+        np.testing.assert_array_equal(ts.nodes_time, threaded_ts.nodes_time)
+        np.testing.assert_array_equal(ts.mutations_time, threaded_ts.mutations_time)
+
+    def test_edge_schedule(self):
+        fit = tsdate.variational.ExpectationPropagation(
+            self.ts, mutation_rate=1e-8, singletons_phased=False
+        )
+        fit.schedule()
+        fixed = fit.node_constraints[:, 0] == fit.node_constraints[:, 1]
+        for order, parents, children, (batch_order, batch_offsets) in [
+            (fit.edge_order, fit.edge_parents, fit.edge_children, fit.edge_schedule),
+            (fit.block_order, *fit.block_nodes, fit.block_schedule),
+        ]:
+            assert np.array_equal(np.sort(order), np.sort(batch_order))
+            assert batch_offsets[0] == 0
+            assert batch_offsets[-1] == order.size
+            # no unfixed node is updated twice within a batch
+            for a, b in zip(batch_offsets[:-1], batch_offsets[1:]):
+                nodes = np.concatenate(
+                    [parents[batch_order[a:b]], children[batch_order[a:b]]]
+                )
+                nodes = nodes[~fixed[nodes]]
+                assert np.unique(nodes).size == nodes.size
+            # updates to each node are in the original order
+            for u in np.flatnonzero(~fixed):
+                original = [i for i in order if u in (parents[i], children[i])]
+                batched = [i for i in batch_order if u in (parents[i], children[i])]
+                assert original == batched
+
+    @pytest.mark.parametrize("singletons_phased", [True, False])
+    def test_residual_tolerance(self, singletons_phased):
+        ts, fit = tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            singletons_phased=singletons_phased,
+            return_fit=True,
+        )
+        residual_ts, residual_fit = tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            singletons_phased=singletons_phased,
+            residual_tolerance=1e-3,
+            return_fit=True,
+        )
+        num_updates = fit.edge_order.size
+        assert fit.edge_updates == [num_updates] * fit.ep_iterations
+        assert residual_fit.edge_updates[0] == num_updates
+        assert all(x <= num_updates for x in residual_fit.edge_updates)
+        assert sum(residual_fit.edge_updates) < sum(fit.edge_updates)
+        free = np.full(ts.num_nodes, True)
+        free[list(ts.samples())] = False
+        np.testing.assert_allclose(
+            ts.nodes_time[free], residual_ts.nodes_time[free], rtol=0.05
+        )
+
+    def test_residual_first_iteration(self):
+        # the first iteration visits every edge in the usual order
+        _, fit = tsdate.variational_gamma(
+            self.ts, mutation_rate=1e-8, max_iterations=1, return_fit=True
+        )
+        _, residual_fit = tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            max_iterations=1,
+            residual_tolerance=1e-3,
+            return_fit=True,
+        )
+        np.testing.assert_array_equal(fit.edge_factors, residual_fit.edge_factors)
+        np.testing.assert_array_equal(fit.node_posterior, residual_fit.node_posterior)
+
+    def test_max_edge_updates(self):
+        _, fit = tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            residual_tolerance=0,
+            max_edge_updates=10,
+            return_fit=True,
+        )
+        assert fit.edge_updates[0] == fit.edge_order.size
+        assert all(x <= 10 for x in fit.edge_updates[1:])
+
+    def test_node_edges(self):
+        fit = tsdate.variational.ExpectationPropagation(
+            self.ts, mutation_rate=1e-8, singletons_phased=False
+        )
+        node_edges, node_offsets = tsdate.variational._node_edges(
+            fit.edge_order, fit.edge_parents, fit.edge_children, self.ts.num_nodes
+        )
+        edges = np.unique(fit.edge_order)
+        for u in range(self.ts.num_nodes):
+            attached = node_edges[node_offsets[u] : node_offsets[u + 1]]
+            expected = edges[
+                np.logical_or(fit.edge_parents[edges] == u, fit.edge_children[edges] == u)
+            ]
+            np.testing.assert_array_equal(np.sort(attached), expected)
+
+    def test_bad_residual_tolerance(self):
+        with pytest.raises(ValueError, match="non-negative"):
+            tsdate.variational_gamma(self.ts, mutation_rate=1e-8, residual_tolerance=-1)
+        with pytest.raises(ValueError, match="num_threads"):
+            tsdate.variational_gamma(
+                self.ts, mutation_rate=1e-8, residual_tolerance=1e-3, num_threads=2
+            )
+        with pytest.raises(ValueError, match="requires a residual tolerance"):
+            tsdate.variational_gamma(self.ts, mutation_rate=1e-8, max_edge_updates=10)
+        with pytest.raises(ValueError, match="greater than 0"):
+            tsdate.variational_gamma(
+                self.ts,
+                mutation_rate=1e-8,
+                residual_tolerance=1e-3,
+                max_edge_updates=0,
+            )
 
     def test_no_set_metadata(self):
         assert len(self.ts.tables.mutations.metadata) == 0
@@ -576,3 +1015,104 @@ class TestVariational:
         dts = tsdate.variational_gamma(ts, mutation_rate=1e-8, set_metadata=True)
         assert len(dts.tables.mutations.metadata) > 0
         assert len(dts.tables.nodes.metadata) > 0
+
+
+class TestDateMany:
+    """
+    Tests for dating many tree sequences in one call
+    """
+
+    @pytest.fixture(autouse=True)
+    def tree_sequences(self):  # noqa PT004
+        self.tree_sequences = [
+            msprime.sim_mutations(
+                msprime.sim_ancestry(
+                    samples=n,
+                    recombination_rate=1e-8,
+                    sequence_length=1e5,
+                    population_size=1e4,
+                    random_seed=n,
+                ),
+                rate=1e-8,
+                random_seed=n,
+            )
+            for n in (5, 20, 10)
+        ]
+
+    def test_returns_dated(self):
+        results = tsdate.date_many(self.tree_sequences, mutation_rate=1e-8)
+        assert len(results) == len(self.tree_sequences)
+        for ts, result in zip(self.tree_sequences, results):
+            assert result.source is ts
+            assert result.output is None
+            assert result.time > 0
+            dts = tsdate.date(ts, mutation_rate=1e-8)
+            assert np.array_equal(result.tree_sequence.nodes_time, dts.nodes_time)
+
+    def test_output_files(self, tmp_path):
+        paths = []
+        for i, ts in enumerate(self.tree_sequences):
+            paths.append(tmp_path / f"input{i}.trees")
+            ts.dump(paths[-1])
+        outputs = [tmp_path / f"output{i}.trees" for i in range(len(paths))]
+        results = tsdate.date_many(
+            paths,
+            mutation_rate=1e-8,
+            output_files=outputs,
+            method="maximization",
+            population_size=1e4,
+        )
+        for ts, output, result in zip(self.tree_sequences, outputs, results):
+            assert result.tree_sequence is None
+            assert result.output == output
+            dts = tsdate.date(
+                ts, mutation_rate=1e-8, method="maximization", population_size=1e4
+            )
+            assert np.array_equal(tskit.load(output).nodes_time, dts.nodes_time)
+
+    def test_biggest_first(self, caplog):
+        with caplog.at_level(logging.INFO, logger="tsdate.core"):
+            tsdate.date_many(self.tree_sequences, mutation_rate=1e-8)
+        dated = [r.getMessage() for r in caplog.records if "Dated" in r.getMessage()]
+        sizes = [ts.nbytes for ts in self.tree_sequences]
+        order = np.argsort(sizes)[::-1]
+        assert [d.split(" in ")[0] for d in dated] == [
+            f"Dated tree sequence {i}" for i in order
+        ]
+
+    def test_num_processes(self):
+        results = tsdate.date_many(
+            self.tree_sequences, mutation_rate=1e-8, num_processes=2
+        )
+        for ts, result in zip(self.tree_sequences, results):
+            dts = tsdate.date(ts, mutation_rate=1e-8)
+            assert np.array_equal(result.tree_sequence.nodes_time, dts.nodes_time)
+
+    def test_bad_output_files(self):
+        with pytest.raises(ValueError, match="one output file for each"):
+            tsdate.date_many(self.tree_sequences, mutation_rate=1e-8, output_files=["a"])
+
+    @pytest.mark.parametrize(
+        "param",
+        [
+            "return_fit",
+            "return_likelihood",
+            "instrumentation_callback",
+            "checkpoint_file",
+            "resume",
+        ],
+    )
+    def test_bad_param(self, param):
+        with pytest.raises(ValueError, match=f"{param} cannot be used"):
+            tsdate.date_many(self.tree_sequences, mutation_rate=1e-8, **{param: True})
+
+    def test_default_params(self):
+        results = tsdate.date_many(
+            self.tree_sequences,
+            mutation_rate=1e-8,
+            return_fit=False,
+            return_likelihood=False,
+            checkpoint_file=None,
+            resume=False,
+        )
+        assert len(results) == len(self.tree_sequences)
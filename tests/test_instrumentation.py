@@ -0,0 +1,162 @@
+# MIT License
+#
+# Copyright (c) 2024 Tskit Developers
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Test cases for recording timings and counts
+"""
+
+import json
+import time
+
+import msprime
+import numpy as np
+import pytest
+
+import tsdate
+from tsdate.instrumentation import Instrumentation
+
+
+class TestInstrumentation:
+    def test_stage(self):
+        instrumentation = Instrumentation("test")
+        with instrumentation.stage("a"):
+            time.sleep(0.01)
+        assert instrumentation.time("a") >= 0.01
+        assert instrumentation.stages["a"]["peak_rss"] > 0
+        first = instrumentation.time("a")
+        with instrumentation.stage("a"):
+            time.sleep(0.01)
+        assert instrumentation.time("a") >= first + 0.01
+
+    def test_stage_error(self):
+        instrumentation = Instrumentation()
+        with pytest.raises(ValueError):
+            with instrumentation.stage("a"):
+                raise ValueError()
+        assert "a" in instrumentation.stages
+
+    def test_counts_and_iterations(self):
+        instrumentation = Instrumentation()
+        instrumentation.count("a", np.int64(3))
+        instrumentation.record("b", np.array([np.inf, 0.5, np.nan]))
+        assert instrumentation.counts == {"a": 3}
+        assert instrumentation.iterations == {"b": [None, 0.5, None]}
+
+    def test_json(self):
+        instrumentation = Instrumentation("test")
+        with instrumentation.stage("a"):
+            pass
+        instrumentation.count("b", 1)
+        instrumentation.record("c", [np.inf, 1.0])
+        instrumentation.finish()
+        assert instrumentation.total_time > 0
+        data = json.loads(instrumentation.to_json(allow_nan=False))
+        assert data == instrumentation.as_dict()
+        assert data["method"] == "test"
+        assert data["tsdate_version"] == tsdate.__version__
+        assert set(data["stages"]["a"]) == {"time", "peak_rss"}
+        assert data["counts"] == {"b": 1}
+        assert data["iterations"] == {"c": [None, 1.0]}
+
+
+class TestDateInstrumentation:
+    @pytest.fixture(autouse=True)
+    def ts(self):  # noqa PT004
+        ts = msprime.sim_ancestry(
+            samples=10,
+            recombination_rate=1e-8,
+            sequence_length=1e5,
+            population_size=1e4,
+            random_seed=2,
+        )
+        self.ts = msprime.sim_mutations(ts, rate=1e-8, random_seed=1)
+
+    @pytest.mark.parametrize("singletons_phased", [True, False])
+    def test_variational_gamma(self, singletons_phased):
+        recorded = []
+        _, fit = tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            max_iterations=5,
+            singletons_phased=singletons_phased,
+            return_fit=True,
+            instrumentation_callback=recorded.append,
+        )
+        assert len(recorded) == 1
+        instrumentation = recorded[0]
+        assert instrumentation is fit.instrumentation
+        assert instrumentation.method == "variational_gamma"
+        for stage in (
+            "mutation_counts",
+            "node_posteriors",
+            "mutation_posteriors",
+            "rescaling",
+            "constrain_ages",
+            "metadata",
+            "sort",
+        ):
+            assert stage in instrumentation.stages
+        assert instrumentation.total_time >= sum(
+            x["time"] for x in instrumentation.stages.values()
+        )
+        counts = instrumentation.counts
+        assert counts["ep_iterations"] == 5
+        assert counts["edge_updates"] == 5 * fit.edge_order.size
+        assert counts["skipped_edges"] == np.sum(np.isnan(fit.edge_logconst))
+        assert counts["skipped_mutations"] == 0
+        unphased = np.sum(fit.mutation_blocks != -1)
+        assert counts["unphased_singletons"] == unphased
+        assert counts["switched_singletons"] <= unphased
+        assert counts["singleton_blocks"] == fit.block_factors.shape[0]
+        iterations = instrumentation.iterations
+        assert iterations["max_relative_change"][0] is None
+        assert iterations["max_relative_change"][1:] == fit.max_relative_change[1:]
+        assert iterations["mean_edge_logconst"] == fit.mean_edge_logconst
+        assert iterations["edge_updates"] == fit.edge_updates
+        json.loads(instrumentation.to_json(allow_nan=False))
+
+    def test_windows(self):
+        recorded = []
+        tsdate.variational_gamma(
+            self.ts,
+            mutation_rate=1e-8,
+            window_size=5e4,
+            instrumentation_callback=recorded.append,
+        )
+        assert "windows" in recorded[0].stages
+        assert "mutation_edges" in recorded[0].stages
+
+    @pytest.mark.parametrize(
+        ("method", "stage"),
+        [("inside_outside", "outside"), ("maximization", "outside_maximization")],
+    )
+    def test_discrete(self, method, stage):
+        recorded = []
+        tsdate.date(
+            self.ts,
+            mutation_rate=1e-8,
+            population_size=1e4,
+            method=method,
+            instrumentation_callback=recorded.append,
+        )
+        assert recorded[0].method == method
+        for name in ("priors", "likelihoods", "inside", stage, "constrain_ages"):
+            assert name in recorded[0].stages
@@ -24,9 +24,12 @@ Test cases for prior functionality used in tsdate
 """
 
 import logging
+from collections import defaultdict
 
+import msprime
 import numpy as np
 import pytest
+import tskit
 import utility_functions
 
 from tsdate.prior import (
@@ -35,6 +38,7 @@ from tsdate.prior import (
     SpansBySamples,
     conditional_coalescent_variance,
     create_timepoints,
+    refine_timepoints,
 )
 
 
@@ -126,6 +130,108 @@ class TestSpansBySamples:
         with pytest.raises(ValueError, match="multiple roots"):
             SpansBySamples(ts)
 
+    @staticmethod
+    def treewise_spans(ts):
+        # Spans of each non-sample node by total and descendant samples, tree by tree
+        spans = defaultdict(lambda: defaultdict(float))
+        for tree in ts.trees():
+            total = sum(tree.parent(u) != tskit.NULL for u in ts.samples())
+            for u in tree.nodes():
+                if not tree.is_sample(u):
+                    spans[u][(total, tree.num_samples(u))] += tree.span
+        return spans
+
+    def verify_compiled_spans(self, ts):
+        span_data = SpansBySamples(ts)
+        expected = self.treewise_spans(ts)
+        assert set(span_data.nodes_to_date) == set(expected)
+        for u, node_spans in expected.items():
+            spans = {
+                (total, k): v
+                for total, wt in span_data.get_spans(u).items()
+                for k, v in zip(wt["descendant_tips"], wt["span"])
+            }
+            assert spans.keys() == node_spans.keys()
+            for key, span in node_spans.items():
+                assert spans[key] == pytest.approx(span)
+            assert span_data.node_spans[u] == pytest.approx(sum(node_spans.values()))
+
+    def test_compiled_matches_trees(self):
+        ts = msprime.sim_ancestry(
+            10, sequence_length=1e5, recombination_rate=1e-8, random_seed=1
+        )
+        assert ts.num_trees > 1
+        self.verify_compiled_spans(ts)
+
+    def test_compiled_missing_data(self):
+        ts = msprime.sim_ancestry(
+            10, sequence_length=1e5, recombination_rate=1e-8, random_seed=1
+        )
+        tables = ts.dump_tables()
+        # Sample 0 is missing from the first half of the genome
+        edges = tables.edges
+        left = np.where(edges.child == 0, np.maximum(edges.left, 5e4), edges.left)
+        keep = left < edges.right
+        tables.edges.set_columns(
+            left=left[keep],
+            right=edges.right[keep],
+            parent=edges.parent[keep],
+            child=edges.child[keep],
+        )
+        tables.sort()
+        ts = tables.tree_sequence().simplify(keep_input_roots=False)
+        span_data = SpansBySamples(ts)
+        assert span_data.total_fixed_at_0_counts == {ts.num_samples - 1, ts.num_samples}
+        # As in the treewise pass, sample spans start at the left of the genome
+        assert span_data.node_spans[0] == pytest.approx(ts.sequence_length)
+        self.verify_compiled_spans(ts)
+
+    def test_csr_layout(self):
+        ts = msprime.sim_ancestry(
+            10, sequence_length=1e5, recombination_rate=1e-8, random_seed=1
+        )
+        span_data = SpansBySamples(ts)
+        offsets = span_data.node_offsets
+        assert len(offsets) == ts.num_nodes + 1
+        assert offsets[0] == 0
+        assert offsets[-1] == len(span_data.total_tips) == len(span_data.span)
+        assert len(span_data.descendant_tips) == len(span_data.span)
+        assert np.all(np.diff(offsets)[ts.samples()] == 0)
+        assert np.array_equal(span_data.nodes_to_date, np.flatnonzero(np.diff(offsets)))
+        for u in span_data.nodes_to_date:
+            rows = slice(offsets[u], offsets[u + 1])
+            assert np.sum(span_data.span[rows]) == pytest.approx(span_data.node_spans[u])
+            keys = np.column_stack(
+                (span_data.total_tips[rows], span_data.descendant_tips[rows])
+            )
+            assert np.array_equal(keys, np.unique(keys, axis=0))
+
+
+class TestMixturePriorParams:
+    @pytest.mark.parametrize("prior_distr", ["gamma", "lognorm"])
+    def test_matches_mixture_expect_and_var(self, prior_distr):
+        ts = msprime.sim_ancestry(
+            10, sequence_length=1e5, recombination_rate=1e-8, random_seed=1
+        )
+        span_data = SpansBySamples(ts)
+        priors = ConditionalCoalescentTimes(None, prior_distr)
+        priors.add(ts.num_samples)
+        params = priors.get_mixture_prior_params(span_data)
+        assert params.shape == (ts.num_nodes + 1, 2)
+        assert np.all(np.isnan(params[ts.samples()]))
+        assert np.all(np.isnan(params[tskit.NULL]))
+        num_mixed = 0
+        for u in span_data.nodes_to_date:
+            mixture = span_data.get_spans(u)
+            (total_tips, span_arr), *others = mixture.items()
+            if len(others) == 0 and span_arr.shape[0] == 1:
+                expected = priors[total_tips][span_arr["descendant_tips"][0], [0, 1]]
+            else:
+                num_mixed += 1
+                expected = priors.func_approx(*priors.mixture_expect_and_var(mixture))
+            assert np.allclose(params[u], expected)
+        assert num_mixed > 0
+
 
 class TestTimepoints:
     def test_create_timepoints(self):
@@ -142,6 +248,31 @@ class TestTimepoints:
         with pytest.raises(ValueError, match="must be lognorm or gamma"):
             create_timepoints(priors, n_points=3)
 
+    def test_refine_timepoints(self):
+        timepoints = np.array([0, 1, 2, 4, 8])
+        mass = np.array([0, 0, 1, 1, 0])
+        tp = refine_timepoints(timepoints, mass, 13)
+        assert len(tp) == 13
+        assert np.all(np.isin(timepoints, tp))
+        assert np.all(np.diff(tp) > 0)
+        # No points are added between timepoints with no mass
+        assert np.sum((tp > 0) & (tp < 1)) == 0
+        # Points are spread in proportion to the mass in each interval
+        assert np.sum((tp > 1) & (tp < 2)) == 2
+        assert np.sum((tp > 2) & (tp < 4)) == 4
+        assert np.sum((tp > 4) & (tp < 8)) == 2
+        assert np.allclose(tp[(tp > 2) & (tp < 4)], [2.4, 2.8, 3.2, 3.6])
+
+    def test_refine_timepoints_no_mass(self):
+        tp = refine_timepoints(np.array([0, 1, 2]), np.zeros(3), 5)
+        assert np.allclose(tp, [0, 0.5, 1, 1.5, 2])
+
+    def test_refine_timepoints_error(self):
+        with pytest.raises(ValueError, match="outnumber"):
+            refine_timepoints(np.array([0, 1, 2]), np.ones(3), 3)
+        with pytest.raises(ValueError, match="mass at each"):
+            refine_timepoints(np.array([0, 1, 2]), np.ones(2), 5)
+
 
 class TestUtilityFunctions:
     def test_m_prob(self):
@@ -34,7 +34,7 @@ import tsinfer
 import tskit
 
 import tsdate
-from tsdate.rescaling import count_mutations, mutational_area
+from tsdate.rescaling import count_mutations, edge_statistics, mutational_area
 
 
 @pytest.fixture(scope="session")
@@ -200,6 +200,28 @@ class TestCountMutations:
         np.testing.assert_array_almost_equal(ck_edge_stats, edge_stats)
         np.testing.assert_array_equal(ck_muts_edge, muts_edge)
 
+    @pytest.mark.parametrize("size_biased", [True, False])
+    def test_edge_statistics(self, inferred_ts, size_biased):
+        ts = inferred_ts
+        individuals_unphased = np.full(ts.num_individuals, False)
+        individuals_unphased[: ts.num_individuals // 2] = True
+        edge_stats, sb_stats, muts_edge, *blocks = edge_statistics(
+            ts, individuals_unphased, size_biased=size_biased
+        )
+        ck_edge_stats, ck_muts_edge = self.naive_count_mutations(ts)
+        np.testing.assert_array_almost_equal(ck_edge_stats, edge_stats)
+        np.testing.assert_array_equal(ck_muts_edge, muts_edge)
+        if size_biased:
+            ck_sb_stats, _ = self.naive_count_sizebiased(ts)
+            np.testing.assert_array_almost_equal(ck_sb_stats, sb_stats)
+        else:
+            assert np.all(sb_stats == 0.0)
+        # blocking singletons does not affect per-edge statistics
+        phased_stats, phased_sb_stats, *_ = edge_statistics(ts, size_biased=size_biased)
+        np.testing.assert_array_equal(phased_stats, edge_stats)
+        np.testing.assert_array_equal(phased_sb_stats, sb_stats)
+        assert blocks[1].shape[0] > 0
+
     @pytest.mark.skip("Ancient samples not implemented")
     def test_count_sizebiased_with_ancient(self, inferred_ts):
         # TODO: if there are ancestral samples, these should not be used as weights.
@@ -19,22 +19,64 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-from .cache import *  # noqa: F403
-from .core import (
-    date,  # NOQA: F401
-    estimation_methods,  # NOQA: F401
-    inside_outside,  # NOQA: F401
-    maximization,  # NOQA: F401
-    variational_gamma,  # NOQA: F401
-)
-from .prior import parameter_grid as build_parameter_grid  # NOQA: F401
-from .prior import prior_grid as build_prior_grid  # NOQA: F401
+import importlib
+
 from .provenance import __version__  # NOQA: F401
-from .util import (
-    add_sampledata_times,  # NOQA: F401
-    preprocess_ts,  # NOQA: F401
-    sites_time_from_ts,  # NOQA: F401
-)
+
+# The public functions are imported from their submodules on first use, so that
+# importing tsdate does not load numba, scipy or the compiled kernels until needed
+_lazy_functions = {
+    "add_sampledata_times": ("util", "add_sampledata_times"),
+    "build_parameter_grid": ("prior", "parameter_grid"),
+    "build_prior_grid": ("prior", "prior_grid"),
+    "date": ("core", "date"),
+    "date_many": ("core", "date_many"),
+    "estimation_methods": ("core", "estimation_methods"),
+    "get_cache_dir": ("cache", "get_cache_dir"),
+    "inside_outside": ("core", "inside_outside"),
+    "maximization": ("core", "maximization"),
+    "preprocess_ts": ("util", "preprocess_ts"),
+    "sites_time_from_ts": ("util", "sites_time_from_ts"),
+    "variational_gamma": ("core", "variational_gamma"),
+    "warmup": ("accelerate", "warmup"),
+}
+
+_submodules = {
+    "accelerate",
+    "approx",
+    "cache",
+    "cli",
+    "core",
+    "demography",
+    "discrete",
+    "evaluation",
+    "hypergeo",
+    "instrumentation",
+    "node_time_class",
+    "phasing",
+    "prior",
+    "rescaling",
+    "schemas",
+    "util",
+    "variational",
+}
+
+
+def __getattr__(name):
+    if name in _lazy_functions:
+        module, attr = _lazy_functions[name]
+        value = getattr(importlib.import_module(f".{module}", __name__), attr)
+    elif name in _submodules:
+        value = importlib.import_module(f".{name}", __name__)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_functions) | _submodules)
+
 
 # Bit 20 is set in node flags when they are samples not at time zero in the sampledata
 # file. This should match the node flag in tsinfer.
@@ -1,11 +1,24 @@
+import contextlib
+import logging
 import os
+import time
 from typing import Callable
 
+import numba
+import numpy as np
+import tskit
 from numba import jit
+from numba.core import caching
 
-# By default we disable the numba cache. See e.g.
+from .cache import get_cache_dir
+from .provenance import __version__
+
+logger = logging.getLogger(__name__)
+
+# By default compiled code is cached on disk (see `numba_cache_dir`), unless
+# disabled by setting TSDATE_ENABLE_NUMBA_CACHE=0. See e.g.
 # https://github.com/sgkit-dev/sgkit/blob/main/sgkit/accelerate.py
-_ENABLE_CACHE = os.environ.get("TSDATE_ENABLE_NUMBA_CACHE", "0")
+_ENABLE_CACHE = os.environ.get("TSDATE_ENABLE_NUMBA_CACHE", "1")
 
 try:
     CACHE_NUMBA = {"0": False, "1": True}[_ENABLE_CACHE]
@@ -15,6 +28,67 @@ except KeyError as e:  # pragma: no cover
     ) from e
 
 
+def numba_cache_dir():
+    """
+    The directory in which tsdate caches compiled code: a subdirectory of
+    :func:`get_cache_dir` that is specific to the versions of tsdate and numba,
+    so that upgrading either invalidates the cache. If the ``NUMBA_CACHE_DIR``
+    environment variable is set, numba uses that directory instead.
+    """
+    if os.environ.get("NUMBA_CACHE_DIR"):
+        return numba.config.CACHE_DIR
+    version = f"tsdate-{__version__}-numba-{numba.__version__}"
+    return get_cache_dir() / "numba" / version
+
+
+class _TsdateCacheLocator(caching._UserProvidedCacheLocator):
+    # Locates the cached compiled code of kernels defined in the tsdate package
+    # in `numba_cache_dir`, without changing numba's global configuration (and
+    # hence where other libraries cache their compiled code)
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    cache_dir = None
+
+    def __init__(self, py_func, py_file):
+        self._py_file = py_file
+        self._lineno = py_func.__code__.co_firstlineno
+        self._cache_path = os.path.join(
+            self.cache_dir, self.get_suitable_cache_subpath(py_file)
+        )
+
+    @classmethod
+    def from_function(cls, py_func, py_file):
+        if cls.cache_dir is None or not os.path.exists(py_file):
+            return None
+        if not os.path.abspath(py_file).startswith(cls.package_dir + os.sep):
+            return None
+        locator = cls(py_func, py_file)
+        locator.ensure_cache_path()
+        return locator
+
+
+def _setup_cache():
+    # Register the cache directory for tsdate kernels before any are compiled,
+    # returning False if the directory is not writable. Numba writes cache
+    # files atomically, so the cache can be shared between processes.
+    if os.environ.get("NUMBA_CACHE_DIR"):
+        return True
+    try:
+        cache_dir = numba_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:  # pragma: no cover
+        return False
+    if not os.access(cache_dir, os.W_OK):  # pragma: no cover
+        return False
+    _TsdateCacheLocator.cache_dir = str(cache_dir)
+    if _TsdateCacheLocator not in caching._CacheImpl._locator_classes:
+        caching._CacheImpl._locator_classes.insert(0, _TsdateCacheLocator)
+    return True
+
+
+if CACHE_NUMBA:
+    CACHE_NUMBA = _setup_cache()
+
+
 DEFAULT_NUMBA_ARGS = {
     "nopython": True,
     "cache": CACHE_NUMBA,
@@ -25,3 +99,87 @@ def numba_jit(*args, **kwargs) -> Callable:  # pragma: no cover
     kwargs_ = DEFAULT_NUMBA_ARGS.copy()
     kwargs_.update(kwargs)
     return jit(*args, **kwargs_)
+
+
+@contextlib.contextmanager
+def numba_threads(num_threads):
+    """
+    Temporarily set the number of threads used by numba's parallel kernels,
+    capped at the number of threads numba was launched with. If ``num_threads``
+    is ``None`` the current setting is left unchanged.
+    """
+    if num_threads is None:
+        yield numba.get_num_threads()
+        return
+    if num_threads < 1:
+        raise ValueError("Number of threads must be a positive integer")
+    previous = numba.get_num_threads()
+    numba.set_num_threads(min(num_threads, numba.config.NUMBA_NUM_THREADS))
+    try:
+        yield numba.get_num_threads()
+    finally:
+        numba.set_num_threads(previous)
+
+
+def _warmup_tree_sequence():
+    # A small tree sequence of diploid individuals with a mutation on every edge
+    tables = tskit.Tree.generate_balanced(8, span=100).tree_sequence.dump_tables()
+    for _ in range(4):
+        tables.individuals.add_row()
+    individual = tables.nodes.individual
+    individual[:8] = np.repeat(np.arange(4), 2)
+    tables.nodes.individual = individual
+    for position, child in enumerate(tables.edges.child):
+        site = tables.sites.add_row(position=position, ancestral_state="0")
+        tables.mutations.add_row(site=site, node=child, derived_state="1")
+    tables.sort()
+    return tables.tree_sequence()
+
+
+def warmup():
+    """
+    Compile the numba kernels used by tsdate and save them to the on-disk
+    cache (see :func:`numba_cache_dir`), so that later runs of tsdate, in this
+    or other processes, load them from the cache rather than compiling them
+    afresh. Kernels with explicit signatures are compiled when tsdate is
+    imported; the remainder are compiled by dating a small tree sequence with
+    each method. Because the multithreaded kernels are compiled, numba's
+    thread pool is started in the calling process.
+
+    :return: The cache directory, or ``None`` if caching has been disabled
+        by setting the environment variable ``TSDATE_ENABLE_NUMBA_CACHE=0``.
+    :rtype: pathlib.Path
+    """
+    from . import core
+
+    if not CACHE_NUMBA:
+        logger.warning("Compiled code is not cached: TSDATE_ENABLE_NUMBA_CACHE=0")
+        return None
+    start_time = time.time()
+    ts = _warmup_tree_sequence()
+    params = dict(mutation_rate=1e-2, record_provenance=False)
+    for single_precision in (False, True):
+        for singletons_phased in (True, False):
+            core.variational_gamma(
+                ts,
+                max_iterations=2,
+                rescaling_intervals=10,
+                single_precision=single_precision,
+                singletons_phased=singletons_phased,
+                num_threads=1,
+                **params,
+            )
+    for single_precision in (False, True):
+        for probability_space in ("linear", "logarithmic"):
+            for method in (core.inside_outside, core.maximization):
+                method(
+                    ts,
+                    population_size=1,
+                    probability_space=probability_space,
+                    single_precision=single_precision,
+                    **params,
+                )
+    cache_dir = numba_cache_dir()
+    warmup_timing = time.time() - start_time
+    logger.info(f"Cached compiled code in {cache_dir} in {warmup_timing:.2f} seconds")
+    return cache_dir
@@ -39,9 +39,10 @@ _KLMIN_RELTOL = np.sqrt(np.finfo(np.float64).eps)
 
 
 # shorthand for numba readonly array types, [type][dimension][constness]
-# type is one of "i" (int32), "f" (float64), "b" (boolean)
+# type is one of "i" (int32), "f" (float64), "s" (float32), "b" (boolean)
 # constness is one of "r" (read-only) or "w" (writable)
 _f = numba.types.float64
+_s = numba.types.float32
 _i = numba.types.int32
 _b = numba.types.bool_
 _f1w = numba.types.Array(_f, 1, "C", readonly=False)
@@ -50,6 +51,12 @@ _f2w = numba.types.Array(_f, 2, "C", readonly=False)
 _f2r = numba.types.Array(_f, 2, "C", readonly=True)
 _f3w = numba.types.Array(_f, 3, "C", readonly=False)
 _f3r = numba.types.Array(_f, 3, "C", readonly=True)
+_s1w = numba.types.Array(_s, 1, "C", readonly=False)
+_s1r = numba.types.Array(_s, 1, "C", readonly=True)
+_s2w = numba.types.Array(_s, 2, "C", readonly=False)
+_s2r = numba.types.Array(_s, 2, "C", readonly=True)
+_s3w = numba.types.Array(_s, 3, "C", readonly=False)
+_s3r = numba.types.Array(_s, 3, "C", readonly=True)
 _i1w = numba.types.Array(_i, 1, "C", readonly=False)
 _i1r = numba.types.Array(_i, 1, "C", readonly=True)
 _i2w = numba.types.Array(_i, 2, "C", readonly=False)
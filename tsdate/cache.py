@@ -23,6 +23,7 @@
 Handle cache for precalculated prior
 """
 
+import contextlib
 import logging
 import os
 import pathlib
@@ -44,3 +45,30 @@ def get_cache_dir():
     except OSError:
         logger.info(f"{cache_dir} already exists")
     return cache_dir
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on a ``.lock`` file next to ``path`` while in this
+    context, so that concurrent processes do not all create the same cache file.
+    If locking is not possible (e.g. on Windows, or in a read-only directory),
+    the context is entered without a lock.
+    """
+    try:
+        import fcntl
+    except ImportError:  # pragma: no cover
+        yield
+        return
+    try:
+        lock_file = open(f"{os.fspath(path)}.lock", "a")
+    except OSError as err:
+        logger.info(f"Could not lock {path}: {err}")
+        yield
+        return
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -26,6 +26,8 @@ Command line interface for tsdate.
 
 import argparse
 import logging
+import os
+import pathlib
 import sys
 
 import tskit
@@ -55,48 +57,8 @@ def setup_logging(args):
     return log_level
 
 
-def tsdate_cli_parser():
-    top_parser = argparse.ArgumentParser(
-        description=(
-            "This is the command line interface for tsdate, a tool to date "
-            "tree sequences."
-        ),
-    )
-    top_parser.add_argument(
-        "-V", "--version", action="version", version=f"%(prog)s {tsdate.__version__}"
-    )
-
-    subparsers = top_parser.add_subparsers(dest="subcommand")
-    subparsers.required = True
-
-    parser = subparsers.add_parser(
-        "date",
-        help=(
-            "Takes an inferred tree sequence topology and "
-            "returns a dated tree sequence."
-        ),
-    )
-
-    parser.add_argument(
-        "tree_sequence",
-        help=(
-            "The path and name of the input tree sequence for which "
-            "node ages are estimated."
-        ),
-    )
-    parser.add_argument(
-        "output",
-        help=(
-            "The path and name of output file where the dated tree "
-            "sequence will saved."
-        ),
-    )
-    parser.add_argument(
-        "deprecated_population_size",
-        type=float,
-        nargs="?",
-        help="Deprecated positional argument, left for backwards compatibility.",
-    )
+def add_dating_arguments(parser):
+    # Options shared by the "date" and "date-many" subcommands
     parser.add_argument(
         "-m",
         "--mutation-rate",
@@ -171,6 +133,94 @@ def tsdate_cli_parser():
         ),
         default=None,
     )
+    parser.add_argument(
+        "--convergence-tolerance",
+        type=float,
+        help=(
+            "Halt the expectation propagation algorithm early once the maximum "
+            "relative change in posterior mean node ages between iterations is "
+            "below this value. Default: None (always run max-iterations)"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--residual-tolerance",
+        type=float,
+        help=(
+            "After the first iteration of expectation propagation, only update "
+            "edges whose factors are still changing by more than this relative "
+            "amount, in order of decreasing change. Default: None (update every "
+            "edge in every iteration)"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--max-edge-updates",
+        type=int,
+        help=(
+            "The maximum number of edge updates per iteration when a residual "
+            "tolerance is given. Default: None treated as twice the number of edges"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--checkpoint-file",
+        type=str,
+        help=(
+            "Periodically save the state of the expectation propagation algorithm "
+            "to this file, so that an interrupted run can be resumed. Default: None"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=int,
+        help=(
+            "The number of expectation propagation iterations between checkpoints. "
+            "Default: None treated as 1"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume from the state saved in the checkpoint file, if it exists",
+    )
+    parser.add_argument(
+        "--warm-start",
+        action="store_true",
+        help=(
+            "Initialise the expectation propagation algorithm from the posterior "
+            "node times stored in the metadata of a previously dated tree sequence"
+        ),
+    )
+    parser.add_argument(
+        "--single-precision",
+        action="store_true",
+        help=(
+            "Store expectation propagation factors and posteriors, or for the "
+            "discrete-time methods the node time grids, as 32-bit floats to reduce "
+            "memory usage"
+        ),
+    )
+    parser.add_argument(
+        "--window-size",
+        type=float,
+        help=(
+            "Date the tree sequence in independent genomic windows of this length, "
+            "to bound memory usage. Default: None (date the whole tree sequence)"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--window-overlap",
+        type=float,
+        help=(
+            "The length of flanking sequence added to either side of each genomic "
+            "window. Default: None treated as a tenth of the window size"
+        ),
+        default=None,
+    )
     # TODO array specification from file?
     parser.add_argument(
         "-n",
@@ -189,7 +239,16 @@ def tsdate_cli_parser():
         default=None,
         help=(
             "The number of threads to use. A simpler unthreaded algorithm is used "
-            "unless this is >= 1. Not relevant for the 'variational_gamma' method. "
+            "unless this is >= 1. Default: None"
+        ),
+    )
+    parser.add_argument(
+        "--instrumentation-file",
+        type=str,
+        default=None,
+        help=(
+            "Save the wall time and peak memory usage of each stage of dating, "
+            "together with counts and convergence metrics, to this JSON file. "
             "Default: None"
         ),
     )
@@ -204,8 +263,135 @@ def tsdate_cli_parser():
             "'variational_gamma' method. Default: None treated as 'logarithmic'"
         ),
     )
+    parser.add_argument(
+        "--cache-likelihoods",
+        action="store_true",
+        help=(
+            "Read and save mutation likelihoods in a cache on disk, to reuse when "
+            "dating again with the same timepoints, mutation rate and epsilon. Not "
+            "relevant for the 'variational_gamma' method"
+        ),
+    )
+    parser.add_argument(
+        "--likelihood-threshold",
+        type=float,
+        default=None,
+        help=(
+            "Treat the mutation likelihoods of each edge that are less than this "
+            "fraction of the largest for the same parent time as zero, to speed up "
+            "dating with many timepoints. Not relevant for the 'variational_gamma' "
+            "method. Default: None (use all likelihoods)"
+        ),
+    )
+    parser.add_argument(
+        "--refine-timepoints",
+        type=int,
+        default=None,
+        help=(
+            "Date once, then add time points where the posterior mass is greatest "
+            "to make a grid with this many time points, and date again. Only "
+            "relevant for the 'inside_outside' method. Default: None (no refinement)"
+        ),
+    )
+    parser.add_argument(
+        "--memmap-dir",
+        type=str,
+        default=None,
+        help=(
+            "Store the node time grids in temporary memory-mapped files in this "
+            "directory rather than in RAM. Not relevant for the 'variational_gamma' "
+            "method. Default: None (store in RAM)"
+        ),
+    )
+
+
+def tsdate_cli_parser():
+    top_parser = argparse.ArgumentParser(
+        description=(
+            "This is the command line interface for tsdate, a tool to date "
+            "tree sequences."
+        ),
+    )
+    top_parser.add_argument(
+        "-V", "--version", action="version", version=f"%(prog)s {tsdate.__version__}"
+    )
+
+    subparsers = top_parser.add_subparsers(dest="subcommand")
+    subparsers.required = True
+
+    parser = subparsers.add_parser(
+        "date",
+        help=(
+            "Takes an inferred tree sequence topology and "
+            "returns a dated tree sequence."
+        ),
+    )
+
+    parser.add_argument(
+        "tree_sequence",
+        help=(
+            "The path and name of the input tree sequence for which "
+            "node ages are estimated."
+        ),
+    )
+    parser.add_argument(
+        "output",
+        help=(
+            "The path and name of output file where the dated tree "
+            "sequence will saved."
+        ),
+    )
+    parser.add_argument(
+        "deprecated_population_size",
+        type=float,
+        nargs="?",
+        help="Deprecated positional argument, left for backwards compatibility.",
+    )
+    add_dating_arguments(parser)
+    parser.add_argument(
+        "--num-processes",
+        type=int,
+        help=(
+            "The number of processes used to date genomic windows in parallel. "
+            "Default: None (date windows sequentially)"
+        ),
+        default=None,
+    )
     parser.set_defaults(runner=run_date)
 
+    parser = subparsers.add_parser(
+        "date-many",
+        help=(
+            "Date many tree sequences, e.g. one per chromosome, saving each to "
+            "the output directory under the same file name."
+        ),
+    )
+    parser.add_argument(
+        "tree_sequences",
+        nargs="+",
+        help="The paths of the input tree sequences to date.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        required=True,
+        help=(
+            "The directory in which to save the dated tree sequences, which must "
+            "not contain any of the inputs."
+        ),
+    )
+    add_dating_arguments(parser)
+    parser.add_argument(
+        "--num-processes",
+        type=int,
+        help=(
+            "The number of worker processes used to date tree sequences in "
+            "parallel, largest first. Default: None (date sequentially)"
+        ),
+        default=None,
+    )
+    parser.set_defaults(runner=run_date_many)
+
     parser = subparsers.add_parser(
         "preprocess", help=("Remove regions without data from an input tree sequence.")
     )
@@ -254,33 +440,51 @@ def tsdate_cli_parser():
         help="How much verbosity to output (max is -vv).",
     )
     parser.set_defaults(runner=run_preprocess)
+
+    parser = subparsers.add_parser(
+        "warmup",
+        help=(
+            "Compile the numba kernels used by tsdate and store them in the "
+            "on-disk cache, so that subsequent runs start quickly."
+        ),
+    )
+    parser.add_argument(
+        "-v",
+        "--verbosity",
+        action="count",
+        default=0,
+        help="How much verbosity to output (max is -vv).",
+    )
+    parser.set_defaults(runner=run_warmup)
     return top_parser
 
 
-def run_date(args):
-    if args.deprecated_population_size is not None:
-        error_exit(
-            "Specifying the population size without prefixing by `-n` is "
-            f"deprecated. Please use `-n {args.deprecated_population_size}` instead."
-        )
-    try:
-        ts = tskit.load(args.tree_sequence)
-    except tskit.FileFormatError as ffe:
-        error_exit(f"FileFormatError loading '{args.tree_sequence}: {ffe}")
+def dating_params(args):
+    # Check the options for the dating method and return them as parameters
     if args.method == "variational_gamma":
         # TODO - warn about other non-relevant options
         if args.population_size is not None:
             error_exit(
                 "The population_size is not currently required for 'variational_gamma'"
             )
-        if args.num_threads is not None:
-            error_exit(
-                "Multiple threads cannot be used in the 'variational_gamma' method"
-            )
         if args.probability_space is not None:
             error_exit(
                 "The probability_spaces parameter is irrelevant for 'variational_gamma'"
             )
+        if args.cache_likelihoods:
+            error_exit(
+                "The cache_likelihoods parameter is irrelevant for 'variational_gamma'"
+            )
+        if args.likelihood_threshold is not None:
+            error_exit(
+                "The likelihood_threshold parameter is irrelevant for 'variational_gamma'"
+            )
+        if args.refine_timepoints is not None:
+            error_exit(
+                "The refine_timepoints parameter is irrelevant for 'variational_gamma'"
+            )
+        if args.memmap_dir is not None:
+            error_exit("The memmap_dir parameter is irrelevant for 'variational_gamma'")
         params = dict(
             recombination_rate=args.recombination_rate,
             method=args.method,
@@ -288,6 +492,18 @@ def run_date(args):
             progress=args.progress,
             max_iterations=args.max_iterations,
             rescaling_intervals=args.rescaling_intervals,
+            convergence_tolerance=args.convergence_tolerance,
+            checkpoint_file=args.checkpoint_file,
+            checkpoint_interval=args.checkpoint_interval,
+            resume=args.resume,
+            initial_posteriors="metadata" if args.warm_start else None,
+            single_precision=args.single_precision,
+            window_size=args.window_size,
+            window_overlap=args.window_overlap,
+            num_processes=args.num_processes,
+            num_threads=args.num_threads,
+            residual_tolerance=args.residual_tolerance,
+            max_edge_updates=args.max_edge_updates,
         )
     else:
         if args.rescaling_intervals is not None:
@@ -296,6 +512,23 @@ def run_date(args):
             )
         if args.max_iterations is not None:
             error_exit("max_iterations is not currently used in discrete-time methods")
+        if args.convergence_tolerance is not None:
+            error_exit(
+                "convergence_tolerance is not currently used in discrete-time methods"
+            )
+        if args.checkpoint_file is not None or args.resume:
+            error_exit("Checkpointing is not currently used in discrete-time methods")
+        if args.warm_start:
+            error_exit("warm_start is not currently used in discrete-time methods")
+        if args.window_size is not None:
+            error_exit("Genomic windows are not currently used in discrete-time methods")
+        if args.residual_tolerance is not None or args.max_edge_updates is not None:
+            error_exit(
+                "Prioritised edge updates are not currently used in discrete-time "
+                "methods"
+            )
+        if args.refine_timepoints is not None and args.method != "inside_outside":
+            error_exit("refine_timepoints is only used in the 'inside_outside' method")
         params = dict(
             population_size=args.population_size,
             recombination_rate=args.recombination_rate,
@@ -304,11 +537,74 @@ def run_date(args):
             progress=args.progress,
             probability_space=args.probability_space,
             num_threads=args.num_threads,
+            cache_likelihoods=args.cache_likelihoods,
+            likelihood_threshold=args.likelihood_threshold,
+            single_precision=args.single_precision,
+            memmap_dir=args.memmap_dir,
+        )
+        if args.refine_timepoints is not None:
+            params["refine_timepoints"] = args.refine_timepoints
+    if args.instrumentation_file is not None:
+
+        def save_instrumentation(instrumentation):
+            with open(args.instrumentation_file, "w") as file:
+                file.write(instrumentation.to_json(indent=2))
+
+        params["instrumentation_callback"] = save_instrumentation
+    return params
+
+
+def run_date(args):
+    if args.deprecated_population_size is not None:
+        error_exit(
+            "Specifying the population size without prefixing by `-n` is "
+            f"deprecated. Please use `-n {args.deprecated_population_size}` instead."
         )
+    try:
+        ts = tskit.load(args.tree_sequence)
+    except tskit.FileFormatError as ffe:
+        error_exit(f"FileFormatError loading '{args.tree_sequence}: {ffe}")
+    params = dating_params(args)
     dated_ts = tsdate.date(ts, mutation_rate=args.mutation_rate, **params)
     dated_ts.dump(args.output)
 
 
+def run_date_many(args):
+    if args.instrumentation_file is not None:
+        error_exit("An instrumentation file cannot be used when dating many files")
+    if args.checkpoint_file is not None or args.resume:
+        error_exit("A checkpoint file cannot be used when dating many files")
+    output_dir = pathlib.Path(args.output_dir)
+    output_files = []
+    for path in args.tree_sequences:
+        path = pathlib.Path(path)
+        if not path.is_file():
+            error_exit(f"Input file '{path}' does not exist")
+        output = output_dir / path.name
+        if output.resolve() == path.resolve():
+            error_exit(f"Dating '{path}' would overwrite it in '{output_dir}'")
+        if output in output_files:
+            error_exit(f"More than one input would be saved as '{output}'")
+        output_files.append(output)
+    params = dating_params(args)
+    params.pop("num_processes", None)
+    progress = params.pop("progress")
+    os.makedirs(output_dir, exist_ok=True)
+    try:
+        results = tsdate.date_many(
+            args.tree_sequences,
+            mutation_rate=args.mutation_rate,
+            output_files=output_files,
+            num_processes=args.num_processes,
+            progress=progress,
+            **params,
+        )
+    except tskit.FileFormatError as ffe:
+        error_exit(f"FileFormatError loading tree sequences: {ffe}")
+    for result in results:
+        print(result.source, result.output, f"{result.time:.2f}", sep="\t")
+
+
 def run_preprocess(args):
     try:
         ts = tskit.load(args.tree_sequence)
@@ -320,6 +616,13 @@ def run_preprocess(args):
     snipped_ts.dump(args.output)
 
 
+def run_warmup(args):
+    cache_dir = tsdate.warmup()
+    if cache_dir is None:
+        error_exit("Compiled code cannot be cached as TSDATE_ENABLE_NUMBA_CACHE=0")
+    print(cache_dir)
+
+
 def tsdate_main(arg_list=None):
     parser = tsdate_cli_parser()
     args = parser.parse_args(arg_list)
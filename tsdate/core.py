@@ -24,14 +24,28 @@
 Infer the age of nodes from mutational data, conditional on a tree sequence topology.
 """
 
+import functools
 import logging
+import multiprocessing
+import os
 import time  # DEBUG
 from collections import namedtuple
 
 import numpy as np
 import tskit
-
-from . import demography, discrete, prior, provenance, schemas, util, variational
+from tqdm.auto import tqdm
+
+from . import (
+    demography,
+    discrete,
+    instrumentation,
+    prior,
+    provenance,
+    rescaling,
+    schemas,
+    util,
+    variational,
+)
 from .node_time_class import LIN_GRID, LOG_GRID
 
 logger = logging.getLogger(__name__)
@@ -58,6 +72,8 @@ Results = namedtuple(
     ],
 )
 
+BatchResult = namedtuple("BatchResult", ["source", "output", "tree_sequence", "time"])
+
 
 class EstimationMethod:
     """
@@ -89,6 +105,7 @@ class EstimationMethod:
         constr_iterations=None,
         set_metadata=None,
         progress=None,
+        instrumentation_callback=None,
         # Deprecated params
         return_posteriors=None,
     ):
@@ -102,6 +119,8 @@ class EstimationMethod:
                 "of the matrix previously returned when ``return_posteriors=True.``"
             )
         self.start_time = time.time()
+        self.instrumentation = instrumentation.Instrumentation(self.name)
+        self.instrumentation_callback = instrumentation_callback
         self.ts = ts
         self.mutation_rate = mutation_rate
         self.recombination_rate = recombination_rate
@@ -145,6 +164,10 @@ class EstimationMethod:
             self.constr_iterations = constr_iterations
 
         self.allow_unary = False if allow_unary is None else allow_unary
+        self.population_size = Ne
+        # Default to not creating approximate priors unless ts has
+        # greater than DEFAULT_APPROX_PRIOR_SIZE samples
+        self.approximate_priors = ts.num_samples > prior.DEFAULT_APPROX_PRIOR_SIZE
 
         if self.prior_grid_func_name is None:
             if priors is not None:
@@ -159,16 +182,14 @@ class EstimationMethod:
                         f"built using tsdate.build_{self.prior_grid_func_name}()"
                     )
                 mk_prior = getattr(prior, self.prior_grid_func_name)
-                # Default to not creating approximate priors unless ts has
-                # greater than DEFAULT_APPROX_PRIOR_SIZE samples
-                approx = ts.num_samples > prior.DEFAULT_APPROX_PRIOR_SIZE
-                self.priors = mk_prior(
-                    ts,
-                    Ne,
-                    approximate_priors=approx,
-                    allow_unary=self.allow_unary,
-                    progress=progress,
-                )
+                with self.instrumentation.stage("priors"):
+                    self.priors = mk_prior(
+                        ts,
+                        Ne,
+                        approximate_priors=self.approximate_priors,
+                        allow_unary=self.allow_unary,
+                        progress=progress,
+                    )
             else:
                 logger.info("Using user-specified priors")
                 if Ne is not None:
@@ -178,10 +199,6 @@ class EstimationMethod:
                     )
                 self.priors = priors
 
-        # mutation to edge mapping
-        # TODO: this isn't needed except for mutations_edge in constrain_mutations
-        self.edges_mutations, self.mutations_edge = util.mutation_span_array(ts)
-
     def get_modified_ts(self, result, eps):
         # Return a new ts based on the existing one, but with the various
         # time-related information correctly set.
@@ -197,30 +214,30 @@ class EstimationMethod:
         mutations = tables.mutations
 
         # Constrain node ages for positive branch lengths
-        constr_timing = time.time()
-        nodes.time = util.constrain_ages(ts, node_mean_t, eps, self.constr_iterations)
-        mutations.time = util.constrain_mutations(ts, nodes.time, mut_edge)
-        mutations.node = mut_node
-        mutations.parent = np.full(mutations.num_rows, tskit.NULL, dtype=np.int32)
-        tables.time_units = self.time_units
-        constr_timing -= time.time()
-        logger.info(f"Constrained node ages in {abs(constr_timing):.2f} seconds")
+        with self.instrumentation.stage("constrain_ages"):
+            nodes.time = util.constrain_ages(ts, node_mean_t, eps, self.constr_iterations)
+            mutations.time = util.constrain_mutations(ts, nodes.time, mut_edge)
+            mutations.node = mut_node
+            mutations.parent = np.full(mutations.num_rows, tskit.NULL, dtype=np.int32)
+            tables.time_units = self.time_units
+        constr_timing = self.instrumentation.time("constrain_ages")
+        logger.info(f"Constrained node ages in {constr_timing:.2f} seconds")
         # Add posterior mean and variance to node/mutation metadata
-        meta_timing = time.time()
-        self.set_time_metadata(
-            nodes, node_mean_t, node_var_t, schemas.default_node_schema
-        )
-        self.set_time_metadata(
-            mutations, mut_mean_t, mut_var_t, schemas.default_mutation_schema
-        )
-        meta_timing -= time.time()
-        logger.info(f"Inserted node and mutation metadata in {abs(meta_timing)} seconds")
-        sort_timing = time.time()
-        tables.sort()
-        tables.build_index()
-        tables.compute_mutation_parents()
-        sort_timing -= time.time()
-        logger.info(f"Sorted tree sequence in {abs(sort_timing):.2f} seconds")
+        with self.instrumentation.stage("metadata"):
+            self.set_time_metadata(
+                nodes, node_mean_t, node_var_t, schemas.default_node_schema
+            )
+            self.set_time_metadata(
+                mutations, mut_mean_t, mut_var_t, schemas.default_mutation_schema
+            )
+        meta_timing = self.instrumentation.time("metadata")
+        logger.info(f"Inserted node and mutation metadata in {meta_timing} seconds")
+        with self.instrumentation.stage("sort"):
+            tables.sort()
+            tables.build_index()
+            tables.compute_mutation_parents()
+        sort_timing = self.instrumentation.time("sort")
+        logger.info(f"Sorted tree sequence in {sort_timing:.2f} seconds")
         if self.provenance_params is not None:
             # Note that the time recorded in provenance excludes numba compilation time
             provenance.record_provenance(
@@ -271,6 +288,9 @@ class EstimationMethod:
         # Construct the tree sequence to return and add other stuff we might want to
         # return. pst_cols is a dict to be appended to the output posterior dict
         ret = [self.get_modified_ts(result, epsilon)]
+        self.instrumentation.finish()
+        if self.instrumentation_callback is not None:
+            self.instrumentation_callback(self.instrumentation)
         if self.return_fit:
             ret.append(result.fit_object)
         if self.return_likelihood:
@@ -304,16 +324,41 @@ class DiscreteTimeMethod(EstimationMethod):
         mn_post[is_fixed] = ts.nodes_time[is_fixed]
         va_post[is_fixed] = 0
 
-        for u in posterior.nonfixed_nodes:
-            probs = posterior[u]
-            times = posterior.timepoints
-            mn_post[u] = np.sum(probs * times) / np.sum(probs)
-            va_post[u] = np.sum(((mn_post[u] - (times)) ** 2) * (probs / np.sum(probs)))
+        # Rows of the grid are in the order of the nonfixed nodes: take them in chunks
+        # to bound the memory used when the grid is single precision or memory-mapped
+        times = posterior.timepoints
+        chunk_size = discrete.BeliefPropagation.rows_per_chunk
+        for start in range(0, posterior.num_nonfixed, chunk_size):
+            nodes = posterior.nonfixed_nodes[start : start + chunk_size]
+            probs = posterior.grid_data[start : start + chunk_size].astype(np.float64)
+            probs /= np.sum(probs, axis=1)[:, np.newaxis]
+            mn_post[nodes] = np.sum(probs * times, axis=1)
+            va_post[nodes] = np.sum(
+                ((mn_post[nodes, np.newaxis] - times) ** 2) * probs, axis=1
+            )
 
         return mn_post, va_post
 
-    def main_algorithm(self, probability_space, epsilon, num_threads):
+    def main_algorithm(
+        self,
+        probability_space,
+        epsilon,
+        num_threads,
+        cache_likelihoods=False,
+        likelihood_threshold=None,
+        single_precision=False,
+        memmap_dir=None,
+    ):
         # Algorithm class is shared by inside-outside & outside-maximization methods
+        if single_precision or memmap_dir is not None:
+            # The inside, outside and posterior grids are cloned from the priors,
+            # so are stored in the same way
+            self.priors = self.priors.clone_with_new_data(
+                grid_data=self.priors.grid_data,
+                fixed_data=self.priors.fixed_data.copy(),
+                dtype=np.float32 if single_precision else None,
+                memmap_dir=memmap_dir,
+            )
         if probability_space == LIN_GRID:
             liklhd = discrete.Likelihoods(
                 self.ts,
@@ -322,6 +367,7 @@ class DiscreteTimeMethod(EstimationMethod):
                 self.recombination_rate,
                 eps=epsilon,
                 fixed_node_set=self.get_fixed_nodes_set(),
+                likelihood_threshold=likelihood_threshold,
                 progress=self.pbar,
             )
         elif probability_space == LOG_GRID:
@@ -332,6 +378,7 @@ class DiscreteTimeMethod(EstimationMethod):
                 self.recombination_rate,
                 eps=epsilon,
                 fixed_node_set=self.get_fixed_nodes_set(),
+                likelihood_threshold=likelihood_threshold,
                 progress=self.pbar,
             )
         else:
@@ -340,7 +387,10 @@ class DiscreteTimeMethod(EstimationMethod):
                 f"one of {LIN_GRID} or {LOG_GRID}"
             )
         if self.mutation_rate is not None:
-            liklhd.precalculate_mutation_likelihoods(num_threads=num_threads)
+            with self.instrumentation.stage("likelihoods"):
+                liklhd.precalculate_mutation_likelihoods(
+                    num_threads=num_threads, cache_likelihoods=cache_likelihoods
+                )
 
         return discrete.BeliefPropagation(self.priors, liklhd, progress=self.pbar)
 
@@ -355,6 +405,11 @@ class InsideOutsideMethod(DiscreteTimeMethod):
         ignore_oldest_root,
         probability_space,
         num_threads=None,
+        cache_likelihoods=None,
+        likelihood_threshold=None,
+        refine_timepoints=None,
+        single_precision=None,
+        memmap_dir=None,
         cache_inside=None,
     ):
         if self.mutation_rate is None and self.recombination_rate is None:
@@ -370,15 +425,62 @@ class InsideOutsideMethod(DiscreteTimeMethod):
             self.provenance_params.update(
                 {k: v for k, v in locals().items() if k != "self"}
             )
-        fit_obj = self.main_algorithm(probability_space, eps, num_threads)
-        marginal_likl = fit_obj.inside_pass(cache_inside=cache_inside)
-        fit_obj.outside_pass(
-            standardize=outside_standardize, ignore_oldest_root=ignore_oldest_root
-        )
-        # Turn the posterior into probabilities
-        fit_obj.posterior_grid.standardize()  # Just to ensure no floating point issues
-        fit_obj.posterior_grid.force_probability_space(LIN_GRID)
-        fit_obj.posterior_grid.to_probabilities()
+            if memmap_dir is not None:
+                self.provenance_params["memmap_dir"] = os.fspath(memmap_dir)
+        if refine_timepoints is not None:
+            if self.population_size is None:
+                raise ValueError(
+                    "Refining the time points requires a population size rather "
+                    "than priors built using tsdate.build_prior_grid()"
+                )
+            if refine_timepoints <= len(self.priors.timepoints):
+                raise ValueError(
+                    "The number of refined time points must be greater than the "
+                    f"{len(self.priors.timepoints)} time points in the prior"
+                )
+
+        def inside_outside():
+            fit_obj = self.main_algorithm(
+                probability_space,
+                eps,
+                num_threads,
+                cache_likelihoods,
+                likelihood_threshold,
+                single_precision,
+                memmap_dir,
+            )
+            with self.instrumentation.stage("inside"):
+                marginal_likl = fit_obj.inside_pass(cache_inside=cache_inside)
+            with self.instrumentation.stage("outside"):
+                fit_obj.outside_pass(
+                    standardize=outside_standardize,
+                    ignore_oldest_root=ignore_oldest_root,
+                )
+            # Turn the posterior into probabilities
+            fit_obj.posterior_grid.standardize()  # Just to ensure no FP issues
+            fit_obj.posterior_grid.force_probability_space(LIN_GRID)
+            fit_obj.posterior_grid.to_probabilities()
+            return fit_obj, marginal_likl
+
+        fit_obj, marginal_likl = inside_outside()
+        if refine_timepoints is not None:
+            # Rerun on a finer grid, concentrated where the posterior mass lies
+            timepoints = prior.refine_timepoints(
+                self.priors.timepoints,
+                np.sum(fit_obj.posterior_grid.grid_data, axis=0),
+                refine_timepoints,
+            )
+            logger.info(f"Refining to {len(timepoints)} time points")
+            with self.instrumentation.stage("priors"):
+                self.priors = prior.prior_grid(
+                    self.ts,
+                    self.population_size,
+                    timepoints,
+                    approximate_priors=self.approximate_priors,
+                    allow_unary=self.allow_unary,
+                    progress=self.pbar,
+                )
+            fit_obj, marginal_likl = inside_outside()
 
         posterior_mean, posterior_var = self.mean_var(self.ts, fit_obj.posterior_grid)
         mut_edge = np.full(self.ts.num_mutations, tskit.NULL)
@@ -406,6 +508,10 @@ class MaximizationMethod(DiscreteTimeMethod):
         eps,
         probability_space=None,
         num_threads=None,
+        cache_likelihoods=None,
+        likelihood_threshold=None,
+        single_precision=None,
+        memmap_dir=None,
         cache_inside=None,
     ):
         if self.mutation_rate is None and self.recombination_rate is None:
@@ -414,9 +520,21 @@ class MaximizationMethod(DiscreteTimeMethod):
             self.provenance_params.update(
                 {k: v for k, v in locals().items() if k != "self"}
             )
-        fit_obj = self.main_algorithm(probability_space, eps, num_threads)
-        marginal_likl = fit_obj.inside_pass(cache_inside=cache_inside)
-        fit_obj.outside_maximization(eps=eps)
+            if memmap_dir is not None:
+                self.provenance_params["memmap_dir"] = os.fspath(memmap_dir)
+        fit_obj = self.main_algorithm(
+            probability_space,
+            eps,
+            num_threads,
+            cache_likelihoods,
+            likelihood_threshold,
+            single_precision,
+            memmap_dir,
+        )
+        with self.instrumentation.stage("inside"):
+            marginal_likl = fit_obj.inside_pass(cache_inside=cache_inside)
+        with self.instrumentation.stage("outside_maximization"):
+            fit_obj.outside_maximization(eps=eps)
         mut_edge = np.full(self.ts.num_mutations, tskit.NULL)
         mut_node = self.ts.mutations_node
         return Results(
@@ -448,22 +566,126 @@ class VariationalGammaMethod(EstimationMethod):
         match_segregating_sites,
         regularise_roots,
         singletons_phased,
+        convergence_tolerance=None,
+        checkpoint_file=None,
+        checkpoint_interval=None,
+        resume=None,
+        initial_posteriors=None,
+        single_precision=None,
+        window_size=None,
+        window_overlap=None,
+        num_processes=None,
+        num_threads=None,
+        residual_tolerance=None,
+        max_edge_updates=None,
     ):
         if self.provenance_params is not None:
             self.provenance_params.update(
                 {k: v for k, v in locals().items() if k != "self"}
             )
+            if initial_posteriors is not None and not isinstance(initial_posteriors, str):
+                self.provenance_params["initial_posteriors"] = "array"
         if not max_iterations > 0:
             raise ValueError("Maximum number of EP iterations must be greater than 0")
+        if convergence_tolerance is not None and not convergence_tolerance > 0:
+            raise ValueError("Convergence tolerance must be greater than 0")
+        if checkpoint_interval is None:
+            checkpoint_interval = 1
+        if not checkpoint_interval > 0:
+            raise ValueError("Checkpoint interval must be greater than 0")
+        if resume and checkpoint_file is None:
+            raise ValueError("A checkpoint file is required to resume from")
+        if residual_tolerance is not None:
+            if not residual_tolerance >= 0:
+                raise ValueError("Residual tolerance must be non-negative")
+            if num_threads is not None and num_threads >= 1:
+                raise ValueError("Residual tolerance cannot be used with num_threads")
+        if max_edge_updates is not None:
+            if residual_tolerance is None:
+                raise ValueError("Maximum edge updates requires a residual tolerance")
+            if not max_edge_updates > 0:
+                raise ValueError("Maximum edge updates must be greater than 0")
+        if isinstance(initial_posteriors, str):
+            if initial_posteriors != "metadata":
+                raise ValueError("initial_posteriors must be 'metadata' or an array")
+            initial_posteriors = util.node_posteriors_from_metadata(self.ts)
         if self.mutation_rate is None:
             raise ValueError("Variational gamma method requires mutation rate")
+        if window_size is not None:
+            if not window_size > 0:
+                raise ValueError("Window size must be greater than 0")
+            if window_overlap is None:
+                window_overlap = window_size / 10
+            if not window_overlap >= 0:
+                raise ValueError("Window overlap must be non-negative")
+            if checkpoint_file is not None:
+                raise ValueError("Checkpointing is not supported for genomic windows")
+            if self.return_fit:
+                raise ValueError("Cannot return a fit object for genomic windows")
+            with self.instrumentation.stage("windows"):
+                (
+                    node_mn,
+                    node_va,
+                    mutation_mn,
+                    mutation_va,
+                    mutation_node,
+                ) = variational.windowed_posteriors(
+                    self.ts,
+                    window_size=window_size,
+                    window_overlap=window_overlap,
+                    mutation_rate=self.mutation_rate,
+                    allow_unary=self.allow_unary,
+                    singletons_phased=singletons_phased,
+                    single_precision=bool(single_precision),
+                    initial_posteriors=initial_posteriors,
+                    num_processes=num_processes,
+                    progress=self.pbar,
+                    ep_iterations=max_iterations,
+                    max_shape=max_shape,
+                    rescale_intervals=rescaling_intervals,
+                    rescale_iterations=rescaling_iterations,
+                    regularise=regularise_roots,
+                    rescale_segsites=match_segregating_sites,
+                    ep_tolerance=convergence_tolerance,
+                    num_threads=num_threads,
+                    residual_tolerance=residual_tolerance,
+                    max_edge_updates=max_edge_updates,
+                )
+            # map mutations to edges, using the estimated phase of singletons
+            with self.instrumentation.stage("mutation_edges"):
+                ts = self.ts
+                if np.any(mutation_node != ts.mutations_node):
+                    tables = ts.dump_tables()
+                    tables.mutations.node = mutation_node
+                    tables.mutations.parent = np.full_like(mutation_node, tskit.NULL)
+                    tables.mutations.time = np.full(
+                        mutation_node.size, tskit.UNKNOWN_TIME
+                    )
+                    ts = tables.tree_sequence()
+                _, _, mutation_edge, *_ = rescaling.edge_statistics(ts, size_biased=False)
+            return Results(
+                node_mn,
+                node_va,
+                mutation_mn,
+                mutation_va,
+                None,
+                mutation_edge,
+                mutation_node,
+                None,
+            )
 
         fit_obj = variational.ExpectationPropagation(
             self.ts,
             mutation_rate=self.mutation_rate,
             allow_unary=self.allow_unary,
             singletons_phased=singletons_phased,
+            single_precision=bool(single_precision),
+            instrumentation=self.instrumentation,
         )
+        if initial_posteriors is not None:
+            fit_obj.initialize_posteriors(
+                initial_posteriors["mean"], initial_posteriors["variance"]
+            )
         fit_obj.infer(
             ep_iterations=max_iterations,
             max_shape=max_shape,
@@ -471,6 +693,13 @@ class VariationalGammaMethod(EstimationMethod):
             rescale_iterations=rescaling_iterations,
             regularise=regularise_roots,
             rescale_segsites=match_segregating_sites,
+            ep_tolerance=convergence_tolerance,
+            checkpoint=checkpoint_file,
+            checkpoint_interval=checkpoint_interval,
+            resume=bool(resume),
+            num_threads=num_threads,
+            residual_tolerance=residual_tolerance,
+            max_edge_updates=max_edge_updates,
             progress=self.pbar,
         )
         marginal_likl = fit_obj.marginal_likelihood()
@@ -499,6 +728,10 @@ def maximization(
     eps=None,
     num_threads=None,
     probability_space=None,
+    cache_likelihoods=None,
+    likelihood_threshold=None,
+    single_precision=None,
+    memmap_dir=None,
     # below deliberately undocumented
     cache_inside=None,
     Ne=None,
@@ -507,7 +740,9 @@ def maximization(
 ):
     """
     maximization(tree_sequence, *, mutation_rate, population_size=None, priors=None,\
-        eps=None, num_threads=None, probability_space=None, **kwargs)
+        eps=None, num_threads=None, probability_space=None, cache_likelihoods=None,\
+        likelihood_threshold=None, single_precision=None, memmap_dir=None,\
+        **kwargs)
 
     Infer dates for nodes in a genealogical graph using the "outside maximization"
     algorithm. This approximates the marginal posterior distribution of a node's
@@ -568,6 +803,29 @@ def maximization(
     :param string probability_space: Should the internal algorithm save
         probabilities in "logarithmic" (slower, less liable to to overflow) or
         "linear" space (fast, may overflow). Default: None treated as"logarithmic"
+    :param bool cache_likelihoods: Should the mutation likelihoods be read from
+        and saved to a cache on disk, so that they can be reused when dating with
+        the same timepoints, mutation rate and ``eps``? The cache is stored in a
+        subdirectory of :func:`get_cache_dir`, and the least recently used
+        likelihoods are removed to keep it under 1 GiB. Default: None, treated
+        as False.
+    :param float likelihood_threshold: If given, treat the mutation likelihoods
+        of each edge that are less than this fraction of the largest likelihood for
+        the same parent time as zero, and skip them in the inside and outside
+        steps. This is an approximation that speeds up dating with many timepoints
+        or high mutation rates; small values such as 1e-10 are recommended, as
+        larger values can discard most of the probability mass of a node.
+        Default: None, meaning that all likelihoods are used.
+    :param bool single_precision: If ``True``, store the node time grids (the
+        inside, outside and posterior values, and the priors) as 32-bit rather
+        than 64-bit floats, halving the memory they use at the cost of a small
+        loss of numerical accuracy. Best used with the default "logarithmic"
+        ``probability_space``, which is less liable to underflow. Default: None,
+        treated as False.
+    :param str memmap_dir: If given, store the node time grids in temporary
+        memory-mapped files in this directory rather than in RAM, so that large
+        tree sequences can be dated when the grids do not fit in memory. The files
+        are removed once the grids are no longer used. Default: None
     :param \\**kwargs: Other keyword arguments as described in the :func:`date` wrapper
         function, notably ``mutation_rate``, and ``population_size`` or ``priors``.
         Further arguments include ``time_units``, ``progress``, ``allow_unary`` and
@@ -602,6 +860,10 @@ def maximization(
     result = dating_method.run(
         eps=eps,
         num_threads=num_threads,
+        cache_likelihoods=cache_likelihoods,
+        likelihood_threshold=likelihood_threshold,
+        single_precision=single_precision,
+        memmap_dir=memmap_dir,
         cache_inside=cache_inside,
         probability_space=probability_space,
     )
@@ -619,6 +881,11 @@ def inside_outside(
     outside_standardize=None,
     ignore_oldest_root=None,
     probability_space=None,
+    cache_likelihoods=None,
+    likelihood_threshold=None,
+    refine_timepoints=None,
+    single_precision=None,
+    memmap_dir=None,
     # below deliberately undocumented
     cache_inside=False,
     # Deprecated params
@@ -629,7 +896,8 @@ def inside_outside(
     """
     inside_outside(tree_sequence, *, mutation_rate, population_size=None, priors=None,\
         eps=None, num_threads=None, outside_standardize=None, ignore_oldest_root=None,\
-        probability_space=None, **kwargs)
+        probability_space=None, cache_likelihoods=None, likelihood_threshold=None,\
+        refine_timepoints=None, single_precision=None, memmap_dir=None, **kwargs)
 
     Infer dates for nodes in a genealogical graph using the "inside outside" algorithm.
     This approximates the marginal posterior distribution of a node's age using an
@@ -701,6 +969,37 @@ def inside_outside(
     :param string probability_space: Should the internal algorithm save
         probabilities in "logarithmic" (slower, less liable to to overflow) or
         "linear" space (fast, may overflow). Default: "logarithmic"
+    :param bool cache_likelihoods: Should the mutation likelihoods be read from
+        and saved to a cache on disk, so that they can be reused when dating with
+        the same timepoints, mutation rate and ``eps``? The cache is stored in a
+        subdirectory of :func:`get_cache_dir`, and the least recently used
+        likelihoods are removed to keep it under 1 GiB. Default: None, treated
+        as False.
+    :param float likelihood_threshold: If given, treat the mutation likelihoods
+        of each edge that are less than this fraction of the largest likelihood for
+        the same parent time as zero, and skip them in the inside and outside
+        steps. This is an approximation that speeds up dating with many timepoints
+        or high mutation rates; small values such as 1e-10 are recommended, as
+        larger values can discard most of the probability mass of a node.
+        Default: None, meaning that all likelihoods are used.
+    :param int refine_timepoints: If given, first run the inside and outside steps
+        on the time points of the prior, then rerun them on a finer grid with this
+        many time points, made by adding time points between the original ones in
+        proportion to the posterior mass (summed over all nodes) in each interval.
+        This gives a higher resolution where most node times lie, without the
+        quadratic cost of using the same number of evenly spread time points.
+        Requires ``population_size`` rather than ``priors``. Default: None,
+        meaning that the grid is not refined.
+    :param bool single_precision: If ``True``, store the node time grids (the
+        inside, outside and posterior values, and the priors) as 32-bit rather
+        than 64-bit floats, halving the memory they use at the cost of a small
+        loss of numerical accuracy. Best used with the default "logarithmic"
+        ``probability_space``, which is less liable to underflow. Default: None,
+        treated as False.
+    :param str memmap_dir: If given, store the node time grids in temporary
+        memory-mapped files in this directory rather than in RAM, so that large
+        tree sequences can be dated when the grids do not fit in memory. The files
+        are removed once the grids are no longer used. Default: None
     :param \\**kwargs: Other keyword arguments as described in the :func:`date` wrapper
         function, notably ``mutation_rate``, and ``population_size`` or ``priors``.
         Further arguments include ``time_units``, ``progress``, ``allow_unary`` and
@@ -744,6 +1043,11 @@ def inside_outside(
         num_threads=num_threads,
         outside_standardize=outside_standardize,
         ignore_oldest_root=ignore_oldest_root,
+        cache_likelihoods=cache_likelihoods,
+        likelihood_threshold=likelihood_threshold,
+        refine_timepoints=refine_timepoints,
+        single_precision=single_precision,
+        memmap_dir=memmap_dir,
         cache_inside=cache_inside,
         probability_space=probability_space,
     )
@@ -759,6 +1063,18 @@ def variational_gamma(
     rescaling_intervals=None,
     rescaling_iterations=None,
     match_segregating_sites=None,
+    convergence_tolerance=None,
+    checkpoint_file=None,
+    checkpoint_interval=None,
+    resume=None,
+    initial_posteriors=None,
+    single_precision=None,
+    window_size=None,
+    window_overlap=None,
+    num_processes=None,
+    num_threads=None,
+    residual_tolerance=None,
+    max_edge_updates=None,
     # deliberately undocumented parameters below. We may eventually document these
     max_shape=None,
     regularise_roots=None,
@@ -767,7 +1083,11 @@ def variational_gamma(
 ):
     """
     variational_gamma(tree_sequence, *, mutation_rate, eps=None, max_iterations=None,\
-            rescaling_intervals=None, **kwargs)
+            rescaling_intervals=None, convergence_tolerance=None,\
+            checkpoint_file=None, checkpoint_interval=None, resume=None,\
+            initial_posteriors=None, single_precision=None, window_size=None,\
+            window_overlap=None, num_processes=None, num_threads=None,\
+            residual_tolerance=None, max_edge_updates=None, **kwargs)
 
     Infer dates for nodes in a tree sequence using expectation propagation,
     which approximates the marginal posterior distribution of a given node's
@@ -788,8 +1108,8 @@ def variational_gamma(
         unit time.
     :param float eps: The minimum distance separating parent and child ages in
         the returned tree sequence. Default: None, treated as 1e-6
-    :param int max_iterations: The number of iterations used in the expectation
-        propagation algorithm. Default: None, treated as 25.
+    :param int max_iterations: The maximum number of iterations used in the
+        expectation propagation algorithm. Default: None, treated as 25.
     :param float rescaling_intervals: For time rescaling, the number of time
         intervals within which to estimate a rescaling parameter. Setting this to zero
         means that rescaling is not performed. Default ``None``, treated as 1000.
@@ -801,6 +1121,69 @@ def variational_gamma(
         If ``False``, time is rescaled such that branch- and site-mode root-to-leaf
         length are approximately equal, which gives unbiased estimates when there
         are polytomies. Default ``False``.
+    :param float convergence_tolerance: If given, expectation propagation is
+        halted before ``max_iterations`` is reached once the largest relative
+        change in the posterior mean of any node age, between successive
+        iterations, is below this value. Default: None, meaning that
+        ``max_iterations`` rounds of iteration are always performed.
+    :param str checkpoint_file: If given, the state of the expectation
+        propagation algorithm is saved to this ``.npz`` file during iteration,
+        so that a long-running job that is interrupted can be restarted using
+        ``resume=True``. Default: None, meaning no checkpoints are saved.
+    :param int checkpoint_interval: The number of expectation propagation
+        iterations between successive checkpoints. Default: None, treated as 1.
+    :param bool resume: If ``True`` and ``checkpoint_file`` exists, restart
+        iteration from the saved state rather than from scratch. The checkpoint
+        must have been created from the same tree sequence and parameters.
+        Default: None, treated as False.
+    :param initial_posteriors: Warm-start expectation propagation from existing
+        estimates of the posterior mean and variance of node ages, so that fewer
+        iterations are needed for convergence. Either a structured array with
+        ``"mean"`` and ``"variance"`` fields and one row per node, as returned by
+        :meth:`~variational.ExpectationPropagation.node_posteriors`, or the
+        string ``"metadata"``, to use the ``"mn"`` and ``"vr"`` values stored in
+        the node metadata of a tree sequence previously dated by tsdate. As
+        the posteriors are used before time rescaling, this is most effective
+        if they were themselves estimated with little or no rescaling.
+        Default: None, meaning that iteration starts from scratch.
+    :param bool single_precision: If ``True``, store the edge likelihoods and
+        the factors and posteriors used in expectation propagation as 32-bit
+        rather than 64-bit floats, roughly halving memory usage at the cost of
+        a small loss of numerical accuracy. Default: None, treated as False.
+    :param float window_size: If given, cut the genome into windows of this
+        length, which are dated independently so that memory usage is bounded
+        by the size of a window rather than of the whole tree sequence. The
+        posteriors of nodes that span several windows are combined by
+        averaging their natural parameters, weighted by the span of the node
+        in each window. Checkpointing and ``return_fit`` are not supported in
+        this mode. Default: None, meaning the tree sequence is dated as a whole.
+    :param float window_overlap: The length of flanking sequence added to
+        either side of each window, to reduce edge effects at window
+        boundaries. Only used if ``window_size`` is given. Default: None,
+        treated as a tenth of ``window_size``.
+    :param int num_processes: The number of worker processes used to date
+        windows in parallel. Only used if ``window_size`` is given. Windows
+        are dated sequentially unless this is > 1. Workers are started with
+        the "spawn" method, so each imports tsdate afresh. Default: None
+    :param int num_threads: The number of threads to use when updating edge
+        likelihoods in the expectation propagation algorithm. Edges that share
+        no nodes are updated concurrently, giving identical results to the
+        single-threaded algorithm. The posteriors for mutations are then also
+        calculated concurrently. A simpler unthreaded algorithm is used
+        unless this is >= 1. Default: None
+    :param float residual_tolerance: If given, every edge is updated in the
+        first iteration of expectation propagation, but thereafter only edges
+        whose factors are still changing are updated, in order of decreasing
+        residual (the relative change in the factors for an edge when it was
+        last updated, raised whenever the posterior of one of its nodes
+        changes). Edges with residuals at or below this value are skipped, so
+        that iterations are cheaper once most of the tree sequence has
+        converged. Cannot be used with ``num_threads``. Default: None, meaning
+        that every edge is updated in every iteration.
+    :param int max_edge_updates: The maximum number of edge updates in each
+        iteration when ``residual_tolerance`` is given. Default: None, treated
+        as the number of updates in an iteration without prioritisation (twice
+        the number of edges).
     :param \\**kwargs: Other keyword arguments as described in the :func:`date` wrapper
         function, including ``time_units``, ``progress``, ``allow_unary`` and
         ``record_provenance``. The arguments ``return_fit`` and ``return_likelihood``
@@ -833,6 +1216,8 @@ def variational_gamma(
         rescaling_iterations = DEFAULT_RESCALING_ITERATIONS
     if match_segregating_sites is None:
         match_segregating_sites = False
+    if checkpoint_file is not None:
+        checkpoint_file = os.fspath(checkpoint_file)
     if regularise_roots is None:
         regularise_roots = True
     if singletons_phased is None:
@@ -853,6 +1238,18 @@ def variational_gamma(
         match_segregating_sites=match_segregating_sites,
         regularise_roots=regularise_roots,
         singletons_phased=singletons_phased,
+        convergence_tolerance=convergence_tolerance,
+        checkpoint_file=checkpoint_file,
+        checkpoint_interval=checkpoint_interval,
+        resume=resume,
+        initial_posteriors=initial_posteriors,
+        single_precision=single_precision,
+        window_size=window_size,
+        window_overlap=window_overlap,
+        num_processes=num_processes,
+        num_threads=num_threads,
+        residual_tolerance=residual_tolerance,
+        max_edge_updates=max_edge_updates,
     )
     return dating_method.parse_result(result, eps)
 
@@ -888,6 +1285,7 @@ def date(
     allow_unary=None,
     progress=None,
     record_provenance=True,
+    instrumentation_callback=None,
     # Other kwargs documented in the functions for each specific estimation-method
     **kwargs,
 ):
@@ -951,6 +1349,13 @@ def date(
     :param bool record_provenance: Should the tsdate command be appended to the
         provenence information in the returned tree sequence?
         Default: None, treated as True.
+    :param callable instrumentation_callback: A function that is called once
+        dating has finished, with a single
+        :class:`~instrumentation.Instrumentation` argument holding the wall time
+        and peak memory usage of each stage of the run, together with counts such
+        as the number of skipped edges and per-iteration convergence metrics.
+        These can be saved as JSON using
+        :meth:`~instrumentation.Instrumentation.to_json`. Default: None
     :param \\**kwargs: Other keyword arguments specific to the
         :data:`estimation method<tsdate.core.estimation_methods>` used. These are
         documented in those specific functions.
@@ -978,5 +1383,124 @@ def date(
         allow_unary=allow_unary,
         set_metadata=set_metadata,
         record_provenance=record_provenance,
+        instrumentation_callback=instrumentation_callback,
         **kwargs,
     )
+
+
+def _date_source(job, mutation_rate, params):
+    # Date a single input to `date_many`, saving it to file if an output is given
+    index, source, output = job
+    start_time = time.time()
+    ts = source if isinstance(source, tskit.TreeSequence) else tskit.load(source)
+    dated_ts = date(ts, mutation_rate=mutation_rate, **params)
+    if output is not None:
+        dated_ts.dump(output)
+        dated_ts = None
+    return index, dated_ts, time.time() - start_time
+
+
+def date_many(
+    tree_sequences,
+    *,
+    mutation_rate,
+    output_files=None,
+    num_processes=None,
+    progress=None,
+    **kwargs,
+):
+    """
+    Date many tree sequences (e.g. one per chromosome, or simulation replicates)
+    using :func:`date`, optionally in parallel using a pool of worker processes.
+    The workers are reused for successive inputs, so that compiled code is
+    loaded once per worker rather than once per input (see also
+    :func:`~tsdate.warmup`). Inputs are dated in decreasing order of size, to
+    minimise the total run time when the inputs differ in size, and each dated
+    tree sequence is saved to its output file as soon as it is finished.
+
+    .. code-block:: python
+
+      files = [f"chr{i}.trees" for i in range(1, 23)]
+      results = tsdate.date_many(
+          files,
+          mutation_rate=1e-8,
+          output_files=[f.replace(".trees", ".dated.trees") for f in files],
+          num_processes=8,
+      )
+      for result in results:
+          print(f"Dated {result.source} in {result.time:.1f} seconds")
+
+    :param list tree_sequences: The input tree sequences, given either as paths to
+        tree sequence files or as :class:`~tskit.TreeSequence` objects.
+    :param float mutation_rate: The estimated mutation rate per unit of genome per
+        unit time, as in :func:`date`.
+    :param list output_files: Paths to which to save the dated tree sequences, one
+        for each input. If ``None`` (default) the dated tree sequences are returned.
+    :param int num_processes: The number of worker processes used to date tree
+        sequences in parallel. Tree sequences are dated sequentially in the current
+        process unless this is > 1. Note that genomic windows within each tree
+        sequence are always dated sequentially. Default: None
+    :param bool progress: Show a progress bar over inputs. Default: None, treated
+        as False.
+    :param \\**kwargs: Other keyword arguments passed to :func:`date`, such as the
+        ``method``. These must be picklable if ``num_processes`` is > 1. As they
+        are shared by all inputs, ``checkpoint_file`` and ``resume`` cannot be
+        used.
+    :return: A list with a ``BatchResult`` named tuple for each input, in the
+        order given, holding the ``source`` as given, the ``output`` file (or
+        ``None``), the dated ``tree_sequence`` (or ``None`` if saved to an output
+        file) and the wall ``time`` in seconds taken to load, date, and save it.
+    :rtype: list
+    """
+    sources = list(tree_sequences)
+    if output_files is None:
+        output_files = [None] * len(sources)
+    else:
+        output_files = list(output_files)
+        if len(output_files) != len(sources):
+            raise ValueError("There must be one output file for each tree sequence")
+    for param in (
+        "return_fit",
+        "return_likelihood",
+        "instrumentation_callback",
+        "checkpoint_file",
+        "resume",
+    ):
+        if kwargs.get(param):
+            raise ValueError(f"{param} cannot be used when dating many tree sequences")
+
+    def size(source):
+        if isinstance(source, tskit.TreeSequence):
+            return source.nbytes
+        return os.path.getsize(source)
+
+    order = sorted(range(len(sources)), key=lambda i: size(sources[i]), reverse=True)
+    jobs = [(i, sources[i], output_files[i]) for i in order]
+    f = functools.partial(_date_source, mutation_rate=mutation_rate, params=kwargs)
+    dated = [None] * len(sources)
+    timing = [None] * len(sources)
+
+    def record(results):
+        for index, dated_ts, seconds in tqdm(
+            results, total=len(jobs), desc="Tree sequences", disable=not progress
+        ):
+            dated[index] = dated_ts
+            timing[index] = seconds
+            source = sources[index]
+            if isinstance(source, tskit.TreeSequence):
+                source = f"tree sequence {index}"
+            logger.info(f"Dated {source} in {seconds:.2f} seconds")
+
+    if num_processes is not None and num_processes > 1 and len(jobs) > 1:
+        # Workers are spawned rather than forked, as numba's thread pool is not
+        # fork-safe. Jobs are handed out one at a time, biggest first.
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(processes=min(num_processes, len(jobs))) as pool:
+            record(pool.imap_unordered(f, jobs, chunksize=1))
+    else:
+        record(map(f, jobs))
+
+    return [
+        BatchResult(source, output, dated_ts, seconds)
+        for source, output, dated_ts, seconds in zip(sources, output_files, dated, timing)
+    ]
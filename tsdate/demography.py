@@ -171,46 +171,45 @@ class PopulationSizeHistory:
         Given a gamma distribution on a coalescent timescale with parameters
         `shape` and `rate`, return natural parameters of a gamma approximation
         to the distribution under a change of measure to a generational
-        timescale.
+        timescale. Arrays of parameters are converted all at once.
 
-        :param float shape: Shape parameter of gamma
-        :param float rate: Rate parameter of gamma (inverse of scale)
-        :return: natural parameters after change of measure
+        :param array_like shape: Shape parameter(s) of gamma
+        :param array_like rate: Rate parameter(s) of gamma (inverse of scale)
+        :return: natural parameters after change of measure, with the new shape
+            and rate along the last axis
         """
-        assert shape > 0, "Gamma shape parameter must be positive"
-        assert rate > 0, "Gamma rate parameter must be positive"
-        C = np.exp(shape * np.log(rate) - scipy.special.loggamma(shape))
+        shape, rate = np.broadcast_arrays(
+            np.asarray(shape, dtype=float), np.asarray(rate, dtype=float)
+        )
+        assert np.all(shape > 0), "Gamma shape parameter must be positive"
+        assert np.all(rate > 0), "Gamma rate parameter must be positive"
+        # Parameters along rows, epochs along columns
+        shape = shape[..., np.newaxis]
+        rate = rate[..., np.newaxis]
         gamma_cdf = scipy.special.gammainc
         cdf_breaks = np.append(self.coalescent_breaks, [np.inf])
-        cdf_0 = (
-            C
-            * scipy.special.gamma(shape)
-            / rate**shape
-            * np.diff(gamma_cdf(shape + 0, rate * cdf_breaks))
-        )
+        # Partial moments of the gamma within each epoch, using
+        # Gamma(shape + k) / Gamma(shape) / rate ** k = shape * ... * (shape + k - 1)
+        # / rate ** k
+        cdf_0 = np.diff(gamma_cdf(shape + 0, rate * cdf_breaks), axis=-1)
         mn_coef_0 = self.time_breaks - self.population_size * self.coalescent_breaks
         va_coef_0 = mn_coef_0**2
-        cdf_1 = (
-            C
-            * scipy.special.gamma(shape + 1)
-            / rate ** (shape + 1)
-            * np.diff(gamma_cdf(shape + 1, rate * cdf_breaks))
-        )
+        cdf_1 = shape / rate * np.diff(gamma_cdf(shape + 1, rate * cdf_breaks), axis=-1)
         mn_coef_1 = self.population_size
         va_coef_1 = mn_coef_0 * mn_coef_1 * 2
         cdf_2 = (
-            C
-            * scipy.special.gamma(shape + 2)
-            / rate ** (shape + 2)
-            * np.diff(gamma_cdf(shape + 2, rate * cdf_breaks))
+            shape
+            * (shape + 1)
+            / rate**2
+            * np.diff(gamma_cdf(shape + 2, rate * cdf_breaks), axis=-1)
         )
         va_coef_2 = mn_coef_1**2
-        mn = np.sum(mn_coef_1 * cdf_1 + mn_coef_0 * cdf_0)
-        va = np.sum(va_coef_2 * cdf_2 + va_coef_1 * cdf_1 + va_coef_0 * cdf_0)
+        mn = np.sum(mn_coef_1 * cdf_1 + mn_coef_0 * cdf_0, axis=-1)
+        va = np.sum(va_coef_2 * cdf_2 + va_coef_1 * cdf_1 + va_coef_0 * cdf_0, axis=-1)
         va -= mn**2
         new_shape = mn**2 / va
         new_rate = mn / va
-        return np.array([new_shape, new_rate])
+        return np.stack([new_shape, new_rate], axis=-1)
 
     # TODO:
     # @staticmethod
@@ -1,18 +1,67 @@
 # Classes used for discete time algorithms (inside-outside and outsize_maximization)
 # Note that these methods are no longer the default method used by tsdate
-import functools
+import hashlib
 import itertools
-import multiprocessing
+import logging
+import math
 import operator
+import os
+import tempfile
+import zipfile
 from collections import defaultdict
 
 import numpy as np
 import scipy.stats
 import tskit
+from numba import prange
 from tqdm.auto import tqdm
 
-from .accelerate import numba_jit
-from .node_time_class import LIN_GRID, LOG_GRID
+from . import cache
+from .accelerate import numba_jit, numba_threads
+from .node_time_class import LIN_GRID, LOG_GRID, allocate_grid
+from .provenance import __version__
+
+logger = logging.getLogger(__name__)
+
+# The maximum total size in bytes of the mutation likelihoods cached on disk
+LIKELIHOOD_CACHE_MAX_BYTES = 2**30
+
+
+def likelihood_cache_dir():
+    """
+    The directory in which mutation likelihoods are cached between runs: a
+    subdirectory of :func:`~tsdate.get_cache_dir` specific to the tsdate version
+    """
+    return cache.get_cache_dir() / "likelihoods" / f"tsdate-{__version__}"
+
+
+def clear_likelihood_cache():
+    """
+    Remove all mutation likelihoods cached on disk
+    """
+    cache_dir = likelihood_cache_dir()
+    if not cache_dir.is_dir():
+        return
+    for path in cache_dir.glob("*.npz"):
+        path.unlink(missing_ok=True)
+
+
+def _prune_likelihood_cache(cache_dir, max_bytes):
+    # Remove the least recently used files until the cache fits within max_bytes
+    files = []
+    for path in cache_dir.glob("*.npz"):
+        try:
+            stat = path.stat()
+        except OSError:  # pragma: no cover
+            continue  # removed by another process
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+        logger.debug(f"Removed {path} from the likelihood cache")
 
 
 class Likelihoods:
@@ -23,11 +72,17 @@ class Likelihoods:
 
     If ``standardize`` is true, routines will operate to standardize the likelihoods
     such that their maximum is one (in linear space) or zero (in log space)
+
+    If ``likelihood_threshold`` is given, the precalculated likelihoods in each row
+    of the lower triangular matrix (i.e. for each parent time) that are less than
+    this fraction of the maximum in the row are set to zero, and the compiled
+    inside and outside passes only visit the band of remaining entries
     """
 
     probability_space = LIN_GRID
     identity_constant = 1.0
     null_constant = 0.0
+    keys_per_chunk = 100000
 
     def __init__(
         self,
@@ -39,14 +94,18 @@ class Likelihoods:
         eps=0,
         fixed_node_set=None,
         standardize=False,
+        likelihood_threshold=None,
         progress=False,
     ):
+        if likelihood_threshold is not None and not 0 <= likelihood_threshold < 1:
+            raise ValueError("The likelihood threshold must be between 0 and 1")
         self.ts = ts
         self.timepoints = timepoints
         self.fixednodes = set(ts.samples()) if fixed_node_set is None else fixed_node_set
         self.mut_rate = mutation_rate
         self.rec_rate = recombination_rate
         self.standardize = standardize
+        self.likelihood_threshold = likelihood_threshold
         self.grid_size = len(timepoints)
         self.tri_size = self.grid_size * (self.grid_size + 1) / 2
         self.ll_mut = {}
@@ -109,21 +168,21 @@ class Likelihoods:
         """
         ll = scipy.stats.poisson.pmf(muts, dt * mutation_rate * span)
         if standardize:
-            return ll / np.max(ll)
+            return ll / np.max(ll, axis=-1, keepdims=True)
         else:
             return ll
 
-    @staticmethod
-    def _lik_wrapper(muts_span, dt, mutation_rate, standardize=True):
+    def unfixed_edges(self):
         """
-        A wrapper to allow this _lik to be called by pool.imap_unordered, returning the
-        mutation and span values
+        Return a boolean array indicating which edges have a child that is not
+        at a fixed time
         """
-        return muts_span, Likelihoods._lik(
-            muts_span[0], muts_span[1], dt, mutation_rate, standardize=standardize
-        )
+        fixed_nodes = np.fromiter(self.fixednodes, dtype=self.ts.edges_child.dtype)
+        return np.logical_not(np.isin(self.ts.edges_child, fixed_nodes))
 
-    def precalculate_mutation_likelihoods(self, num_threads=None, unique_method=0):
+    def precalculate_mutation_likelihoods(
+        self, num_threads=None, unique_method=None, cache_likelihoods=False
+    ):
         """
         We precalculate these because the pmf function is slow, but can be trivially
         parallelised. We store the likelihoods in a cache because they only depend on
@@ -133,72 +192,180 @@ class Likelihoods:
         because (a) these are only used once per node and (b) sample edges are often
         long, and hence their span will be unique. This also allows us to deal easily
         with fixed nodes at explicit times (rather than in time slices)
+
+        The distinct ``(mutations, span)`` keys are stored in sorted order as the
+        ``unfixed_keys`` record array, and their likelihoods as the corresponding
+        rows of the ``unfixed_likelihoods`` array. These are filled in place by
+        compiled code, using ``num_threads`` threads (default: one).
+        ``unique_method`` is ignored, and only kept for backwards compatibility.
+
+        If ``cache_likelihoods`` is true, likelihoods are also read from and saved
+        to a cache on disk (see :func:`likelihood_cache_dir`), shared by all runs
+        with the same timepoints, mutation rate, ``eps``, standardization and
+        probability space. Least recently used files are removed from the cache
+        to keep it below ``LIKELIHOOD_CACHE_MAX_BYTES``.
         """
 
         if self.mut_rate is None:
             raise RuntimeError(
                 "Cannot calculate mutation likelihoods with no mutation_rate set"
             )
-        if unique_method == 0:
-            self.unfixed_likelihood_cache = {
-                (muts, e.span): None
-                for muts, e in zip(self.mut_edges, self.ts.edges())
-                if e.child not in self.fixednodes
-            }
-        else:
-            fixed_nodes = np.array(list(self.fixednodes))
-            keys = np.unique(
-                np.core.records.fromarrays(
-                    (self.mut_edges, self.ts.edges_right - self.ts.edges_left),
-                    names="muts,span",
-                )[np.logical_not(np.isin(self.ts.edges_child, fixed_nodes))]
-            )
-            if unique_method == 1:
-                self.unfixed_likelihood_cache = dict.fromkeys({tuple(t) for t in keys})
-            else:
-                self.unfixed_likelihood_cache = {tuple(t): None for t in keys}
-
-        if num_threads:
-            f = functools.partial(  # Set constant values for params for static _lik
-                self._lik_wrapper,
-                dt=self.timediff_lower_tri,
-                mutation_rate=self.mut_rate,
-                standardize=self.standardize,
+        is_unfixed = self.unfixed_edges()
+        self.unfixed_keys = np.unique(
+            np.rec.fromarrays(
+                (
+                    self.mut_edges[is_unfixed],
+                    (self.ts.edges_right - self.ts.edges_left)[is_unfixed],
+                ),
+                names="muts,span",
             )
-            if num_threads == 1:
-                # Useful for testing
-                for key in tqdm(
-                    self.unfixed_likelihood_cache.keys(),
-                    disable=not self.progress,
-                    desc="Precalculating Likelihoods",
-                ):
-                    returned_key, likelihoods = f(key)
-                    self.unfixed_likelihood_cache[returned_key] = likelihoods
-            else:
-                with tqdm(
-                    total=len(self.unfixed_likelihood_cache.keys()),
-                    disable=not self.progress,
-                    desc="Precalculating Likelihoods",
-                ) as prog_bar:
-                    with multiprocessing.Pool(processes=num_threads) as pool:
-                        for key, pmf in pool.imap_unordered(
-                            f, self.unfixed_likelihood_cache.keys()
-                        ):
-                            self.unfixed_likelihood_cache[key] = pmf
-                            prog_bar.update()
+        )
+        num_keys = self.unfixed_keys.size
+        self.unfixed_likelihoods = np.empty((num_keys, int(self.tri_size)))
+        cached = None
+        if cache_likelihoods:
+            cached = self._load_cached_likelihoods()
+        if cached is None:
+            missing = np.arange(num_keys)
+            self._fill_likelihoods(missing, self.unfixed_likelihoods, num_threads)
         else:
-            for muts, span in tqdm(
-                self.unfixed_likelihood_cache.keys(),
+            keys, likelihoods = cached
+            rows = np.minimum(np.searchsorted(keys, self.unfixed_keys), keys.size - 1)
+            found = keys[rows] == self.unfixed_keys
+            self.unfixed_likelihoods[found] = likelihoods[rows[found]]
+            missing = np.flatnonzero(~found)
+            out = np.empty((missing.size, int(self.tri_size)))
+            self._fill_likelihoods(missing, out, num_threads)
+            self.unfixed_likelihoods[missing] = out
+            logger.info(
+                f"Read {num_keys - missing.size} of {num_keys} mutation likelihoods "
+                "from the cache"
+            )
+        if cache_likelihoods and missing.size > 0:
+            self._save_cached_likelihoods(cached)
+        if self.likelihood_threshold is not None:
+            self.unfixed_bands = np.empty((num_keys, self.grid_size, 4), np.int64)
+            with numba_threads(num_threads or 1):
+                _truncate_likelihoods(
+                    self.unfixed_likelihoods,
+                    self.row_indices[0],
+                    self.likelihood_threshold,
+                    self.probability_space == LOG_GRID,
+                    self.unfixed_bands,
+                )
+
+    def likelihood_bands(self):
+        """
+        Return the bands of significant entries in the precalculated likelihoods,
+        as an array with one ``(grid_size, 4)`` array for each row of
+        ``unfixed_likelihoods``. Entry ``[k, 0:2]`` of each gives the range of
+        child times in row ``k`` of the lower triangular matrix, and
+        ``[k, 2:4]`` the range of parent times in column ``k``. The array is
+        empty if no ``likelihood_threshold`` has been set.
+        """
+        if self.likelihood_threshold is None or self.mut_rate is None:
+            return np.empty((0, self.grid_size, 4), np.int64)
+        assert hasattr(
+            self, "unfixed_bands"
+        ), "Must call `precalculate_mutation_likelihoods()` before getting bands"
+        return self.unfixed_bands
+
+    def _fill_likelihoods(self, rows, out, num_threads):
+        # Calculate the likelihoods for the given rows of the unfixed keys into out
+        chunk_size = max(1, self.keys_per_chunk)
+        with numba_threads(num_threads or 1):
+            with tqdm(
+                total=rows.size,
                 disable=not self.progress,
                 desc="Precalculating Likelihoods",
-            ):
-                self.unfixed_likelihood_cache[muts, span] = self._lik(
-                    muts,
-                    span,
-                    dt=self.timediff_lower_tri,
-                    mutation_rate=self.mut_rate,
-                    standardize=self.standardize,
+            ) as prog_bar:
+                for start in range(0, rows.size, chunk_size):
+                    stop = min(start + chunk_size, rows.size)
+                    keys = self.unfixed_keys[rows[start:stop]]
+                    _mutation_likelihoods(
+                        keys["muts"],
+                        keys["span"],
+                        self.timediff_lower_tri,
+                        self.mut_rate,
+                        self.probability_space == LOG_GRID,
+                        self.standardize,
+                        out[start:stop],
+                    )
+                    prog_bar.update(stop - start)
+
+    def likelihood_cache_file(self):
+        """
+        The file in which the likelihoods for the current timepoints, mutation rate,
+        ``eps``, standardization and probability space are cached on disk
+        """
+        digest = hashlib.sha256()
+        digest.update(np.ascontiguousarray(self.timediff_lower_tri, np.float64))
+        digest.update(
+            repr(
+                (float(self.mut_rate), bool(self.standardize), self.probability_space)
+            ).encode()
+        )
+        return likelihood_cache_dir() / f"{digest.hexdigest()[:32]}.npz"
+
+    def _load_cached_likelihoods(self):
+        # Return the sorted keys and likelihoods cached on disk, or None
+        path = self.likelihood_cache_file()
+        try:
+            with np.load(path) as data:
+                keys = np.rec.fromarrays((data["muts"], data["span"]), names="muts,span")
+                likelihoods = data["likelihoods"]
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as err:
+            logger.warning(f"Ignoring unreadable likelihood cache {path}: {err}")
+            return None
+        if keys.size == 0 or likelihoods.shape != (keys.size, int(self.tri_size)):
+            return None
+        return keys, likelihoods
+
+    def _save_cached_likelihoods(self, cached):
+        # Merge the current likelihoods with any previously cached and save them,
+        # replacing the file atomically so that it can be shared between processes
+        keys, likelihoods = self.unfixed_keys, self.unfixed_likelihoods
+        if cached is not None:
+            keys, index = np.unique(np.concatenate((keys, cached[0])), return_index=True)
+            likelihoods = np.concatenate((likelihoods, cached[1]))[index]
+        if likelihoods.nbytes > LIKELIHOOD_CACHE_MAX_BYTES:
+            logger.info("Mutation likelihoods are too large to cache")
+            return
+        path = self.likelihood_cache_file()
+        tmp_name = None
+        try:
+            os.makedirs(path.parent, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                dir=path.parent, suffix=".tmp", delete=False
+            ) as file:
+                tmp_name = file.name
+                np.savez(
+                    file, muts=keys["muts"], span=keys["span"], likelihoods=likelihoods
                 )
+            os.replace(tmp_name, path)
+        except OSError as err:
+            logger.warning(f"Could not save mutation likelihoods to {path}: {err}")
+            if tmp_name is not None and os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            return
+        logger.info(f"Saved {keys.size} mutation likelihoods to {path}")
+        _prune_likelihood_cache(path.parent, LIKELIHOOD_CACHE_MAX_BYTES)
+
+    def unfixed_rows(self, mutations, spans):
+        """
+        Return the rows of the precalculated ``unfixed_likelihoods`` array for
+        edges with the given numbers of mutations and spans
+        """
+        keys = np.rec.fromarrays(
+            (np.atleast_1d(mutations), np.atleast_1d(spans)), names="muts,span"
+        )
+        rows = np.searchsorted(self.unfixed_keys, keys)
+        assert np.all(rows < self.unfixed_keys.size), "Likelihood not precalculated"
+        assert np.all(self.unfixed_keys[rows] == keys), "Likelihood not precalculated"
+        return rows
 
     def get_mut_lik_fixed_node(self, edge):
         """
@@ -239,11 +406,11 @@ class Likelihoods:
             edge.child not in self.fixednodes
         ), "Wrongly called lower_tri function on fixed node"
         assert hasattr(
-            self, "unfixed_likelihood_cache"
+            self, "unfixed_likelihoods"
         ), "Must call `precalculate_mutation_likelihoods()` before getting likelihoods"
 
-        mutations_on_edge = self.mut_edges[edge.id]
-        return self.unfixed_likelihood_cache[mutations_on_edge, edge.span]
+        (row,) = self.unfixed_rows(self.mut_edges[edge.id], edge.span)
+        return self.unfixed_likelihoods[row]
 
     def get_mut_lik_upper_tri(self, edge):
         """
@@ -253,6 +420,45 @@ class Likelihoods:
         """
         return self.get_mut_lik_lower_tri(edge)[np.concatenate(self.row_indices)]
 
+    def edge_likelihoods(self):
+        """
+        Return the mutation likelihoods for every edge as arrays, for use in
+        compiled code. Returns a tuple of ``(edges_lik, unfixed, fixed)``, where
+        ``unfixed`` holds the cached flattened lower triangular likelihoods for
+        edges with non-fixed children (one row per distinct number of mutations
+        and span) and ``fixed`` holds the likelihoods for edges whose child is
+        at a fixed time (one row per edge). ``edges_lik`` gives the row for each
+        edge in ``unfixed`` or ``fixed`` depending on the child, or -1 if no
+        mutation rate has been set.
+        """
+        edges_lik = np.full(self.ts.num_edges, -1, dtype=np.int64)
+        tri_size = int(self.tri_size)
+        if self.mut_rate is None:
+            return (
+                edges_lik,
+                np.empty((0, tri_size)),
+                np.empty((0, self.grid_size)),
+            )
+        assert hasattr(
+            self, "unfixed_likelihoods"
+        ), "Must call `precalculate_mutation_likelihoods()` before getting likelihoods"
+        span = self.ts.edges_right - self.ts.edges_left
+        is_fixed = np.logical_not(self.unfixed_edges())
+        assert np.all(self.ts.nodes_time[self.ts.edges_child[is_fixed]] == 0)
+        edges_lik[~is_fixed] = self.unfixed_rows(
+            self.mut_edges[~is_fixed], span[~is_fixed]
+        )
+        unfixed_lik = self.unfixed_likelihoods
+        edges_lik[is_fixed] = np.arange(np.sum(is_fixed))
+        fixed_lik = self._lik(
+            self.mut_edges[is_fixed, np.newaxis],
+            span[is_fixed, np.newaxis],
+            self.timediff,
+            self.mut_rate,
+            standardize=self.standardize,
+        )
+        return edges_lik, unfixed_lik, fixed_lik
+
     # The following functions don't access the likelihoods directly, but allow
     # other input arrays of length grid_size to be repeated in such a way that they can
     # be directly multiplied by the unpacked lower triangular matrix, or arrays of length
@@ -390,19 +596,10 @@ class LogLikelihoods(Likelihoods):
         """
         ll = scipy.stats.poisson.logpmf(muts, dt * mutation_rate * span)
         if standardize:
-            return ll - np.max(ll)
+            return ll - np.max(ll, axis=-1, keepdims=True)
         else:
             return ll
 
-    @staticmethod
-    def _lik_wrapper(muts_span, dt, mutation_rate, standardize=True):
-        """
-        Needs redefining to refer to the LogLikelihoods class
-        """
-        return muts_span, LogLikelihoods._lik(
-            muts_span[0], muts_span[1], dt, mutation_rate, standardize=standardize
-        )
-
     def rowsum_lower_tri(self, input_array):
         """
         The function below is equivalent to (but numba makes it faster than)
@@ -489,12 +686,402 @@ class LogLikelihoods(Likelihoods):
         return fraction * value
 
 
+@numba_jit(parallel=True, error_model="numpy")
+def _truncate_likelihoods(lik, lower_tri_offsets, threshold, log_space, bands):
+    """
+    Set the entries of each row of the flattened lower triangular likelihoods
+    ``lik`` that are less than ``threshold`` times the maximum of the row to
+    zero, storing the range of remaining entries in each row and column in
+    ``bands`` (as described in :meth:`Likelihoods.likelihood_bands`).
+    """
+    grid_size = lower_tri_offsets.size
+    null = -np.inf if log_space else 0.0
+    for i in prange(lik.shape[0]):
+        row = lik[i]
+        band = bands[i]
+        for k in range(grid_size):
+            band[k, 2] = grid_size
+            band[k, 3] = 0
+        for k in range(grid_size):
+            offset = lower_tri_offsets[k]
+            max_val = np.max(row[offset : offset + k + 1])
+            cutoff = max_val + np.log(threshold) if log_space else max_val * threshold
+            # The likelihood is unimodal in the time difference, so the entries
+            # that remain are contiguous
+            lo = 0
+            while lo < k and row[offset + lo] < cutoff:
+                lo += 1
+            hi = k + 1
+            while hi > lo + 1 and row[offset + hi - 1] < cutoff:
+                hi -= 1
+            row[offset : offset + lo] = null
+            row[offset + hi : offset + k + 1] = null
+            band[k, 0] = lo
+            band[k, 1] = hi
+            for j in range(lo, hi):
+                band[j, 2] = min(band[j, 2], k)
+                band[j, 3] = max(band[j, 3], k + 1)
+
+
+@numba_jit(error_model="numpy")
+def _rowsum_lower_tri(daughter, lik, lower_tri_offsets, log_space, out, band):
+    """
+    Repeat ``daughter`` over the rows of a flattened lower triangular matrix,
+    combine it with the likelihoods ``lik`` (treated as the identity if empty)
+    and store the sum of each row in ``out``. In log space, values are added
+    and rows are summed using a streaming logsumexp. If ``band`` is not empty,
+    only the entries in the band of each row are summed.
+    """
+    for k in range(out.size):
+        offset = lower_tri_offsets[k]
+        lo, hi = (band[k, 0], band[k, 1]) if band.shape[0] else (0, k + 1)
+        if log_space:
+            alpha = -np.inf
+            r = 0.0
+            for j in range(lo, hi):
+                x = daughter[j] + (lik[offset + j] if lik.size else 0.0)
+                if x != -np.inf:
+                    if x <= alpha:
+                        r += np.exp(x - alpha)
+                    else:
+                        r *= np.exp(alpha - x)
+                        r += 1.0
+                        alpha = x
+            out[k] = -np.inf if r == 0 else np.log(r) + alpha
+        else:
+            total = 0.0
+            for j in range(lo, hi):
+                total += daughter[j] * (lik[offset + j] if lik.size else 1.0)
+            out[k] = total
+
+
+@numba_jit(error_model="numpy")
+def _rowsum_upper_tri(parent, lik, lower_tri_offsets, log_space, out, band):
+    """
+    Repeat ``parent`` over the rows of a flattened upper triangular matrix,
+    combine it with the transpose of the flattened lower triangular likelihoods
+    ``lik`` (treated as the identity if empty) and store the sum of each row in
+    ``out``, as in :func:`_rowsum_lower_tri`.
+    """
+    for k in range(out.size):
+        lo, hi = (band[k, 2], band[k, 3]) if band.shape[0] else (k, out.size)
+        if log_space:
+            alpha = -np.inf
+            r = 0.0
+            for j in range(lo, hi):
+                x = parent[j] + (lik[lower_tri_offsets[j] + k] if lik.size else 0.0)
+                if x != -np.inf:
+                    if x <= alpha:
+                        r += np.exp(x - alpha)
+                    else:
+                        r *= np.exp(alpha - x)
+                        r += 1.0
+                        alpha = x
+            out[k] = -np.inf if r == 0 else np.log(r) + alpha
+        else:
+            total = 0.0
+            for j in range(lo, hi):
+                total += parent[j] * (lik[lower_tri_offsets[j] + k] if lik.size else 1.0)
+            out[k] = total
+
+
+@numba_jit(error_model="numpy")
+def _inside_pass(
+    start,
+    stop,
+    parent_offsets,
+    edges_parent,
+    edges_child,
+    edges_spanfrac,
+    edges_lik,
+    row_lookup,
+    prior_grid,
+    inside_grid,
+    inside_fixed,
+    unfixed_lik,
+    fixed_lik,
+    unfixed_bands,
+    lower_tri_offsets,
+    denominator,
+    g_i,
+    log_space,
+    standardize,
+    cache_inside,
+):
+    """
+    Run the inside algorithm on the groups of edges with the same parent from
+    ``start`` to ``stop``, where group ``i`` is given by the edges from
+    ``parent_offsets[i]`` to ``parent_offsets[i + 1]``. Operates in linear or
+    (if ``log_space`` is true) logarithmic space, updating ``inside_grid``,
+    ``denominator`` and (if ``cache_inside`` is true) ``g_i`` in place, and
+    returning the product of the denominators.
+    """
+    grid_size = prior_grid.shape[1]
+    identity = 0.0 if log_space else 1.0
+    use_lik = unfixed_lik.shape[0] + fixed_lik.shape[0] > 0
+    use_bands = unfixed_bands.shape[0] > 0
+    no_lik = np.empty(0)
+    no_band = np.empty((0, 4), np.int64)
+    marginal_lik = identity
+    val = np.empty(grid_size)
+    edge_lik = np.empty(grid_size)
+    daughter = np.empty(grid_size)
+    for i in range(start, stop):
+        parent = edges_parent[parent_offsets[i]]
+        parent_row = row_lookup[parent]
+        if parent_row < 0:
+            continue  # there is no hidden state for this parent - it's fixed
+        val[:] = prior_grid[parent_row]
+        for e in range(parent_offsets[i], parent_offsets[i + 1]):
+            child_row = row_lookup[edges_child[e]]
+            spanfrac = edges_spanfrac[e]
+            if child_row < 0:
+                # NB: geometric scaling works exactly when all nodes fixed in graph
+                # but is an approximation when times are unknown.
+                value = inside_fixed[1 + child_row]
+                value = spanfrac * value if log_space else value**spanfrac
+                for j in range(grid_size):
+                    lik = fixed_lik[edges_lik[e], j] if use_lik else identity
+                    edge_lik[j] = value + lik if log_space else value * lik
+            else:
+                if np.all(np.isnan(inside_grid[child_row])):
+                    # Child has not been visited. Either our edge order is wrong
+                    # (bug) or we have hit a dangling node
+                    raise ValueError(
+                        "The input tree sequence includes "
+                        "dangling nodes: please simplify it"
+                    )
+                for j in range(grid_size):
+                    value = inside_grid[child_row, j]
+                    daughter[j] = spanfrac * value if log_space else value**spanfrac
+                lik = unfixed_lik[edges_lik[e]] if use_lik else no_lik
+                band = unfixed_bands[edges_lik[e]] if use_bands else no_band
+                _rowsum_lower_tri(
+                    daughter, lik, lower_tri_offsets, log_space, edge_lik, band
+                )
+            for j in range(grid_size):
+                val[j] = val[j] + edge_lik[j] if log_space else val[j] * edge_lik[j]
+            if cache_inside:
+                g_i[e] = edge_lik
+        denominator[parent] = np.max(val) if standardize else identity
+        for j in range(grid_size):
+            if log_space:
+                inside_grid[parent_row, j] = val[j] - denominator[parent]
+            else:
+                inside_grid[parent_row, j] = val[j] / denominator[parent]
+        if standardize:
+            if log_space:
+                marginal_lik += denominator[parent]
+            else:
+                marginal_lik *= denominator[parent]
+    return marginal_lik
+
+
+@numba_jit(error_model="numpy")
+def _outside_pass(
+    start,
+    stop,
+    child_offsets,
+    edges_order,
+    edges_parent,
+    edges_child,
+    edges_spanfrac,
+    edges_lik,
+    row_lookup,
+    inside_grid,
+    outside_grid,
+    unfixed_lik,
+    unfixed_bands,
+    lower_tri_offsets,
+    denominator,
+    g_i,
+    log_space,
+    standardize,
+    ignore_parent,
+):
+    """
+    Run the outside algorithm on the groups of edges with the same child from
+    ``start`` to ``stop``, where group ``i`` is given by the edges
+    ``edges_order[child_offsets[i]:child_offsets[i + 1]]``, updating
+    ``outside_grid`` in place. If ``g_i`` is empty, the inside values for each
+    edge are recalculated rather than taken from ``g_i``. Edges to
+    ``ignore_parent`` are skipped.
+    """
+    grid_size = inside_grid.shape[1]
+    identity = 0.0 if log_space else 1.0
+    null = -np.inf if log_space else 0.0
+    use_lik = unfixed_lik.shape[0] > 0
+    use_bands = unfixed_bands.shape[0] > 0
+    cache_inside = g_i.shape[0] > 0
+    no_lik = np.empty(0)
+    no_band = np.empty((0, 4), np.int64)
+    val = np.empty(grid_size)
+    edge_lik = np.empty(grid_size)
+    daughter = np.empty(grid_size)
+    parent_val = np.empty(grid_size)
+    for i in range(start, stop):
+        child = edges_child[edges_order[child_offsets[i]]]
+        child_row = row_lookup[child]
+        if child_row < 0:
+            continue
+        val[:] = identity
+        for e in edges_order[child_offsets[i] : child_offsets[i + 1]]:
+            parent = edges_parent[e]
+            if parent == ignore_parent:
+                continue
+            parent_row = row_lookup[parent]
+            if parent_row < 0:
+                raise RuntimeError("Fixed nodes cannot currently be parents in the TS")
+            # Geometric scaling works exactly for all nodes fixed in graph
+            # but is an approximation when times are unknown.
+            spanfrac = edges_spanfrac[e]
+            lik = unfixed_lik[edges_lik[e]] if use_lik else no_lik
+            band = unfixed_bands[edges_lik[e]] if use_bands else no_band
+            if cache_inside:
+                edge_lik[:] = g_i[e]
+            else:  # we haven't cached g_i so we recalculate
+                for j in range(grid_size):
+                    value = inside_grid[child_row, j]
+                    daughter[j] = spanfrac * value if log_space else value**spanfrac
+                _rowsum_lower_tri(
+                    daughter, lik, lower_tri_offsets, log_space, edge_lik, band
+                )
+                for j in range(grid_size):
+                    if log_space:
+                        edge_lik[j] -= denominator[child]
+                    else:
+                        edge_lik[j] /= denominator[child]
+            for j in range(grid_size):
+                inside = inside_grid[parent_row, j]
+                if log_space:
+                    inside_div_gi = inside - edge_lik[j]
+                else:
+                    inside_div_gi = inside / edge_lik[j]
+                if np.isnan(inside_div_gi):
+                    inside_div_gi = null
+                if log_space:
+                    value = spanfrac * (outside_grid[parent_row, j] + inside_div_gi)
+                else:
+                    value = (outside_grid[parent_row, j] * inside_div_gi) ** spanfrac
+                parent_val[j] = value
+            if standardize:
+                max_val = np.max(parent_val)
+                for j in range(grid_size):
+                    if log_space:
+                        parent_val[j] -= max_val
+                    else:
+                        parent_val[j] /= max_val
+            _rowsum_upper_tri(
+                parent_val, lik, lower_tri_offsets, log_space, edge_lik, band
+            )
+            for j in range(grid_size):
+                val[j] = val[j] + edge_lik[j] if log_space else val[j] * edge_lik[j]
+        assert denominator[child] > null
+        norm = np.max(val) if standardize else denominator[child]
+        for j in range(grid_size):
+            if log_space:
+                outside_grid[child_row, j] = val[j] - norm
+            else:
+                outside_grid[child_row, j] = val[j] / norm
+
+
+@numba_jit
+def _poisson_loglik(muts, mu):
+    # The Poisson log probability, as in scipy.stats.poisson.logpmf
+    if muts == 0:
+        return -mu
+    return muts * np.log(mu) - mu - math.lgamma(muts + 1)
+
+
+@numba_jit(parallel=True, error_model="numpy")
+def _mutation_likelihoods(muts, span, dt, mutation_rate, log_space, standardize, out):
+    # Fill each row of ``out`` with the likelihoods of an edge with the given number
+    # of mutations and span over the time differences ``dt``, in parallel over rows
+    for k in prange(muts.size):
+        row = out[k]
+        for i in range(dt.size):
+            row[i] = _poisson_loglik(muts[k], dt[i] * mutation_rate * span[k])
+        if log_space:
+            if standardize:
+                row -= np.max(row)
+        else:
+            for i in range(dt.size):
+                row[i] = np.exp(row[i])
+            if standardize:
+                row /= np.max(row)
+
+
+@numba_jit(error_model="numpy")
+def _outside_maximization(
+    start,
+    stop,
+    child_offsets,
+    edges_order,
+    edges_parent,
+    edges_child,
+    edges_span,
+    mut_edges,
+    row_lookup,
+    inside_grid,
+    timepoints,
+    mutation_rate,
+    eps,
+    log_space,
+    maximized_node_times,
+):
+    """
+    Find the most likely time for the child of each group of edges from
+    ``start`` to ``stop`` (grouped as in :func:`_outside_pass`, in decreasing
+    order of child time), given the most likely times of its parents, updating
+    ``maximized_node_times`` in place.
+    """
+    result = np.empty(timepoints.size)
+    ll_mut = np.empty(timepoints.size)
+    for i in range(start, stop):
+        group = edges_order[child_offsets[i] : child_offsets[i + 1]]
+        child_row = row_lookup[edges_child[group[0]]]
+        if child_row < 0:
+            continue
+        # The child must be younger than its youngest parent
+        youngest_par_index = timepoints.size
+        for e in group:
+            youngest_par_index = min(
+                youngest_par_index, maximized_node_times[edges_parent[e]]
+            )
+        num_times = youngest_par_index + 1
+        result[:num_times] = 0.0 if log_space else 1.0
+        for e in group:
+            parent_time = timepoints[maximized_node_times[edges_parent[e]]]
+            for j in range(num_times):
+                mu = (parent_time - timepoints[j] + eps) * mutation_rate * edges_span[e]
+                ll_mut[j] = _poisson_loglik(mut_edges[e], mu)
+            max_ll = np.max(ll_mut[:num_times])
+            for j in range(num_times):
+                if log_space:
+                    result[j] += ll_mut[j] - max_ll
+                else:
+                    result[j] *= np.exp(ll_mut[j]) / np.exp(max_ll)
+        for j in range(num_times):
+            if log_space:
+                result[j] += inside_grid[child_row, j]
+            else:
+                result[j] *= inside_grid[child_row, j]
+        maximized_node_times[edges_child[group[0]]] = np.argmax(result[:num_times])
+
+
 class BeliefPropagation:
     """
     The class that encapsulates running exact belief propagation models,
     in particular the discrete-time inside and outside algorithms.
     """
 
+    # The number of parent nodes processed by each call to compiled code, which
+    # sets how often the progress bar is updated
+    parents_per_chunk = 10000
+    # The number of rows of the (possibly memory-mapped) edge and node grids that
+    # are processed at once in numpy, which bounds the size of temporary arrays
+    rows_per_chunk = 100000
+
     def __init__(self, priors, lik, *, progress=False):
         if (
             lik.fixednodes.intersection(priors.nonfixed_nodes)
@@ -584,6 +1171,22 @@ class BeliefPropagation:
         else:
             return sorted_child_parent
 
+    def edges_by_child_desc_offsets(self):
+        # Return the order of edges grouped by child in descending order of the time
+        # of the child, as for edges_by_child_desc(), together with the offsets of
+        # the start of each group
+        edges_order = np.lexsort(
+            (self.ts.edges_child, -self.ts.nodes_time[self.ts.edges_child])
+        )
+        child_offsets = np.concatenate(
+            (
+                [0],
+                np.flatnonzero(np.diff(self.ts.edges_child[edges_order])) + 1,
+                [self.ts.num_edges],
+            )
+        )[: 1 if self.ts.num_edges == 0 else None]
+        return edges_order, child_offsets
+
     # === MAIN ALGORITHMS ===
 
     def inside_pass(self, *, standardize=True, cache_inside=False, progress=None):
@@ -593,61 +1196,73 @@ class BeliefPropagation:
         inside = self.priors.clone_with_new_data(  # store inside matrix values
             grid_data=np.nan, fixed_data=self.lik.identity_constant
         )
+        # Store the edge values in the same way as the node grids
+        grid_dtype = inside.grid_data.dtype
         if cache_inside:
-            g_i = np.full(
-                (self.ts.num_edges, self.lik.grid_size), self.lik.identity_constant
+            g_i = allocate_grid(
+                (self.ts.num_edges, self.lik.grid_size), grid_dtype, inside.memmap_dir
             )
+            g_i.fill(self.lik.identity_constant)
         denominator = np.full(self.ts.num_nodes, np.nan)
         assert (
             self.lik.standardize is False
         ), "Marginal likelihood requires unstandardized mutation likelihoods"
+        if self.lik.rec_rate is not None:
+            self.lik._recombination_lik(None)
         marginal_lik = self.lik.identity_constant
-        # Iterate through the nodes via groupby on parent node
-        for parent, edges in tqdm(
-            self.edges_by_parent_asc(),
+        # Edges are grouped by parent, in nondecreasing order of parent time
+        edges_parent = self.ts.edges_parent
+        parent_offsets = np.concatenate(
+            ([0], np.flatnonzero(np.diff(edges_parent)) + 1, [self.ts.num_edges])
+        )[: 1 if self.ts.num_edges == 0 else None]
+        spans = self.ts.edges_right - self.ts.edges_left
+        edges_spanfrac = spans / self.spans[self.ts.edges_child]
+        edges_lik, unfixed_lik, fixed_lik = self.lik.edge_likelihoods()
+        unfixed_bands = self.lik.likelihood_bands()
+        # reused by the outside pass
+        self.edges_lik = (edges_lik, unfixed_lik, unfixed_bands)
+        if not cache_inside:
+            g_i = np.empty((0, self.lik.grid_size), dtype=grid_dtype)
+        num_groups = len(parent_offsets) - 1
+        is_nonfixed = inside.row_lookup[edges_parent[parent_offsets[:-1]]] >= 0
+        with tqdm(
             desc="Inside",
             total=inside.num_nonfixed,
             disable=not progress,
-        ):
-            """
-            for each node, find the conditional prob of age at every time
-            in time grid
-            """
-            if parent in self.fixednodes:
-                continue  # there is no hidden state for this parent - it's fixed
-            val = self.priors[parent].copy()
-            for edge in edges:
-                spanfrac = edge.span / self.spans[edge.child]
-                # Calculate vals for each edge
-                if edge.child in self.fixednodes:
-                    # NB: geometric scaling works exactly when all nodes fixed in graph
-                    # but is an approximation when times are unknown.
-                    daughter_val = self.lik.scale_geometric(spanfrac, inside[edge.child])
-                    edge_lik = self.lik.get_fixed(daughter_val, edge)
-                else:
-                    inside_values = inside[edge.child]
-                    if np.ndim(inside_values) == 0 or np.all(np.isnan(inside_values)):
-                        # Child appears fixed, or we have not visited it. Either our
-                        # edge order is wrong (bug) or we have hit a dangling node
-                        raise ValueError(
-                            "The input tree sequence includes "
-                            "dangling nodes: please simplify it"
-                        )
-                    daughter_val = self.lik.scale_geometric(
-                        spanfrac, self.lik.make_lower_tri(inside[edge.child])
-                    )
-                    edge_lik = self.lik.get_inside(daughter_val, edge)
-                val = self.lik.combine(val, edge_lik)
-                if cache_inside:
-                    g_i[edge.id] = edge_lik
-            denominator[parent] = (
-                np.max(val) if standardize else self.lik.identity_constant
-            )
-            inside[parent] = self.lik.ratio(val, denominator[parent])
-            if standardize:
-                marginal_lik = self.lik.combine(marginal_lik, denominator[parent])
+        ) as pbar:
+            for start in range(0, num_groups, self.parents_per_chunk):
+                stop = min(start + self.parents_per_chunk, num_groups)
+                chunk_lik = _inside_pass(
+                    start,
+                    stop,
+                    parent_offsets,
+                    edges_parent,
+                    self.ts.edges_child,
+                    edges_spanfrac,
+                    edges_lik,
+                    inside.row_lookup,
+                    self.priors.grid_data,
+                    inside.grid_data,
+                    inside.fixed_data,
+                    unfixed_lik,
+                    fixed_lik,
+                    unfixed_bands,
+                    self.lik.row_indices[0],
+                    denominator,
+                    g_i,
+                    self.lik.probability_space == LOG_GRID,
+                    standardize,
+                    cache_inside,
+                )
+                marginal_lik = self.lik.combine(marginal_lik, chunk_lik)
+                pbar.update(np.sum(is_nonfixed[start:stop]))
         if cache_inside:
-            self.g_i = self.lik.ratio(g_i, denominator[self.ts.edges_child, None])
+            for start in range(0, self.ts.num_edges, self.rows_per_chunk):
+                chunk = slice(start, start + self.rows_per_chunk)
+                g_i[chunk] = self.lik.ratio(
+                    g_i[chunk], denominator[self.ts.edges_child[chunk], None]
+                )
+            self.g_i = g_i
         # Keep the results in this object
         self.inside = inside
         self.denominator = denominator
@@ -684,60 +1299,48 @@ class BeliefPropagation:
             outside[root] = span_when_root / self.spans[root]
         outside.force_probability_space(self.inside.probability_space)
 
-        for child, edges in tqdm(
-            self.edges_by_child_desc(),
-            desc="Outside",
-            total=len(np.unique(self.ts.edges_child)),
-            disable=not progress,
-        ):
-            if child in self.fixednodes:
-                continue
-            val = np.full(self.lik.grid_size, self.lik.identity_constant)
-            for edge in edges:
-                if ignore_oldest_root:
-                    if edge.parent == self.ts.num_nodes - 1:
-                        continue
-                if edge.parent in self.fixednodes:
-                    raise RuntimeError(
-                        "Fixed nodes cannot currently be parents in the TS"
-                    )
-                # Geometric scaling works exactly for all nodes fixed in graph
-                # but is an approximation when times are unknown.
-                spanfrac = edge.span / self.spans[child]
-                try:
-                    inside_div_gi = self.lik.ratio(
-                        self.inside[edge.parent], self.g_i[edge.id], div_0_null=True
-                    )
-                except AttributeError:  # we haven't cached g_i so we recalculate
-                    daughter_val = self.lik.scale_geometric(
-                        spanfrac, self.lik.make_lower_tri(self.inside[edge.child])
-                    )
-                    edge_lik = self.lik.get_inside(daughter_val, edge)
-                    cur_g_i = self.lik.ratio(edge_lik, self.denominator[child])
-                    inside_div_gi = self.lik.ratio(
-                        self.inside[edge.parent], cur_g_i, div_0_null=True
-                    )
-                parent_val = self.lik.scale_geometric(
-                    spanfrac,
-                    self.lik.make_upper_tri(
-                        self.lik.combine(outside[edge.parent], inside_div_gi)
-                    ),
+        edges_order, child_offsets = self.edges_by_child_desc_offsets()
+        spans = self.ts.edges_right - self.ts.edges_left
+        edges_spanfrac = spans / self.spans[self.ts.edges_child]
+        edges_lik, unfixed_lik, unfixed_bands = self.edges_lik
+        g_i = getattr(
+            self, "g_i", np.empty((0, self.lik.grid_size), dtype=outside.grid_data.dtype)
+        )
+        num_groups = len(child_offsets) - 1
+        with tqdm(desc="Outside", total=num_groups, disable=not progress) as pbar:
+            for start in range(0, num_groups, self.parents_per_chunk):
+                stop = min(start + self.parents_per_chunk, num_groups)
+                _outside_pass(
+                    start,
+                    stop,
+                    child_offsets,
+                    edges_order,
+                    self.ts.edges_parent,
+                    self.ts.edges_child,
+                    edges_spanfrac,
+                    edges_lik,
+                    outside.row_lookup,
+                    self.inside.grid_data,
+                    outside.grid_data,
+                    unfixed_lik,
+                    unfixed_bands,
+                    self.lik.row_indices[0],
+                    self.denominator,
+                    g_i,
+                    self.lik.probability_space == LOG_GRID,
+                    standardize,
+                    self.ts.num_nodes - 1 if ignore_oldest_root else tskit.NULL,
                 )
-                if standardize:
-                    parent_val = self.lik.ratio(parent_val, np.max(parent_val))
-                edge_lik = self.lik.get_outside(parent_val, edge)
-                val = self.lik.combine(val, edge_lik)
-
-            # vv[0] = 0  # Seems a hack: internal nodes should be allowed at time 0
-            assert self.denominator[edge.child] > self.lik.null_constant
-            outside[child] = self.lik.ratio(val, self.denominator[child])
-            if standardize:
-                outside[child] = self.lik.ratio(val, np.max(val))
+                pbar.update(stop - start)
         self.outside = outside  # useful to access for testing purposes
-        self.posterior_grid = outside.clone_with_new_data(
-            grid_data=self.lik.combine(self.inside.grid_data, outside.grid_data),
-            fixed_data=np.nan,
-        )  # NB: we should never use the posterior for a fixed node
+        # NB: we should never use the posterior for a fixed node
+        posterior = outside.clone_with_new_data(fixed_data=np.nan)
+        for start in range(0, posterior.num_nonfixed, self.rows_per_chunk):
+            chunk = slice(start, start + self.rows_per_chunk)
+            posterior.grid_data[chunk] = self.lik.combine(
+                self.inside.grid_data[chunk], outside.grid_data[chunk]
+            )
+        self.posterior_grid = posterior
 
     def node_posteriors(self):
         """
@@ -767,70 +1370,37 @@ class BeliefPropagation:
             raise RuntimeError("You have not yet run the inside algorithm")
 
         maximized_node_times = np.zeros(self.ts.num_nodes, dtype="int")
-
-        if self.lik.probability_space == LOG_GRID:
-            poisson = scipy.stats.poisson.logpmf
-        elif self.lik.probability_space == LIN_GRID:
-            poisson = scipy.stats.poisson.pmf
-
-        mut_edges = self.lik.mut_edges
         mrcas = np.where(
             np.isin(np.arange(self.ts.num_nodes), self.ts.edges_child, invert=True)
         )[0]
-        for i in mrcas:
-            if i not in self.fixednodes:
-                maximized_node_times[i] = np.argmax(self.inside[i])
-
-        for child, edges in tqdm(
-            self.edges_by_child_then_parent_desc(),
-            desc="Maximization",
-            total=len(np.unique(self.ts.edges_child)),
-            disable=not progress,
-        ):
-            if child in self.fixednodes:
-                continue
-            for edge_index, edge in enumerate(edges):
-                if edge_index == 0:
-                    youngest_par_index = maximized_node_times[edge.parent]
-                    parent_time = self.lik.timepoints[maximized_node_times[edge.parent]]
-                    ll_mut = poisson(
-                        mut_edges[edge.id],
-                        (
-                            parent_time
-                            - self.lik.timepoints[: youngest_par_index + 1]
-                            + eps
-                        )
-                        * self.lik.mut_rate
-                        * edge.span,
-                    )
-                    result = self.lik.ratio(ll_mut, np.max(ll_mut))
-                else:
-                    cur_parent_index = maximized_node_times[edge.parent]
-                    if cur_parent_index < youngest_par_index:
-                        youngest_par_index = cur_parent_index
-                    parent_time = self.lik.timepoints[maximized_node_times[edge.parent]]
-                    ll_mut = poisson(
-                        mut_edges[edge.id],
-                        (
-                            parent_time
-                            - self.lik.timepoints[: youngest_par_index + 1]
-                            + eps
-                        )
-                        * self.lik.mut_rate
-                        * edge.span,
-                    )
-                    result[: youngest_par_index + 1] = self.lik.combine(
-                        self.lik.ratio(
-                            ll_mut[: youngest_par_index + 1],
-                            np.max(ll_mut[: youngest_par_index + 1]),
-                        ),
-                        result[: youngest_par_index + 1],
-                    )
-            inside_val = self.inside[child][: (youngest_par_index + 1)]
+        rows = self.inside.row_lookup[mrcas]
+        maximized_node_times[mrcas[rows >= 0]] = np.argmax(
+            self.inside.grid_data[rows[rows >= 0]], axis=1
+        )
 
-            maximized_node_times[child] = np.argmax(
-                self.lik.combine(result[: youngest_par_index + 1], inside_val)
-            )
+        edges_order, child_offsets = self.edges_by_child_desc_offsets()
+        num_groups = len(child_offsets) - 1
+        with tqdm(desc="Maximization", total=num_groups, disable=not progress) as pbar:
+            for start in range(0, num_groups, self.parents_per_chunk):
+                stop = min(start + self.parents_per_chunk, num_groups)
+                _outside_maximization(
+                    start,
+                    stop,
+                    child_offsets,
+                    edges_order,
+                    self.ts.edges_parent,
+                    self.ts.edges_child,
+                    self.ts.edges_right - self.ts.edges_left,
+                    self.lik.mut_edges,
+                    self.inside.row_lookup,
+                    self.inside.grid_data,
+                    self.lik.timepoints,
+                    self.lik.mut_rate,
+                    eps,
+                    self.lik.probability_space == LOG_GRID,
+                    maximized_node_times,
+                )
+                pbar.update(stop - start)
         # The outside_maximization method does not provide a full posterior but
         # simply the means of the posterior distributions
         self.posterior_mean = self.lik.timepoints[
@@ -0,0 +1,144 @@
+# MIT License
+#
+# Copyright (c) 2024 Tskit Developers
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Timings and counters for the stages of a dating run
+"""
+
+import contextlib
+import json
+import math
+import sys
+import time
+
+from .provenance import __version__
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None  # e.g. on Windows
+
+
+def peak_rss():
+    """
+    Return the peak resident set size of the current process in bytes, or
+    ``None`` if this is not available on the current platform.
+    """
+    if resource is None:  # pragma: no cover
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Instrumentation:
+    """
+    Records the wall time and peak memory usage of each stage of a dating run,
+    together with counts (such as the number of skipped edges) and metrics per
+    iteration (such as the change in posteriors used to assess convergence).
+    An instance is passed to the ``instrumentation_callback`` of :func:`date`
+    once dating has finished, and is available as the ``instrumentation``
+    attribute of the fit object for the ``variational_gamma`` method.
+
+    .. note:: Peak memory usage is that of the whole process up to the end of
+        each stage, so it never decreases from one stage to the next. It
+        excludes any worker processes.
+    """
+
+    def __init__(self, method=None):
+        self.method = method
+        #: A dictionary mapping the name of each stage to a dictionary containing
+        #: its wall time in seconds (``"time"``) and the peak resident set size
+        #: of the process in bytes at the end of the stage (``"peak_rss"``).
+        self.stages = {}
+        #: A dictionary of named counts.
+        self.counts = {}
+        #: A dictionary mapping names to lists of values, one per iteration.
+        self.iterations = {}
+        #: The wall time in seconds from creation until :meth:`finish` is called.
+        self.total_time = None
+        #: The peak resident set size in bytes when :meth:`finish` is called.
+        self.peak_rss = None
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        A context manager that records the wall time taken within it as the
+        stage ``name``. If the stage has already been recorded, the time is
+        added to the existing total.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            record = self.stages.setdefault(name, {"time": 0.0, "peak_rss": None})
+            record["time"] += elapsed
+            record["peak_rss"] = peak_rss()
+
+    def time(self, name):
+        """
+        Return the wall time in seconds recorded for the stage ``name``.
+        """
+        return self.stages[name]["time"]
+
+    def count(self, name, value):
+        """
+        Record the count ``name``, replacing any existing value.
+        """
+        self.counts[name] = int(value)
+
+    def record(self, name, values):
+        """
+        Record a sequence of per-iteration ``values`` as ``name``, replacing
+        any existing values. Values that are not finite are stored as ``None``,
+        so that they can be serialised as JSON.
+        """
+        self.iterations[name] = [float(x) if math.isfinite(x) else None for x in values]
+
+    def finish(self):
+        """
+        Record the total wall time and peak memory usage.
+        """
+        self.total_time = time.perf_counter() - self._start
+        self.peak_rss = peak_rss()
+
+    def as_dict(self):
+        """
+        Return the recorded values as a dictionary that can be serialised as
+        JSON.
+        """
+        return {
+            "tsdate_version": __version__,
+            "method": self.method,
+            "total_time": self.total_time,
+            "peak_rss": self.peak_rss,
+            "stages": {k: dict(v) for k, v in self.stages.items()},
+            "counts": dict(self.counts),
+            "iterations": {k: list(v) for k, v in self.iterations.items()},
+        }
+
+    def to_json(self, **kwargs):
+        """
+        Return the recorded values as a JSON string. Keyword arguments are
+        passed to :func:`json.dumps`.
+        """
+        return json.dumps(self.as_dict(), **kwargs)
@@ -24,6 +24,8 @@
 Base classes and internal constants used by tsdate
 """
 
+import tempfile
+
 import numpy as np
 
 FLOAT_DTYPE = np.float64
@@ -32,6 +34,20 @@ LOG_GRID = "logarithmic"
 GAMMA_PAR = "gamma_parameter"
 
 
+def allocate_grid(shape, dtype=FLOAT_DTYPE, memmap_dir=None):
+    """
+    Return an uninitialised array of the given shape and dtype. If ``memmap_dir``
+    is given, the array is backed by an anonymous temporary file in that directory,
+    which is removed when the array is garbage collected.
+    """
+    if memmap_dir is None or np.prod(shape) == 0:
+        return np.empty(shape, dtype=dtype)
+    # The mapping keeps the (unlinked) file open after it is closed here. Return a
+    # plain ndarray view, which can be passed to compiled code
+    with tempfile.TemporaryFile(dir=memmap_dir) as file:
+        return np.memmap(file, dtype=dtype, mode="w+", shape=shape).view(np.ndarray)
+
+
 class NodeTimeValues:
     """
     A class to store times or discretised distributions of times for node ids. For nodes
@@ -57,6 +73,12 @@ class NodeTimeValues:
     :vartype timepoints: numpy.ndarray
     :ivar fill_value: What should we fill the data arrays with to start with
     :vartype fill_value: float
+    :ivar dtype: The floating point type of the gridded data, e.g. ``numpy.float32``
+        to halve the memory used compared to the default of ``numpy.float64``
+    :vartype dtype: numpy.dtype
+    :ivar memmap_dir: If not None, store the gridded data in a memory-mapped
+        temporary file in this directory rather than in RAM
+    :vartype memmap_dir: str
     """
 
     def __init__(
@@ -66,6 +88,7 @@ class NodeTimeValues:
         timepoints,
         fill_value=np.nan,
         dtype=FLOAT_DTYPE,
+        memmap_dir=None,
     ):
         """
         :param numpy.ndarray grid: The input numpy.ndarray.
@@ -88,8 +111,12 @@ class NodeTimeValues:
         self.num_nodes = num_nodes
         self.nonfixed_nodes = nonfixed_nodes
         self.num_nonfixed = len(nonfixed_nodes)
-        self.grid_data = np.full((self.num_nonfixed, grid_size), fill_value, dtype=dtype)
-        self.fixed_data = np.full(num_nodes - self.num_nonfixed, fill_value, dtype=dtype)
+        self.memmap_dir = memmap_dir
+        self.grid_data = allocate_grid((self.num_nonfixed, grid_size), dtype, memmap_dir)
+        self.grid_data.fill(fill_value)
+        self.fixed_data = np.full(
+            num_nodes - self.num_nonfixed, fill_value, dtype=FLOAT_DTYPE
+        )
         self.row_lookup = np.empty(num_nodes, dtype=np.int64)
         # non-fixed nodes get a positive value, indicating lookup in the grid_data array
         self.row_lookup[nonfixed_nodes] = np.arange(self.num_nonfixed)
@@ -113,8 +140,8 @@ class NodeTimeValues:
             if self.probability_space == LIN_GRID:
                 pass
             elif self.probability_space == LOG_GRID:
-                self.grid_data = np.exp(self.grid_data)
-                self.fixed_data = np.exp(self.fixed_data)
+                np.exp(self.grid_data, out=self.grid_data)
+                np.exp(self.fixed_data, out=self.fixed_data)
                 self.probability_space = LIN_GRID
             else:
                 raise TypeError("Cannot force " + " ".join(descr))
@@ -123,8 +150,8 @@ class NodeTimeValues:
                 pass
             elif self.probability_space == LIN_GRID:
                 with np.errstate(divide="ignore", invalid="ignore"):
-                    self.grid_data = np.log(self.grid_data)
-                    self.fixed_data = np.log(self.fixed_data)
+                    np.log(self.grid_data, out=self.grid_data)
+                    np.log(self.fixed_data, out=self.fixed_data)
                 self.probability_space = LOG_GRID
             else:
                 raise TypeError("Cannot force " + " ".join(descr))
@@ -139,15 +166,16 @@ class NodeTimeValues:
     def standardize(self):
         """
         Standardize grid data so the max for each row is one (in linear space) or zero
-        (in logarithmic space)
+        (in logarithmic space). The data are modified in place, so that gridded
+        data stored in a memory-mapped file remains there.
 
         TODO - is it clear why we omit the first element of the grid?
         """
         rowmax = self.grid_data[:, 1:].max(axis=1)
         if self.probability_space == LIN_GRID:
-            self.grid_data = self.grid_data / rowmax[:, np.newaxis]
+            self.grid_data /= rowmax[:, np.newaxis]
         elif self.probability_space == LOG_GRID:
-            self.grid_data = self.grid_data - rowmax[:, np.newaxis]
+            self.grid_data -= rowmax[:, np.newaxis]
         else:
             raise RuntimeError("Probability space is not", LIN_GRID, "or", LOG_GRID)
 
@@ -159,24 +187,32 @@ class NodeTimeValues:
         if self.probability_space != LIN_GRID:
             raise NotImplementedError("Can only convert to probabilities in linear space")
         assert not np.any(self.grid_data < 0)
-        self.grid_data = self.grid_data / self.grid_data.sum(axis=1)[:, np.newaxis]
+        self.grid_data /= self.grid_data.sum(axis=1)[:, np.newaxis]
 
     def __getitem__(self, node_id):
-        index = self.row_lookup[node_id]
+        # Use item() to get a python int, which is much quicker to test and use as
+        # an index than a numpy scalar
+        index = self.row_lookup.item(node_id)
         if index < 0:
             return self.fixed_data[1 + index]
         else:
-            return self.grid_data[index, :]
+            return self.grid_data[index]
 
     def __setitem__(self, node_id, value):
-        index = self.row_lookup[node_id]
+        index = self.row_lookup.item(node_id)
         if index < 0:
             self.fixed_data[1 + index] = value
         else:
-            self.grid_data[index, :] = value
+            self.grid_data[index] = value
 
     def clone_with_new_data(
-        self, grid_data=np.nan, fixed_data=None, probability_space=None
+        self,
+        grid_data=np.nan,
+        fixed_data=None,
+        probability_space=None,
+        *,
+        dtype=None,
+        memmap_dir=None,
     ):
         """
         Take the row indices etc from an existing NodeTimeValues object and make a new
@@ -187,6 +223,11 @@ class NodeTimeValues:
         If fixed_data is None and grid_data is a single number, use the same value as
         grid_data for the fixed data values. If fixed_data is None and grid_data is an
         array, set the fixed data to np.nan
+
+        The gridded data of the new object is stored with the same dtype and in the
+        same way (in memory or memory-mapped) as the original, unless ``dtype`` or
+        ``memmap_dir`` are given. A grid_data array of the right dtype is used
+        directly if the new data is stored in memory, and copied otherwise.
         """
 
         def fill_fixed(orig, fixed_data):
@@ -201,30 +242,36 @@ class NodeTimeValues:
                     orig.fixed_data.shape, fixed_data, dtype=orig.fixed_data.dtype
                 )
 
+        if dtype is None:
+            dtype = self.grid_data.dtype
+        if memmap_dir is None:
+            memmap_dir = self.memmap_dir
         new_obj = NodeTimeValues.__new__(NodeTimeValues)
         new_obj.num_nodes = self.num_nodes
         new_obj.nonfixed_nodes = self.nonfixed_nodes
         new_obj.num_nonfixed = self.num_nonfixed
         new_obj.row_lookup = self.row_lookup
         new_obj.timepoints = self.timepoints
-        if type(grid_data) is np.ndarray:
+        new_obj.memmap_dir = memmap_dir
+        if isinstance(grid_data, np.ndarray):
             if self.grid_data.shape != grid_data.shape:
                 raise ValueError(
                     "The grid data array must be the same shape as the original"
                 )
-            new_obj.grid_data = grid_data
+            if memmap_dir is None and grid_data.dtype == dtype:
+                new_obj.grid_data = grid_data
+            else:
+                new_obj.grid_data = allocate_grid(grid_data.shape, dtype, memmap_dir)
+                new_obj.grid_data[:] = grid_data
             new_obj.fixed_data = fill_fixed(
                 self, np.nan if fixed_data is None else fixed_data
             )
         else:
-            if grid_data == 0:  # Fast allocation
-                new_obj.grid_data = np.zeros(
-                    self.grid_data.shape, dtype=self.grid_data.dtype
-                )
+            if memmap_dir is None and grid_data == 0:  # Fast allocation
+                new_obj.grid_data = np.zeros(self.grid_data.shape, dtype=dtype)
             else:
-                new_obj.grid_data = np.full(
-                    self.grid_data.shape, grid_data, dtype=self.grid_data.dtype
-                )
+                new_obj.grid_data = allocate_grid(self.grid_data.shape, dtype, memmap_dir)
+                new_obj.grid_data.fill(grid_data)
             new_obj.fixed_data = fill_fixed(
                 self, grid_data if fixed_data is None else fixed_data
             )
@@ -27,12 +27,23 @@ import numpy as np
 import tskit
 
 from .accelerate import numba_jit
-from .approx import _b1r, _b2r, _f, _f1r, _f2w, _i1r, _i1w, _i2r, _i2w, _tuple, _void
+from .approx import (
+    _b2r,
+    _f,
+    _f1r,
+    _f2w,
+    _i1r,
+    _i2r,
+    _i2w,
+    _s2w,
+    _void,
+)
+from .rescaling import edge_statistics
 
 # --- machinery used by ExpectationPropagation class --- #
 
 
-@numba_jit(_void(_f2w, _f1r, _i1r, _i2r))
+@numba_jit([_void(_f2w, _f1r, _i1r, _i2r), _void(_s2w, _f1r, _i1r, _i2r)])
 def reallocate_unphased(edges_likelihood, mutations_phase, mutations_block, blocks_edges):
     """
     Add a proportion of each unphased singleton mutation to one of the two
@@ -64,145 +75,16 @@ def reallocate_unphased(edges_likelihood, mutations_phase, mutations_block, bloc
     assert np.isclose(num_unphased, np.sum(edges_likelihood[edges_unphased, 0]))
 
 
-@numba_jit(
-    _tuple((_f2w, _i2w, _i1w))(
-        _b1r, _i1r, _i1r, _f1r, _i1r, _i1r, _f1r, _f1r, _i1r, _i1r, _f
-    )
-)
-def _block_singletons(
-    individuals_unphased,
-    nodes_individual,
-    mutations_node,
-    mutations_position,
-    edges_parent,
-    edges_child,
-    edges_left,
-    edges_right,
-    indexes_insert,
-    indexes_remove,
-    sequence_length,
-):
-    """
-    TODO
-    """
-    assert edges_parent.size == edges_child.size == edges_left.size == edges_right.size
-    assert indexes_insert.size == indexes_remove.size == edges_parent.size
-    assert mutations_node.size == mutations_position.size
-
-    num_mutations = mutations_node.size
-    num_edges = edges_parent.size
-    num_individuals = individuals_unphased.size
-
-    indexes_mutation = np.argsort(mutations_position)
-    position_insert = edges_left[indexes_insert]
-    position_remove = edges_right[indexes_remove]
-    position_mutation = mutations_position[indexes_mutation]
-
-    individuals_edges = np.full((num_individuals, 2), tskit.NULL)
-    individuals_position = np.full(num_individuals, np.nan)
-    individuals_singletons = np.zeros(num_individuals)
-    individuals_block = np.full(num_edges, tskit.NULL)
-    mutations_block = np.full(num_mutations, tskit.NULL)
-
-    blocks_span = []
-    blocks_singletons = []
-    blocks_edges = []
-    blocks_order = []
-
-    num_blocks = 0
-    left = 0.0
-    a, b, d = 0, 0, 0
-    while a < num_edges or b < num_edges:
-        while b < num_edges and position_remove[b] == left:  # edges out
-            e = indexes_remove[b]
-            c = edges_child[e]
-            i = nodes_individual[c]
-            if i != tskit.NULL and individuals_unphased[i]:
-                u, v = individuals_edges[i]
-                assert u == e or v == e
-                s = u if v == e else v
-                individuals_edges[i] = s, tskit.NULL
-                if s != tskit.NULL:  # flush block
-                    blocks_order.append(individuals_block[i])
-                    blocks_edges.extend([e, s])
-                    blocks_singletons.append(individuals_singletons[i])
-                    blocks_span.append(left - individuals_position[i])
-                    individuals_position[i] = np.nan
-                    individuals_block[i] = tskit.NULL
-                    individuals_singletons[i] = 0.0
-            b += 1
-
-        while a < num_edges and position_insert[a] == left:  # edges in
-            e = indexes_insert[a]
-            c = edges_child[e]
-            i = nodes_individual[c]
-            if i != tskit.NULL and individuals_unphased[i]:
-                u, v = individuals_edges[i]
-                assert u == tskit.NULL or v == tskit.NULL
-                individuals_edges[i] = [e, max(u, v)]
-                individuals_position[i] = left
-                if individuals_block[i] == tskit.NULL:
-                    individuals_block[i] = num_blocks
-                    num_blocks += 1
-            a += 1
-
-        right = sequence_length
-        if b < num_edges:
-            right = min(right, position_remove[b])
-        if a < num_edges:
-            right = min(right, position_insert[a])
-        left = right
-
-        while d < num_mutations and position_mutation[d] < right:  # mutations
-            m = indexes_mutation[d]
-            c = mutations_node[m]
-            i = nodes_individual[c]
-            if i != tskit.NULL and individuals_unphased[i]:
-                mutations_block[m] = individuals_block[i]
-                individuals_singletons[i] += 1.0
-            d += 1
-
-    mutations_block = mutations_block.astype(np.int32)
-    blocks_edges = np.array(blocks_edges, dtype=np.int32).reshape(-1, 2)
-    blocks_singletons = np.array(blocks_singletons)
-    blocks_span = np.array(blocks_span)
-    blocks_order = np.array(blocks_order)
-    blocks_stats = np.column_stack((blocks_singletons, blocks_span))
-    assert num_blocks == blocks_edges.shape[0] == blocks_stats.shape[0]
-
-    # sort block arrays so that mutations_block points to correct row
-    blocks_order = np.argsort(blocks_order)
-    blocks_edges = blocks_edges[blocks_order]
-    blocks_stats = blocks_stats[blocks_order]
-
-    return blocks_stats, blocks_edges, mutations_block
-
-
 def block_singletons(ts, individuals_unphased):
     """
-    TODO
+    Return the number of singleton mutations and span per singleton block, the
+    pair of edges in each block, and the block containing each mutation. See
+    `rescaling.edge_statistics`.
     """
-    for i in ts.individuals():
-        if individuals_unphased[i.id]:
-            if i.nodes.size != 2:
-                raise ValueError("Singleton blocking assumes diploid individuals")
-            if not np.all(ts.nodes_time[i.nodes] == 0.0):
-                raise ValueError("Singleton blocking assumes contemporary individuals")
-
-    # TODO: adjust spans by an accessibility mask
-    return _block_singletons(
-        individuals_unphased,
-        ts.nodes_individual,
-        ts.mutations_node,
-        ts.sites_position[ts.mutations_site],
-        ts.edges_parent,
-        ts.edges_child,
-        ts.edges_left,
-        ts.edges_right,
-        ts.indexes_edge_insertion_order,
-        ts.indexes_edge_removal_order,
-        ts.sequence_length,
+    *_, blocks_stats, blocks_edges, mutations_block = edge_statistics(
+        ts, individuals_unphased, size_biased=False
     )
+    return blocks_stats, blocks_edges, mutations_block
 
 
 @numba_jit(_i2w(_b2r, _i1r, _f1r, _i1r, _i1r, _f1r, _f1r, _i1r, _i1r, _f))
@@ -26,6 +26,7 @@ Routines and classes for creating priors and timeslices for use in tsdate
 
 import logging
 import os
+import tempfile
 from collections import defaultdict, namedtuple
 
 import numpy as np
@@ -37,6 +38,7 @@ from tqdm.auto import tqdm
 
 from . import cache, demography, node_time_class, provenance, util
 from .accelerate import numba_jit
+from .approx import _b1r, _f1r, _f1w, _i1r, _i1w, _tuple
 
 #: The default value for `approx_prior_size` (see :func:`~tsdate.build_prior_grid` and
 #: :func:`~tsdate.build_parameter_grid`)
@@ -144,14 +146,18 @@ class ConditionalCoalescentTimes:
         if precalc_approximation_n:
             # Create lookup table based on a large n that can be used for n > ~50
             filename = self.get_precalc_cache(precalc_approximation_n)
-            if os.path.isfile(filename):
-                # Have already calculated and stored this
-                self.approx_priors = np.genfromtxt(filename)
-            else:
-                # Calc and store
-                self.approx_priors = self.precalculate_priors_for_approximation(
-                    precalc_approximation_n,
-                )
+            self.approx_priors = self.load_precalculated_priors(precalc_approximation_n)
+            if self.approx_priors is None:
+                with cache.file_lock(filename):
+                    # Another process may have stored this while we waited for the lock
+                    self.approx_priors = self.load_precalculated_priors(
+                        precalc_approximation_n
+                    )
+                    if self.approx_priors is None:
+                        # Calc and store
+                        self.approx_priors = self.precalculate_priors_for_approximation(
+                            precalc_approximation_n,
+                        )
         else:
             self.approx_priors = None
 
@@ -264,7 +270,44 @@ class ConditionalCoalescentTimes:
         all_tips = np.arange(2, n + 1)
         prior_lookup_table[1:, 0] = all_tips / n
         prior_lookup_table[1:, 1] = conditional_coalescent_variance(n + 1)[all_tips]
-        np.savetxt(self.get_precalc_cache(n), prior_lookup_table)
+        # Write to a temporary file and rename, so that other processes never
+        # read a partially written table
+        filename = self.get_precalc_cache(n)
+        tmp_name = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(filename),
+                prefix=f"{os.path.basename(filename)}.",
+                suffix=".tmp",
+                delete=False,
+            ) as file:
+                tmp_name = file.name
+                np.save(file, prior_lookup_table)
+            os.replace(tmp_name, filename)
+        except OSError as err:
+            logging.warning(f"Could not save precalculated priors to {filename}: {err}")
+            if tmp_name is not None and os.path.exists(tmp_name):
+                os.remove(tmp_name)
+        return prior_lookup_table
+
+    @classmethod
+    def load_precalculated_priors(cls, precalc_approximation_n):
+        """
+        Return the precalculated lookup table for ``precalc_approximation_n`` tips
+        from the user cache, memory-mapped read-only, or None if it has not been
+        created (or cannot be read)
+        """
+        filename = cls.get_precalc_cache(precalc_approximation_n)
+        try:
+            prior_lookup_table = np.load(filename, mmap_mode="r")
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            logging.warning(f"Ignoring unreadable precalculated priors {filename}: {err}")
+            return None
+        if prior_lookup_table.shape != (precalc_approximation_n, 2):
+            logging.warning(f"Ignoring precalculated priors of wrong shape {filename}")
+            return None
         return prior_lookup_table
 
     def clear_precalculated_priors(self):
@@ -281,9 +324,36 @@ class ConditionalCoalescentTimes:
         cache_dir = cache.get_cache_dir()
         return os.path.join(
             cache_dir,
-            f"prior_{precalc_approximation_n}df_{provenance.__version__}.txt",
+            f"prior_{precalc_approximation_n}df_{provenance.__version__}.npy",
         )
 
+    @staticmethod
+    def list_precalculated_priors():
+        """
+        Return a dictionary mapping the number of tips of each lookup table stored
+        in the user cache by this version of tsdate to its file size in bytes
+        """
+        suffix = f"df_{provenance.__version__}.npy"
+        sizes = {}
+        for path in cache.get_cache_dir().glob(f"prior_*{suffix}"):
+            n = path.name[len("prior_") : -len(suffix)]
+            if n.isdigit():
+                try:
+                    sizes[int(n)] = path.stat().st_size
+                except OSError:  # pragma: no cover
+                    continue  # removed by another process
+        return sizes
+
+    @staticmethod
+    def clear_all_precalculated_priors():
+        """
+        Remove all lookup tables stored in the user cache, including those made by
+        other versions of tsdate, along with their lock and temporary files
+        """
+        for path in cache.get_cache_dir().glob("prior_*df_*"):
+            if path.is_file():
+                path.unlink(missing_ok=True)
+
     @staticmethod
     def tau_expect(i, n):
         if i == n:
@@ -377,50 +447,197 @@ class ConditionalCoalescentTimes:
             [i for i, f in enumerate(PriorParams._fields) if f not in ("mean", "var")]
         )
 
-        seen_mixtures = {}
         # allocate space for params for all nodes, even though we only use nodes_to_date
         num_nodes, num_params = spans_by_samples.ts.num_nodes, len(param_cols)
         priors = np.full(
             (num_nodes + 1, num_params), np.nan, dtype=node_time_class.FLOAT_DTYPE
         )
-        for node in tqdm(
-            spans_by_samples.nodes_to_date,
-            total=len(spans_by_samples.nodes_to_date),
-            disable=not self.progress,
-            desc="Find Mixture Priors",
-        ):
-            mixture = spans_by_samples.get_spans(node)
-            if len(mixture) == 1:
-                # The norm: this node spans trees that all have the same set of samples
-                total_tips, span_arr = next(iter(mixture.items()))
-                if span_arr.shape[0] == 1:
-                    d_tips = span_arr["descendant_tips"][0]
-                    # This node is not a mixture - can use the standard coalescent prior
-                    priors[node] = self[total_tips][d_tips, param_cols]
-                elif span_arr.shape[0] <= 5:
-                    # Making mixture priors is a little expensive. We can help by caching
-                    # in those cases where we have only a few mixtures
-                    # (arbitrarily set here as <= 5 mixtures)
-                    mixture_hash = (total_tips, span_arr.tobytes())
-                    if mixture_hash not in seen_mixtures:
-                        priors[node] = seen_mixtures[mixture_hash] = self.func_approx(
-                            *self.mixture_expect_and_var(mixture)
-                        )
-                    else:
-                        priors[node] = seen_mixtures[mixture_hash]
-                else:
-                    # a large number of mixtures in this node - don't bother caching
-                    priors[node] = self.func_approx(*self.mixture_expect_and_var(mixture))
-            else:
-                # The node spans trees with multiple total tip numbers,
-                # don't use the cache
-                priors[node] = self.func_approx(*self.mixture_expect_and_var(mixture))
+        # Look up the coalescent mean and variance of every row in the span mixtures
+        offsets = spans_by_samples.node_offsets
+        total_tips = spans_by_samples.total_tips
+        descendant_tips = spans_by_samples.descendant_tips
+        span = spans_by_samples.span
+        num_rows = np.diff(offsets)
+        row_node = np.repeat(np.arange(num_nodes), num_rows)
+        # Nodes with a single row are not a mixture - use the standard coalescent prior
+        single = offsets[:-1][num_rows == 1]
+        mean_time = np.empty(span.size, dtype=node_time_class.FLOAT_DTYPE)
+        var_time = np.empty(span.size, dtype=node_time_class.FLOAT_DTYPE)
+        for num_samples in np.unique(total_tips):
+            table = self[int(num_samples)]
+            rows = total_tips == num_samples
+            mean_time[rows] = table[descendant_tips[rows], self.mean_column]
+            var_time[rows] = table[descendant_tips[rows], self.var_column]
+            rows = single[total_tips[single] == num_samples]
+            priors[row_node[rows]] = table[
+                descendant_tips[rows][:, np.newaxis], param_cols
+            ]
+        # Sum the mixtures for all nodes at once, as in mixture_expect_and_var
+        mixed = np.flatnonzero(num_rows > 1)
+        if mixed.size > 0:
+            weight_sum = np.bincount(row_node, weights=span, minlength=num_nodes)
+            expectation = np.bincount(
+                row_node, weights=mean_time * span, minlength=num_nodes
+            )
+            first = np.bincount(row_node, weights=var_time * span, minlength=num_nodes)
+            secnd = np.bincount(
+                row_node, weights=mean_time**2 * span, minlength=num_nodes
+            )
+            mean = expectation[mixed] / weight_sum[mixed]
+            var = (first[mixed] + secnd[mixed]) / weight_sum[mixed] - (mean**2)
+            priors[mixed] = np.column_stack(self.func_approx(mean, var))
         # Check that references to the tskit.NULL'th node return NaNs, as we will later
         # be indexing into the prior array using a node mapping which could have NULLs
         assert np.all(np.isnan(priors[tskit.NULL, :]))
         return priors
 
 
+@numba_jit(
+    _tuple((_i1w, _i1w, _i1w, _f1w, _f1w, _i1w, _i1w))(
+        _b1r, _i1r, _i1r, _f1r, _f1r, _i1r, _i1r, _f1r
+    )
+)
+def _spans_by_samples(
+    node_is_sample,
+    edges_parent,
+    edges_child,
+    edges_left,
+    edges_right,
+    indexes_insert,
+    indexes_remove,
+    breakpoints,
+):
+    """
+    Single sweep over the edge indexes that splits the span of each node into
+    stretches over which the node is in the tree, with a fixed number of
+    descendant samples and a fixed total number of samples in the tree. Returns
+    the node, total samples, descendant samples, left coordinate and span of each
+    stretch, and the number of samples and of roots in each tree. Unary nodes are
+    treated like any other node. As in :meth:`SpansBySamples.first_pass`, the
+    first stretch of each sample starts at the left of the genome, even if the
+    sample is isolated (i.e. missing) there.
+    """
+    assert edges_parent.size == edges_child.size == edges_left.size == edges_right.size
+    assert indexes_insert.size == indexes_remove.size == edges_parent.size
+
+    num_edges = edges_parent.size
+    num_nodes = node_is_sample.size
+    num_trees = breakpoints.size - 1
+
+    nodes_parent = np.full(num_nodes, tskit.NULL, dtype=np.int32)
+    nodes_children = np.zeros(num_nodes, dtype=np.int32)
+    nodes_samples = np.zeros(num_nodes, dtype=np.int32)
+    nodes_left = np.full(num_nodes, np.nan)  # start of current stretch, if in tree
+    trees_samples = np.zeros(num_trees, dtype=np.int32)
+    trees_roots = np.zeros(num_trees, dtype=np.int32)
+
+    # nodes whose stretch ends at the current breakpoint, with their sample counts
+    # before any change
+    nodes_marked = np.full(num_nodes, tskit.NULL, dtype=np.int32)
+    marked_node = np.empty(num_nodes, dtype=np.int32)
+    marked_samples = np.empty(num_nodes, dtype=np.int32)
+
+    stretches_node = []
+    stretches_total = []
+    stretches_samples = []
+    stretches_left = []
+    stretches_span = []
+
+    nodes_samples[node_is_sample] = 1
+    nodes_left[node_is_sample] = breakpoints[0]
+    num_samples = 0
+    num_roots = 0
+    a, b = 0, 0
+    for t in range(num_trees + 1):
+        position = breakpoints[t]
+        num_marked = 0
+        prev_samples = num_samples
+
+        while b < num_edges and edges_right[indexes_remove[b]] == position:  # out
+            e = indexes_remove[b]
+            p, c = edges_parent[e], edges_child[e]
+            u = c
+            while u != tskit.NULL:  # downdate sample counts
+                if nodes_marked[u] != t:
+                    nodes_marked[u] = t
+                    marked_node[num_marked] = u
+                    marked_samples[num_marked] = nodes_samples[u]
+                    num_marked += 1
+                if u != c:
+                    nodes_samples[u] -= nodes_samples[c]
+                u = nodes_parent[u]
+            nodes_parent[c] = tskit.NULL
+            nodes_children[p] -= 1
+            if nodes_children[c] > 0:
+                num_roots += 1
+            if nodes_children[p] == 0 and nodes_parent[p] == tskit.NULL:
+                num_roots -= 1
+            if node_is_sample[c]:
+                num_samples -= 1
+            b += 1
+
+        while a < num_edges and edges_left[indexes_insert[a]] == position:  # in
+            e = indexes_insert[a]
+            p, c = edges_parent[e], edges_child[e]
+            if nodes_children[c] > 0:
+                num_roots -= 1
+            if nodes_children[p] == 0 and nodes_parent[p] == tskit.NULL:
+                num_roots += 1
+            nodes_parent[c] = p
+            nodes_children[p] += 1
+            if node_is_sample[c]:
+                num_samples += 1
+            u = c
+            while u != tskit.NULL:  # update sample counts
+                if nodes_marked[u] != t:
+                    nodes_marked[u] = t
+                    marked_node[num_marked] = u
+                    marked_samples[num_marked] = nodes_samples[u]
+                    num_marked += 1
+                if u != c:
+                    nodes_samples[u] += nodes_samples[c]
+                u = nodes_parent[u]
+            a += 1
+
+        if num_samples != prev_samples:  # end the stretches of all nodes in the tree
+            for u in range(num_nodes):
+                if nodes_parent[u] == tskit.NULL and nodes_children[u] == 0:
+                    continue  # not in the tree, e.g. a sample yet to be attached
+                if not np.isnan(nodes_left[u]) and nodes_marked[u] != t:
+                    nodes_marked[u] = t
+                    marked_node[num_marked] = u
+                    marked_samples[num_marked] = nodes_samples[u]
+                    num_marked += 1
+
+        for i in range(num_marked):
+            u = marked_node[i]
+            left = nodes_left[u]
+            if not np.isnan(left) and position > left:
+                stretches_node.append(u)
+                stretches_total.append(trees_samples[t - 1])
+                stretches_samples.append(marked_samples[i])
+                stretches_left.append(left)
+                stretches_span.append(position - left)
+            if nodes_parent[u] != tskit.NULL or nodes_children[u] > 0:
+                nodes_left[u] = position
+            else:
+                nodes_left[u] = np.nan
+
+        if t < num_trees:
+            trees_samples[t] = num_samples
+            trees_roots[t] = num_roots
+
+    return (
+        np.array(stretches_node, dtype=np.int32),
+        np.array(stretches_total, dtype=np.int32),
+        np.array(stretches_samples, dtype=np.int32),
+        np.array(stretches_left, dtype=np.float64),
+        np.array(stretches_span, dtype=np.float64),
+        trees_samples,
+        trees_roots,
+    )
+
+
 class SpansBySamples:
     """
     A class to efficiently calculate the genomic spans covered by each
@@ -458,8 +675,28 @@ class SpansBySamples:
         and also provide the node numbers that are valid parameters for the
         :meth:`get_spans` method.
     :vartype nodes_to_date: numpy.ndarray (dtype=np.uint32)
+    :ivar node_offsets: A numpy array of size :attr:`.tree_sequence.num_nodes` + 1,
+        such that the spans of node ``u`` are stored in rows
+        ``node_offsets[u]`` to ``node_offsets[u + 1]`` of the :attr:`total_tips`,
+        :attr:`descendant_tips` and :attr:`span` arrays
+    :vartype node_offsets: numpy.ndarray (dtype=np.int64)
+    :ivar total_tips: The total number of samples in the trees of each row,
+        sorted within each node
+    :vartype total_tips: numpy.ndarray (dtype=np.uint64)
+    :ivar descendant_tips: The number of samples descending from the node in each
+        row, sorted within each node and total number of samples
+    :vartype descendant_tips: numpy.ndarray (dtype=np.uint64)
+    :ivar span: The genomic span of each row
+    :vartype span: numpy.ndarray (dtype=np.float64)
     """
 
+    spans_dtype = np.dtype(
+        {
+            "names": ("descendant_tips", "span"),
+            "formats": (np.uint64, node_time_class.FLOAT_DTYPE),
+        }
+    )
+
     def __init__(self, tree_sequence, *, progress=False, allow_unary=False):
         """
         :param TreeSequence tree_sequence: The input :class:`tskit.TreeSequence`.
@@ -477,20 +714,26 @@ class SpansBySamples:
         self._spans = defaultdict(
             lambda: defaultdict(lambda: defaultdict(node_time_class.FLOAT_DTYPE))
         )
+        # Or, if made by the compiled pass, as arrays of node, total tips,
+        # descendant tips and span
+        self._span_rows = None
 
-        if not allow_unary:
-            if has_locally_unary_nodes(self.ts):
-                raise ValueError(
-                    "The input tree sequence has unary nodes: tsdate currently requires "
-                    "that these are removed using `simplify(keep_unary=False)`"
-                )
+        has_unary = util.contains_unary_nodes(self.ts)
+        if has_unary and not allow_unary:
+            raise ValueError(
+                "The input tree sequence has unary nodes: tsdate currently requires "
+                "that these are removed using `simplify(keep_unary=False)`"
+            )
 
         with tqdm(total=3, desc="TipCount", disable=not self.progress) as progressbar:
+            # Spans of unary nodes are taken from the coalescent nodes above and
+            # below them, which needs the slower treewise passes
+            first_pass = self.first_pass if has_unary else self.compiled_pass
             (
                 node_spans,
                 trees_with_undated,
                 total_fixed_at_0_per_tree,
-            ) = self.first_pass(allow_unary=allow_unary)
+            ) = first_pass(allow_unary=allow_unary)
             progressbar.update()
 
             # A set of the total_num_tips in different trees (used for missing data)
@@ -526,10 +769,13 @@ class SpansBySamples:
         Return a set of the node IDs that we want to date, but which haven't had a
         set of spans allocated which could be used to date the node.
         """
+        spanned = set(self._spans)
+        if self._span_rows is not None:
+            spanned.update(np.unique(self._span_rows[0]).tolist())
         return {
             n
             for n in range(self.ts.num_nodes)
-            if not (n in self._spans or n in self.sample_node_set)
+            if not (n in spanned or n in self.sample_node_set)
         }
 
     def nodes_remain_to_date(self):
@@ -537,9 +783,12 @@ class SpansBySamples:
         A more efficient version of nodes_remaining_to_date() that simply tells us if
         there are any more nodes that remain to date, but does not identify which ones
         """
-        if self.ts.num_nodes - len(self.sample_node_set) - len(self._spans) != 0:
+        num_spanned = len(self._spans)
+        if self._span_rows is not None:
+            num_spanned += len(np.unique(self._span_rows[0]))
+        if self.ts.num_nodes - len(self.sample_node_set) - num_spanned != 0:
             # we should always have equal or fewer results than nodes to date
-            assert len(self._spans) < self.ts.num_nodes - len(self.sample_node_set)
+            assert num_spanned < self.ts.num_nodes - len(self.sample_node_set)
             return True
         return False
 
@@ -771,6 +1020,64 @@ class SpansBySamples:
                 )
         return node_spans, trees_with_undated, n_tips_per_tree
 
+    def compiled_pass(self, allow_unary=False):
+        """
+        A faster equivalent of :meth:`first_pass` for tree sequences without unary
+        nodes, which assigns spans to all nodes in a single compiled sweep along
+        the genome, so that no trees need revisiting.
+        """
+        logging.debug("Assigning priors to non-fixed nodes in compiled code")
+        node_is_sample = np.zeros(self.ts.num_nodes, dtype=bool)
+        node_is_sample[self.ts.samples()] = True
+        (
+            stretches_node,
+            stretches_total,
+            stretches_samples,
+            stretches_left,
+            stretches_span,
+            n_tips_per_tree,
+            roots_per_tree,
+        ) = _spans_by_samples(
+            node_is_sample,
+            self.ts.edges_parent,
+            self.ts.edges_child,
+            self.ts.edges_left,
+            self.ts.edges_right,
+            self.ts.indexes_edge_insertion_order,
+            self.ts.indexes_edge_removal_order,
+            self.ts.breakpoints(as_array=True),
+        )
+        self.has_unary = False
+        multiple_roots = np.flatnonzero(roots_per_tree > 1)
+        if multiple_roots.size > 0:
+            raise ValueError(f"Tree {multiple_roots[0]} has multiple roots")
+        dangling = np.flatnonzero(stretches_samples == 0)
+        if dangling.size > 0:
+            first = dangling[np.argmin(stretches_left[dangling])]
+            raise ValueError(
+                f"Node {stretches_node[first]} is dangling (no descendant samples) at "
+                f"pos {stretches_left[first]}: this node will have no weight in "
+                "this region. Run `simplify(keep_unary=False)` before dating "
+                "this tree sequence"
+            )
+        node_spans = np.bincount(
+            stretches_node, weights=stretches_span, minlength=self.ts.num_nodes
+        )
+        # Sum the spans of each non-sample node by total and descendant samples
+        keep = np.logical_not(node_is_sample[stretches_node])
+        keys, inverse = np.unique(
+            np.column_stack(
+                (stretches_node[keep], stretches_total[keep], stretches_samples[keep])
+            ),
+            axis=0,
+            return_inverse=True,
+        )
+        spans = np.bincount(
+            inverse.ravel(), weights=stretches_span[keep], minlength=keys.shape[0]
+        )
+        self._span_rows = (keys[:, 0], keys[:, 1], keys[:, 2], spans)
+        return node_spans, [], n_tips_per_tree.astype(np.int64)
+
     def second_pass(self, trees_with_undated, n_tips_per_tree):
         """
         Check for nodes which have unassigned prior params after the first
@@ -852,18 +1159,12 @@ class SpansBySamples:
 
     def finalize(self):
         """
-        normalize the spans in self._spans by the values in self.node_spans,
-        and overwrite the results (as we don't need them any more), providing a
-        shortcut to by setting node_span_data. Also provide the
+        Gather the spans in self._spans (or made by the compiled pass) into compressed
+        sparse rows, sorted by node, then total tips, then descendant tips, and
+        discard the original data as we don't need it any more. Also provide the
         nodes_to_date value.
         """
-        assert not hasattr(self, "node_span_data"), "Already finalized"
-        spans_dtype = np.dtype(
-            {
-                "names": ("descendant_tips", "span"),
-                "formats": (np.uint64, node_time_class.FLOAT_DTYPE),
-            }
-        )
+        assert not hasattr(self, "node_offsets"), "Already finalized"
 
         if self.nodes_remain_to_date():
             raise ValueError(
@@ -872,14 +1173,33 @@ class SpansBySamples:
                 f"{self.nodes_remaining_to_date()}"
             )
 
-        for node, spans_by_total_tips in self._spans.items():
-            self._spans[node] = {}  # Overwrite, so we don't leave the old data around
-            for num_samples, spans in sorted(spans_by_total_tips.items()):
-                wt = np.array([(k, v) for k, v in spans.items()], dtype=spans_dtype)
-                self._spans[node][num_samples] = wt
-        # Assign into the instance, for further reference
-        self.node_span_data = self._spans
-        self.nodes_to_date = np.array(list(self._spans.keys()), dtype=np.uint64)
+        rows = [
+            (node, total_tips, descendant_tips, span)
+            for node, spans_by_total_tips in self._spans.items()
+            for total_tips, spans in spans_by_total_tips.items()
+            for descendant_tips, span in spans.items()
+        ]
+        node, total_tips, descendant_tips, span = (
+            np.array([row[i] for row in rows], dtype=dtype)
+            for i, dtype in enumerate(
+                (np.int64, np.uint64, np.uint64, node_time_class.FLOAT_DTYPE)
+            )
+        )
+        if self._span_rows is not None:
+            node, total_tips, descendant_tips, span = (
+                np.concatenate((a, b.astype(a.dtype)))
+                for a, b in zip(
+                    (node, total_tips, descendant_tips, span), self._span_rows
+                )
+            )
+        order = np.lexsort((descendant_tips, total_tips, node))
+        counts = np.bincount(node, minlength=self.ts.num_nodes)
+        self.node_offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.total_tips = total_tips[order]
+        self.descendant_tips = descendant_tips[order]
+        self.span = span[order]
+        self.nodes_to_date = np.flatnonzero(counts).astype(np.uint64)
+        del self._spans, self._span_rows
 
     def get_spans(self, node):
         """
@@ -905,6 +1225,10 @@ class SpansBySamples:
         region of a node returns a 50:50  mix of the coalescent node above and
         the coalescent node below it.
 
+        The same values are stored for all nodes in the ``total_tips``,
+        ``descendant_tips`` and ``span`` arrays, where the rows for node ``u`` run
+        from ``node_offsets[u]`` to ``node_offsets[u + 1]``.
+
         :param int node: The node for which we want spans.
         :return: A dictionary, whose keys ( :math:`n_t` ) are the total number of
             samples in the trees in a tree sequence, and whose values are
@@ -914,7 +1238,19 @@ class SpansBySamples:
             sum to ``self.node_spans[u]``.
         :rtype: dict(int, numpy.ndarray)'
         """
-        return self.node_span_data[node]
+        start, stop = self.node_offsets[node], self.node_offsets[node + 1]
+        total_tips = self.total_tips[start:stop]
+        spans = {}
+        for num_samples in np.unique(total_tips):
+            rows = slice(
+                start + np.searchsorted(total_tips, num_samples, side="left"),
+                start + np.searchsorted(total_tips, num_samples, side="right"),
+            )
+            wt = np.empty(rows.stop - rows.start, dtype=self.spans_dtype)
+            wt["descendant_tips"] = self.descendant_tips[rows]
+            wt["span"] = self.span[rows]
+            spans[int(num_samples)] = wt
+        return spans
 
     def lookup_span(self, node, total_tips, descendant_tips):
         # Only used for testing
@@ -997,8 +1333,44 @@ def create_timepoints(base_priors, n_points=21):
     return np.insert(t_set, 0, 0)
 
 
+def refine_timepoints(timepoints, mass, num_timepoints):
+    """
+    Create a finer set of ``num_timepoints`` time points that includes all the
+    existing ``timepoints``, placing the additional points within each interval
+    between existing time points in proportion to the average posterior ``mass``
+    at either end of the interval (e.g. summed over all nodes). The additional
+    points are evenly spaced within each interval.
+    """
+    timepoints = np.asarray(timepoints, dtype=node_time_class.FLOAT_DTYPE)
+    mass = np.asarray(mass, dtype=node_time_class.FLOAT_DTYPE)
+    if len(mass) != len(timepoints):
+        raise ValueError("Must provide the posterior mass at each time point")
+    num_extra = num_timepoints - len(timepoints)
+    if num_extra <= 0:
+        raise ValueError("The refined time points must outnumber the existing ones")
+    interval_mass = (mass[:-1] + mass[1:]) / 2
+    if not np.sum(interval_mass) > 0:
+        interval_mass = np.ones(len(timepoints) - 1)
+    share = interval_mass / np.sum(interval_mass) * num_extra
+    counts = np.floor(share).astype(int)
+    # Give the points left over to the intervals with the largest remainders
+    leftover = num_extra - np.sum(counts)
+    counts[np.argsort(counts - share)[:leftover]] += 1
+    refined = [timepoints]
+    for start, end, count in zip(timepoints[:-1], timepoints[1:], counts):
+        refined.append(np.linspace(start, end, count + 2)[1:-1])
+    return np.unique(np.concatenate(refined))
+
+
 def fill_priors(
-    node_parameters, timepoints, ts, population_size, *, prior_distr, progress=False
+    node_parameters,
+    timepoints,
+    ts,
+    population_size,
+    *,
+    prior_distr,
+    progress=False,
+    rows_per_chunk=None,
 ):
     """
     Take the alpha and beta values from the node_parameters array, which contains
@@ -1009,6 +1381,10 @@ def fill_priors(
     The `population_size` can be a scalar, or an object with a `.to_natural_timescale`
     method used to map from coalescent to generational timescale.
 
+    The prior CDF is evaluated for blocks of `rows_per_chunk` nodes at a time,
+    which bounds the memory used. If None, blocks are chosen to hold around
+    4 million values.
+
     TODO - what if there is an internal fixed node? Should we truncate
 
     TODO - support times scaled by generation length?
@@ -1035,17 +1411,27 @@ def fill_priors(
         population_size.to_natural_timescale(timepoints),
     )
 
-    # TO DO - this can probably be done in an single numpy step rather than a for loop
-    for node in tqdm(
-        datable_nodes, desc="Assign Prior to Each Node", disable=not progress
+    if rows_per_chunk is None:
+        rows_per_chunk = max(1, 2**22 // len(timepoints))
+    for start in tqdm(
+        range(0, prior_times.num_nonfixed, rows_per_chunk),
+        desc="Assign Prior to Each Node",
+        disable=not progress,
     ):
+        chunk = slice(start, start + rows_per_chunk)
+        nodes = prior_times.nonfixed_nodes[chunk]
         # NB: prior CDF is evaluated on coalescent timescale
         with np.errstate(divide="ignore", invalid="ignore"):
-            prior_node = cdf_func(timepoints, main_param[node], scale=scale_param[node])
+            prior_nodes = cdf_func(
+                timepoints[np.newaxis, :],
+                main_param[nodes, np.newaxis],
+                scale=scale_param[nodes, np.newaxis],
+            )
         # force age to be less than max value
-        prior_node = np.divide(prior_node, np.max(prior_node))
+        prior_nodes /= np.max(prior_nodes, axis=1, keepdims=True)
         # prior in each epoch
-        prior_times[node] = np.concatenate([np.array([0]), np.diff(prior_node)])
+        prior_times.grid_data[chunk, 0] = 0
+        prior_times.grid_data[chunk, 1:] = np.diff(prior_nodes, axis=1)
     # standardize so max value is 1
     prior_times.standardize()
     return prior_times
@@ -1145,9 +1531,11 @@ class MixturePrior:
         )
         return priors
 
-    def make_parameter_grid(self, population_size, progress=False):
+    def make_parameter_grid(self, population_size, progress=False, rows_per_chunk=None):
         """
-        Adjust prior parameters given a population size history
+        Adjust prior parameters given a population size history. Nodes are
+        converted in blocks of ``rows_per_chunk``, which if None are chosen so
+        that each block holds around 4 million values.
         """
 
         if self.prior_distribution != "gamma":
@@ -1171,10 +1559,18 @@ class MixturePrior:
 
         shape = self.prior_params[:, PriorParams.field_index("alpha")]
         rate = self.prior_params[:, PriorParams.field_index("beta")]
-        for node in tqdm(
-            datable_nodes, desc="Assign Prior to Each Node", disable=not progress
+        if rows_per_chunk is None:
+            rows_per_chunk = max(1, 2**22 // population_size.population_size.size)
+        for start in tqdm(
+            range(0, prior_pars.num_nonfixed, rows_per_chunk),
+            desc="Assign Prior to Each Node",
+            disable=not progress,
         ):
-            prior_pars[node] = population_size.gamma_to_natural(shape[node], rate[node])
+            chunk = slice(start, start + rows_per_chunk)
+            nodes = prior_pars.nonfixed_nodes[chunk]
+            prior_pars.grid_data[chunk] = population_size.gamma_to_natural(
+                shape[nodes], rate[nodes]
+            )
 
         return prior_pars
 
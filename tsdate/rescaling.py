@@ -41,12 +41,12 @@ from .approx import (
     _i,
     _i1r,
     _i1w,
+    _i2w,
     _tuple,
     _unituple,
     approximate_gamma_iqr,
 )
 from .hypergeo import _gammainc_inv as gammainc_inv
-from .util import mutation_span_array  # NOQA: F401
 
 
 @numba_jit(_i1w(_f1r, _i))
@@ -114,11 +114,27 @@ def _poisson_changepoints(counts, offset, penalty, min_counts, min_offset):
     return breaks
 
 
+def check_unphased_individuals(ts, individuals_unphased):
+    """
+    Check that individuals with unphased singletons can be blocked
+    """
+    for i in ts.individuals():
+        if individuals_unphased[i.id]:
+            if i.nodes.size != 2:
+                raise ValueError("Singleton blocking assumes diploid individuals")
+            if not np.all(ts.nodes_time[i.nodes] == 0.0):
+                raise ValueError("Singleton blocking assumes contemporary individuals")
+
+
 @numba_jit(
-    _tuple((_f2w, _i1w))(_b1r, _i1r, _f1r, _i1r, _i1r, _f1r, _f1r, _i1r, _i1r, _f, _b)
+    _tuple((_f2w, _f2w, _i1w, _f2w, _i2w, _i1w))(
+        _b1r, _b1r, _i1r, _i1r, _f1r, _i1r, _i1r, _f1r, _f1r, _i1r, _i1r, _f, _b
+    )
 )
-def _count_mutations(
+def _edge_statistics(
     node_is_sample,
+    individuals_unphased,
+    nodes_individual,
     mutations_node,
     mutations_position,
     edges_parent,
@@ -130,25 +146,47 @@ def _count_mutations(
     sequence_length,
     size_biased,
 ):
+    """
+    Single sweep over the edge indexes that counts mutations and span per edge
+    (with and without size-biasing), and groups edges beneath unphased
+    individuals into singleton blocks.
+    """
     assert edges_parent.size == edges_child.size == edges_left.size == edges_right.size
     assert indexes_insert.size == indexes_remove.size == edges_parent.size
     assert mutations_node.size == mutations_position.size
+    assert nodes_individual.size == node_is_sample.size
 
     num_mutations = mutations_node.size
     num_edges = edges_parent.size
     num_nodes = node_is_sample.size
+    num_individuals = individuals_unphased.size
 
     indexes_mutation = np.argsort(mutations_position)
     position_insert = edges_left[indexes_insert]
     position_remove = edges_right[indexes_remove]
     position_mutation = mutations_position[indexes_mutation]
 
+    # mutation counts and spans
     nodes_samples = np.zeros(num_nodes)
     nodes_edge = np.full(num_nodes, tskit.NULL)
     nodes_parent = np.full(num_nodes, tskit.NULL)
     mutations_edge = np.full(num_mutations, tskit.NULL)
     edges_mutations = np.zeros(num_edges)
     edges_span = np.zeros(num_edges)
+    edges_sb_mutations = np.zeros(num_edges)
+    edges_sb_span = np.zeros(num_edges)
+
+    # singleton blocks
+    individuals_edges = np.full((num_individuals, 2), tskit.NULL)
+    individuals_position = np.full(num_individuals, np.nan)
+    individuals_singletons = np.zeros(num_individuals)
+    individuals_block = np.full(num_individuals, tskit.NULL)
+    mutations_block = np.full(num_mutations, tskit.NULL)
+    blocks_span = []
+    blocks_singletons = []
+    blocks_edges = []
+    blocks_order = []
+    num_blocks = 0
 
     nodes_samples[node_is_sample] = 1.0
     left = 0.0
@@ -161,13 +199,27 @@ def _count_mutations(
             p, c = edges_parent[e], edges_child[e]
             nodes_edge[c] = tskit.NULL
             nodes_parent[c] = tskit.NULL
+            edges_span[e] -= remainder
             if size_biased:
-                while p != tskit.NULL:  # downdate sample counts
-                    edges_span[e] -= nodes_samples[c] * remainder
-                    nodes_samples[p] -= nodes_samples[c]
-                    e, p = nodes_edge[p], nodes_parent[p]
-            else:
-                edges_span[e] -= remainder
+                f, q = e, p
+                while q != tskit.NULL:  # downdate sample counts
+                    edges_sb_span[f] -= nodes_samples[c] * remainder
+                    nodes_samples[q] -= nodes_samples[c]
+                    f, q = nodes_edge[q], nodes_parent[q]
+            i = nodes_individual[c]
+            if i != tskit.NULL and individuals_unphased[i]:
+                u, v = individuals_edges[i]
+                assert u == e or v == e
+                s = u if v == e else v
+                individuals_edges[i] = s, tskit.NULL
+                if s != tskit.NULL:  # flush block
+                    blocks_order.append(individuals_block[i])
+                    blocks_edges.extend([e, s])
+                    blocks_singletons.append(individuals_singletons[i])
+                    blocks_span.append(left - individuals_position[i])
+                    individuals_position[i] = np.nan
+                    individuals_block[i] = tskit.NULL
+                    individuals_singletons[i] = 0.0
             b += 1
 
         while a < num_edges and position_insert[a] == left:  # edges in
@@ -175,13 +227,22 @@ def _count_mutations(
             p, c = edges_parent[e], edges_child[e]
             nodes_edge[c] = e
             nodes_parent[c] = p
+            edges_span[e] += remainder
             if size_biased:
-                while p != tskit.NULL:  # update sample counts
-                    edges_span[e] += nodes_samples[c] * remainder
-                    nodes_samples[p] += nodes_samples[c]
-                    e, p = nodes_edge[p], nodes_parent[p]
-            else:
-                edges_span[e] += remainder
+                f, q = e, p
+                while q != tskit.NULL:  # update sample counts
+                    edges_sb_span[f] += nodes_samples[c] * remainder
+                    nodes_samples[q] += nodes_samples[c]
+                    f, q = nodes_edge[q], nodes_parent[q]
+            i = nodes_individual[c]
+            if i != tskit.NULL and individuals_unphased[i]:
+                u, v = individuals_edges[i]
+                assert u == tskit.NULL or v == tskit.NULL
+                individuals_edges[i] = [e, max(u, v)]
+                individuals_position[i] = left
+                if individuals_block[i] == tskit.NULL:
+                    individuals_block[i] = num_blocks
+                    num_blocks += 1
             a += 1
 
         right = sequence_length
@@ -191,41 +252,75 @@ def _count_mutations(
             right = min(right, position_insert[a])
         left = right
 
-        while d < num_mutations and position_mutation[d] < right:
+        while d < num_mutations and position_mutation[d] < right:  # mutations
             m = indexes_mutation[d]
             c = mutations_node[m]
             e = nodes_edge[c]
             if e != tskit.NULL:
                 mutations_edge[m] = e
-                edges_mutations[e] += nodes_samples[c] if size_biased else 1.0
+                edges_mutations[e] += 1.0
+                if size_biased:
+                    edges_sb_mutations[e] += nodes_samples[c]
+            i = nodes_individual[c]
+            if i != tskit.NULL and individuals_unphased[i]:
+                mutations_block[m] = individuals_block[i]
+                individuals_singletons[i] += 1.0
             d += 1
 
     mutations_edge = mutations_edge.astype(np.int32)
     edges_stats = np.column_stack((edges_mutations, edges_span))
-
-    return edges_stats, mutations_edge
+    edges_sb_stats = np.column_stack((edges_sb_mutations, edges_sb_span))
+
+    mutations_block = mutations_block.astype(np.int32)
+    blocks_edges = np.array(blocks_edges, dtype=np.int32).reshape(-1, 2)
+    blocks_stats = np.column_stack((np.array(blocks_singletons), np.array(blocks_span)))
+    assert num_blocks == blocks_edges.shape[0] == blocks_stats.shape[0]
+
+    # sort block arrays so that mutations_block points to correct row
+    blocks_order = np.argsort(np.array(blocks_order))
+    blocks_edges = blocks_edges[blocks_order]
+    blocks_stats = blocks_stats[blocks_order]
+
+    return (
+        edges_stats,
+        edges_sb_stats,
+        mutations_edge,
+        blocks_stats,
+        blocks_edges,
+        mutations_block,
+    )
 
 
-def count_mutations(ts, node_is_sample=None, size_biased=False):
+def edge_statistics(ts, individuals_unphased=None, size_biased=True, node_is_sample=None):
     """
-    Return an array with `num_edges` rows, and columns that are the number of
-    mutations per edge and the total span per edge. If `size_biased` is `True`,
-    then mutations and edges are weighted by frequency.
-
-    Note that weighting edges by frequency is done tree-by-tree.
+    Return per-edge mutation statistics and singleton blocks from a single pass
+    through the tree sequence. Returns a tuple of:
+
+    - the number of mutations and the span per edge
+    - the size-biased number of mutations and span per edge (zero if
+      `size_biased` is `False`)
+    - the edge above each mutation
+    - the number of singleton mutations and the span per singleton block
+    - the pair of edges in each singleton block
+    - the singleton block containing each mutation
+
+    Note that weighting edges by frequency is done tree-by-tree, using
+    `node_is_sample` (by default, the sample nodes) as the leaves.
     """
-    # TODO: adjust spans by an accessibility mask:
-    # need to supply cumulative accessible sequence at each
-    # breakpoint
-
+    if individuals_unphased is None:
+        individuals_unphased = np.full(ts.num_individuals, False)
+    check_unphased_individuals(ts, individuals_unphased)
     if node_is_sample is None:
         node_is_sample = np.full(ts.num_nodes, False)
         node_is_sample[list(ts.samples())] = True
     else:
-        assert node_is_sample.size != ts.num_nodes
+        assert node_is_sample.size == ts.num_nodes
 
-    return _count_mutations(
+    # TODO: adjust spans by an accessibility mask
+    return _edge_statistics(
         node_is_sample,
+        individuals_unphased,
+        ts.nodes_individual,
         ts.mutations_node,
         ts.sites_position[ts.mutations_site],
         ts.edges_parent,
@@ -239,6 +334,19 @@ def count_mutations(ts, node_is_sample=None, size_biased=False):
     )
 
 
+def count_mutations(ts, node_is_sample=None, size_biased=False):
+    """
+    Return an array with `num_edges` rows, and columns that are the number of
+    mutations per edge and the total span per edge. If `size_biased` is `True`,
+    then mutations and edges are weighted by frequency. Also returns the edge
+    above each mutation. See `edge_statistics`.
+    """
+    edges_stats, edges_sb_stats, mutations_edge, *_ = edge_statistics(
+        ts, size_biased=size_biased, node_is_sample=node_is_sample
+    )
+    return edges_sb_stats if size_biased else edges_stats, mutations_edge
+
+
 @numba_jit(_tuple((_f1w, _f1w, _f1w, _i1w))(_f1r, _f2r, _i1r, _i1r))
 def mutational_area(
     nodes_time,
@@ -226,6 +226,35 @@ def nodes_time_unconstrained(tree_sequence):
     return nodes_time
 
 
+def node_posteriors_from_metadata(tree_sequence):
+    """
+    Return the posterior mean and variance of node times stored in the ``"mn"``
+    and ``"vr"`` node metadata fields of a tree sequence dated by ``tsdate``, in
+    the same format as
+    :meth:`~variational.ExpectationPropagation.node_posteriors`. Nodes
+    without these metadata fields are given a mean and variance of ``NaN``.
+    Will produce an error if no node contains this information.
+    """
+    data = np.full(
+        tree_sequence.num_nodes, np.nan, dtype=[("mean", float), ("variance", float)]
+    )
+    for node in tree_sequence.nodes():
+        metadata = node.metadata
+        if isinstance(metadata, bytes):
+            try:
+                metadata = json.loads(metadata.decode() or "{}")
+            except (UnicodeDecodeError, json.decoder.JSONDecodeError):
+                continue
+        if isinstance(metadata, dict) and "mn" in metadata and "vr" in metadata:
+            data[node.id] = (metadata["mn"], metadata["vr"])
+    if np.all(np.isnan(data["mean"])):
+        raise ValueError(
+            "Tree sequence has no node time metadata: it must be dated by tsdate "
+            "with node metadata set"
+        )
+    return data
+
+
 def sites_time_from_ts(
     tree_sequence, *, unconstrained=True, node_selection="child", min_time=1
 ):
@@ -24,20 +24,47 @@
 Expectation propagation implementation
 """
 
+import collections
+import functools
+import heapq
 import logging
+import multiprocessing
+import os
 import time
 
 import numpy as np
 import tskit
+from numba import prange
 from numba.types import void as _void
 from tqdm.auto import tqdm
 
 from . import approx
-from .accelerate import numba_jit
-from .approx import _b, _b1r, _f, _f1r, _f1w, _f2r, _f2w, _f3r, _f3w, _i, _i1r, _i2r
-from .phasing import block_singletons, reallocate_unphased
+from .accelerate import numba_jit, numba_threads
+from .approx import (
+    _b,
+    _b1r,
+    _f,
+    _f1r,
+    _f1w,
+    _f2r,
+    _f2w,
+    _f3r,
+    _f3w,
+    _i,
+    _i1r,
+    _i1w,
+    _i2r,
+    _s1r,
+    _s2r,
+    _s2w,
+    _s3r,
+    _s3w,
+    _tuple,
+)
+from .instrumentation import Instrumentation
+from .phasing import reallocate_unphased
 from .rescaling import (
-    count_mutations,
+    edge_statistics,
     mutational_timescale,
     piecewise_scale_point_estimate,
     piecewise_scale_posterior,
@@ -66,8 +93,11 @@ UPPER = 1  # upper bound on node
 USE_EDGE_LIKELIHOOD = False
 USE_BLOCK_LIKELIHOOD = True
 
+# format version for checkpoints of the EP state
+CHECKPOINT_VERSION = 2
+
 
-@numba_jit(_f(_f1r, _f1r, _f))
+@numba_jit([_f(_f1r, _f1r, _f), _f(_s1r, _f1r, _f)])
 def _damp(x, y, s):
     """
     If `x - y` is too small, find `d` so that `x - d*y` is large enough:
@@ -90,7 +120,7 @@ def _damp(x, y, s):
     return d
 
 
-@numba_jit(_f(_f1r, _f))
+@numba_jit([_f(_f1r, _f), _f(_s1r, _f)])
 def _rescale(x, s):
     """
     Find `d` so that `d*x[0] + 1 <= s[0]` or `d*x[0] + 1 >= 1/s[0]`
@@ -107,6 +137,331 @@ def _rescale(x, s):
     return 1.0
 
 
+@numba_jit(
+    [
+        _void(_i, _i1r, _i1r, _f2r, _f2r, _b1r, _f2w, _f3w, _f1w, _f1w, _f, _f, _b),
+        _void(_i, _i1r, _i1r, _s2r, _f2r, _b1r, _s2w, _s3w, _f1w, _f1w, _f, _f, _b),
+    ]
+)
+def _propagate_edge(
+    i,
+    edges_parent,
+    edges_child,
+    likelihoods,
+    constraints,
+    fixed,
+    posterior,
+    factors,
+    lognorm,
+    scale,
+    max_shape,
+    min_step,
+    unphased,
+):
+    """
+    Update the approximating factors for the Poisson mutation likelihood on
+    edge `i`, modifying the parent and child posteriors in place. Only the
+    rows of `posterior`, `scale` for the parent and child, and the rows of
+    `factors`, `lognorm` for the edge are read or written.
+    """
+
+    def cavity_damping(x, y):
+        return _damp(x, y, min_step)
+
+    def posterior_damping(x):
+        return _rescale(x, max_shape)
+
+    def leafward_projection(x, y, z):
+        if unphased:
+            return approx.sideways_projection(x, y, z)
+        return approx.leafward_projection(x, y, z)
+
+    def rootward_projection(x, y, z):
+        if unphased:
+            return approx.sideways_projection(x, y, z)
+        return approx.rootward_projection(x, y, z)
+
+    def gamma_projection(x, y, z):
+        if unphased:
+            return approx.unphased_projection(x, y, z)
+        return approx.gamma_projection(x, y, z)
+
+    def twin_projection(x, y):
+        assert unphased, "Invalid update"
+        return approx.twin_projection(x, y)
+
+    p, c = edges_parent[i], edges_child[i]
+    if fixed[p] and fixed[c]:
+        return
+    elif fixed[p] and not fixed[c]:
+        # in practice this should only occur if a sample is the
+        # ancestor of another sample
+        child_message = factors[i, LEAFWARD] * scale[c]
+        child_delta = cavity_damping(posterior[c], child_message)
+        child_cavity = posterior[c] - child_delta * child_message
+        edge_likelihood = child_delta * likelihoods[i]
+        parent_age = constraints[p, LOWER]
+        lognorm[i], posterior[c] = leafward_projection(
+            parent_age,
+            child_cavity,
+            edge_likelihood,
+        )
+        factors[i, LEAFWARD] *= 1.0 - child_delta
+        factors[i, LEAFWARD] += (posterior[c] - child_cavity) / scale[c]
+        child_eta = posterior_damping(posterior[c])
+        posterior[c] *= child_eta
+        scale[c] *= child_eta
+    elif fixed[c] and not fixed[p]:
+        # in practice this should only occur if a sample has age
+        # greater than zero
+        parent_message = factors[i, ROOTWARD] * scale[p]
+        parent_delta = cavity_damping(posterior[p], parent_message)
+        parent_cavity = posterior[p] - parent_delta * parent_message
+        edge_likelihood = parent_delta * likelihoods[i]
+        child_age = constraints[c, LOWER]
+        lognorm[i], posterior[p] = rootward_projection(
+            child_age,
+            parent_cavity,
+            edge_likelihood,
+        )
+        factors[i, ROOTWARD] *= 1.0 - parent_delta
+        factors[i, ROOTWARD] += (posterior[p] - parent_cavity) / scale[p]
+        parent_eta = posterior_damping(posterior[p])
+        posterior[p] *= parent_eta
+        scale[p] *= parent_eta
+    else:
+        if p == c:  # singleton block with single parent
+            parent_message = factors[i, ROOTWARD] * scale[p]
+            parent_delta = cavity_damping(posterior[p], parent_message)
+            parent_cavity = posterior[p] - parent_delta * parent_message
+            edge_likelihood = parent_delta * likelihoods[i]
+            child_age = constraints[c, LOWER]
+            lognorm[i], posterior[p] = \
+                twin_projection(parent_cavity, edge_likelihood)  # fmt: skip
+            factors[i, ROOTWARD] *= 1.0 - parent_delta
+            factors[i, ROOTWARD] += (posterior[p] - parent_cavity) / scale[p]
+            parent_eta = posterior_damping(posterior[p])
+            posterior[p] *= parent_eta
+            scale[p] *= parent_eta
+        else:
+            # lower-bound cavity
+            parent_message = factors[i, ROOTWARD] * scale[p]
+            child_message = factors[i, LEAFWARD] * scale[c]
+            parent_delta = cavity_damping(posterior[p], parent_message)
+            child_delta = cavity_damping(posterior[c], child_message)
+            delta = min(parent_delta, child_delta)
+
+            parent_cavity = posterior[p] - delta * parent_message
+            child_cavity = posterior[c] - delta * child_message
+            edge_likelihood = delta * likelihoods[i]
+
+            # match moments and update factors
+            lognorm[i], posterior[p], posterior[c] = gamma_projection(
+                parent_cavity,
+                child_cavity,
+                edge_likelihood,
+            )
+            factors[i, ROOTWARD] *= 1.0 - delta
+            factors[i, ROOTWARD] += (posterior[p] - parent_cavity) / scale[p]
+            factors[i, LEAFWARD] *= 1.0 - delta
+            factors[i, LEAFWARD] += (posterior[c] - child_cavity) / scale[c]
+
+            # upper-bound posterior
+            parent_eta = posterior_damping(posterior[p])
+            child_eta = posterior_damping(posterior[c])
+            posterior[p] *= parent_eta
+            posterior[c] *= child_eta
+            scale[p] *= parent_eta
+            scale[c] *= child_eta
+
+
+@numba_jit(
+    [
+        _void(_i, _f2w, _f1w, _i1r, _i1r, _i1r, _f2r, _f2r, _b1r, _f2r, _f3r, _f1r, _b),
+        _void(_i, _f2w, _f1w, _i1r, _i1r, _i1r, _s2r, _f2r, _b1r, _s2r, _s3r, _f1r, _b),
+    ]
+)
+def _propagate_mutation(
+    m,
+    mutations_posterior,
+    mutations_phase,
+    mutations_edge,
+    edges_parent,
+    edges_child,
+    likelihoods,
+    constraints,
+    fixed,
+    posterior,
+    factors,
+    scale,
+    unphased,
+):
+    """
+    Calculate the posterior and phase of mutation `m`, from the cavity
+    distributions for the nodes of its edge. Only row `m` of
+    `mutations_posterior`, `mutations_phase` is written.
+    """
+
+    # TODO: scale should be 1.0, can we delete
+    # TODO: we don't seem to need to damp?
+
+    def leafward_projection(x, y, z):
+        if unphased:
+            return approx.mutation_sideways_projection(x, y, z)
+        return approx.mutation_leafward_projection(x, y, z)
+
+    def rootward_projection(x, y, z):
+        if unphased:
+            return approx.mutation_sideways_projection(x, y, z)
+        return approx.mutation_rootward_projection(x, y, z)
+
+    def gamma_projection(x, y, z):
+        if unphased:
+            return approx.mutation_unphased_projection(x, y, z)
+        return approx.mutation_gamma_projection(x, y, z)
+
+    def fixed_projection(x, y):
+        if unphased:
+            return approx.mutation_block_projection(x, y)
+        return approx.mutation_edge_projection(x, y)
+
+    twin_projection = approx.mutation_twin_projection
+
+    i = mutations_edge[m]
+    if i == tskit.NULL:  # skip mutations above root
+        return
+    p, c = edges_parent[i], edges_child[i]
+    if fixed[p] and fixed[c]:
+        child_age = constraints[c, 0]
+        parent_age = constraints[p, 0]
+        mutations_phase[m], mutations_posterior[m] = \
+            fixed_projection(parent_age, child_age)  # fmt: skip
+    elif fixed[p] and not fixed[c]:
+        child_message = factors[i, LEAFWARD] * scale[c]
+        child_delta = 1.0  # hopefully we don't need to damp
+        child_cavity = posterior[c] - child_delta * child_message
+        edge_likelihood = child_delta * likelihoods[i]
+        parent_age = constraints[p, LOWER]
+        mutations_phase[m], mutations_posterior[m] = leafward_projection(
+            parent_age,
+            child_cavity,
+            edge_likelihood,
+        )
+    elif fixed[c] and not fixed[p]:
+        parent_message = factors[i, ROOTWARD] * scale[p]
+        parent_delta = 1.0  # hopefully we don't need to damp
+        parent_cavity = posterior[p] - parent_delta * parent_message
+        edge_likelihood = parent_delta * likelihoods[i]
+        child_age = constraints[c, LOWER]
+        mutations_phase[m], mutations_posterior[m] = rootward_projection(
+            child_age,
+            parent_cavity,
+            edge_likelihood,
+        )
+    else:
+        if p == c:  # singleton block with single parent
+            parent_message = factors[i, ROOTWARD] * scale[p]
+            parent_delta = 1.0  # hopefully we don't need to damp
+            parent_cavity = posterior[p] - parent_delta * parent_message
+            edge_likelihood = parent_delta * likelihoods[i]
+            child_age = constraints[c, LOWER]
+            mutations_phase[m], mutations_posterior[m] = \
+                twin_projection(parent_cavity, edge_likelihood)  # fmt: skip
+        else:
+            parent_message = factors[i, ROOTWARD] * scale[p]
+            child_message = factors[i, LEAFWARD] * scale[c]
+            parent_delta = 1.0  # hopefully we don't need to damp
+            child_delta = 1.0  # hopefully we don't need to damp
+            delta = min(parent_delta, child_delta)
+            parent_cavity = posterior[p] - delta * parent_message
+            child_cavity = posterior[c] - delta * child_message
+            edge_likelihood = delta * likelihoods[i]
+            mutations_phase[m], mutations_posterior[m] = gamma_projection(
+                parent_cavity,
+                child_cavity,
+                edge_likelihood,
+            )
+
+
+@numba_jit(_tuple((_i1w, _i1w))(_i1r, _i1r, _i1r, _b1r))
+def _edge_schedule(edge_order, edges_parent, edges_child, fixed):
+    """
+    Partition a sequence of edge updates into batches, such that no two edges
+    in a batch share an unfixed node. Each update is placed in the batch after
+    the last one that touched either of its unfixed nodes, so the updates to
+    any given node happen in the same order as in `edge_order`. Updates within
+    a batch are independent and may be run concurrently, with results that
+    are identical to a serial pass through `edge_order`.
+
+    Returns the reordered updates and the offsets of each batch.
+    """
+    assert edges_parent.size == edges_child.size
+    num_updates = edge_order.size
+    nodes_batch = np.full(fixed.size, -1, dtype=np.int32)
+    updates_batch = np.zeros(num_updates, dtype=np.int32)
+    num_batches = 0
+    for k, i in enumerate(edge_order):
+        p, c = edges_parent[i], edges_child[i]
+        b = -1
+        if not fixed[p]:
+            b = max(b, nodes_batch[p])
+        if not fixed[c]:
+            b = max(b, nodes_batch[c])
+        b += 1
+        if not fixed[p]:
+            nodes_batch[p] = b
+        if not fixed[c]:
+            nodes_batch[c] = b
+        updates_batch[k] = b
+        num_batches = max(num_batches, b + 1)
+    batch_offsets = np.zeros(num_batches + 1, dtype=np.int32)
+    for b in updates_batch:
+        batch_offsets[b + 1] += 1
+    batch_offsets[:] = np.cumsum(batch_offsets)
+    batch_position = batch_offsets[:-1].copy()
+    batch_order = np.zeros(num_updates, dtype=np.int32)
+    for k, i in enumerate(edge_order):
+        b = updates_batch[k]
+        batch_order[batch_position[b]] = i
+        batch_position[b] += 1
+    return batch_order, batch_offsets
+
+
+@numba_jit(_f(_f, _f, _f, _f, _f, _f))
+def _relative_change(x0, x1, y0, y1, z0, z1):
+    """
+    The largest change between natural parameters `(x0, x1)` and `(y0, y1)`,
+    relative to the shape and rate of the gamma distribution with natural
+    parameters `(z0, z1)`.
+    """
+    return max(abs(x0 - y0) / (z0 + 1), abs(x1 - y1) / z1)
+
+
+@numba_jit(_tuple((_i1w, _i1w))(_i1r, _i1r, _i1r, _i))
+def _node_edges(edge_order, edges_parent, edges_child, num_nodes):
+    """
+    Find the distinct edges in `edge_order` that are attached to each node.
+
+    Returns the edges sorted by node and the offsets of each node.
+    """
+    assert edges_parent.size == edges_child.size
+    visited = np.full(edges_parent.size, False)
+    node_offsets = np.zeros(num_nodes + 1, dtype=np.int32)
+    for i in edge_order:
+        if not visited[i]:
+            visited[i] = True
+            node_offsets[edges_parent[i] + 1] += 1
+            node_offsets[edges_child[i] + 1] += 1
+    node_offsets[:] = np.cumsum(node_offsets)
+    node_position = node_offsets[:-1].copy()
+    node_edges = np.zeros(node_offsets[-1], dtype=np.int32)
+    for i in np.flatnonzero(visited):
+        for n in (edges_parent[i], edges_child[i]):
+            node_edges[node_position[n]] = i
+            node_position[n] += 1
+    return node_edges, node_offsets
+
+
 class ExpectationPropagation:
     r"""
     The class that encapsulates running the variational gamma approach to
@@ -185,7 +540,16 @@ class ExpectationPropagation:
         posterior_check += node_factors[:, CONSTRNT]
         np.testing.assert_allclose(posterior_check, posterior)
 
-    def __init__(self, ts, *, mutation_rate, allow_unary=None, singletons_phased=True):
+    def __init__(
+        self,
+        ts,
+        *,
+        mutation_rate,
+        allow_unary=None,
+        singletons_phased=True,
+        single_precision=False,
+        instrumentation=None,
+    ):
         """
         Initialize an expectation propagation algorithm for dating nodes
         in a tree sequence.
@@ -200,9 +564,21 @@ class ExpectationPropagation:
             ordering of nodes.
         :param ~float mutation_rate: the expected per-base mutation rate per
             time unit.
+        :param bool single_precision: if True, store likelihoods, factors and
+            posteriors as 32-bit floats, which are widened to 64-bit floats
+            during moment matching. This roughly halves memory usage.
+        :param ~instrumentation.Instrumentation instrumentation: an object in
+            which to record timings and counts. If None, a new one is created.
         """
 
         self._check_valid_inputs(ts, mutation_rate, allow_unary)
+        self.dtype = np.float32 if single_precision else np.float64
+        self.mutation_rate = mutation_rate
+        self.singletons_phased = singletons_phased
+        #: An :class:`~instrumentation.Instrumentation` holding timings and counts
+        self.instrumentation = instrumentation
+        if instrumentation is None:
+            self.instrumentation = Instrumentation()
         self.edge_parents = ts.edges_parent
         self.edge_children = ts.edges_child
 
@@ -215,36 +591,41 @@ class ExpectationPropagation:
             self.node_constraints, self.edge_parents, self.edge_children
         )
 
-        # count mutations on edges
-        count_timing = time.time()
-        self.edge_likelihoods, self.mutation_edges = count_mutations(ts)
-        self.edge_likelihoods[:, 1] *= mutation_rate
-        self.sizebiased_likelihoods, _ = count_mutations(ts, size_biased=True)
-        self.sizebiased_likelihoods[:, 1] *= mutation_rate
-        count_timing -= time.time()
-        logger.debug(f"Extracted mutations in {abs(count_timing):.2f} seconds")
-
-        # count mutations in singleton blocks
-        phase_timing = time.time()
-        individual_phased = np.full(ts.num_individuals, singletons_phased)
-        self.block_likelihoods, self.block_edges, self.mutation_blocks = \
-            block_singletons(ts, ~individual_phased)  # fmt: skip
-        self.block_likelihoods[:, 1] *= mutation_rate
-        num_blocks = self.block_likelihoods.shape[0]
-        self.block_nodes = np.full((2, num_blocks), tskit.NULL, dtype=np.int32)
-        self.block_nodes[0] = self.edge_parents[self.block_edges[:, 0]]
-        self.block_nodes[1] = self.edge_parents[self.block_edges[:, 1]]
-        num_unphased = np.sum(self.mutation_blocks != tskit.NULL)
-        phase_timing -= time.time()
+        # count mutations on edges and in singleton blocks
+        with self.instrumentation.stage("mutation_counts"):
+            individual_phased = np.full(ts.num_individuals, singletons_phased)
+            (
+                self.edge_likelihoods,
+                self.sizebiased_likelihoods,
+                self.mutation_edges,
+                self.block_likelihoods,
+                self.block_edges,
+                self.mutation_blocks,
+            ) = edge_statistics(ts, ~individual_phased)
+            self.edge_likelihoods[:, 1] *= mutation_rate
+            self.sizebiased_likelihoods[:, 1] *= mutation_rate
+            self.block_likelihoods[:, 1] *= mutation_rate
+            self.edge_likelihoods = self.edge_likelihoods.astype(self.dtype, copy=False)
+            self.sizebiased_likelihoods = \
+                self.sizebiased_likelihoods.astype(self.dtype, copy=False)  # fmt: skip
+            self.block_likelihoods = self.block_likelihoods.astype(self.dtype, copy=False)
+            num_blocks = self.block_likelihoods.shape[0]
+            self.block_nodes = np.full((2, num_blocks), tskit.NULL, dtype=np.int32)
+            self.block_nodes[0] = self.edge_parents[self.block_edges[:, 0]]
+            self.block_nodes[1] = self.edge_parents[self.block_edges[:, 1]]
+            num_unphased = np.sum(self.mutation_blocks != tskit.NULL)
+        count_timing = self.instrumentation.time("mutation_counts")
+        self.instrumentation.count("unphased_singletons", num_unphased)
+        self.instrumentation.count("singleton_blocks", num_blocks)
         logger.info(f"Found {num_unphased} unphased singleton mutations")
         logger.info(f"Split unphased singleton edges into {num_blocks} blocks")
-        logger.debug(f"Phased singletons in {abs(phase_timing):.2f} seconds")
+        logger.debug(f"Extracted mutations in {count_timing:.2f} seconds")
 
         # mutable
-        self.node_factors = np.zeros((ts.num_nodes, 2, 2))
-        self.edge_factors = np.zeros((ts.num_edges, 2, 2))
-        self.block_factors = np.zeros((num_blocks, 2, 2))
-        self.node_posterior = np.zeros((ts.num_nodes, 2))
+        self.node_factors = np.zeros((ts.num_nodes, 2, 2), dtype=self.dtype)
+        self.edge_factors = np.zeros((ts.num_edges, 2, 2), dtype=self.dtype)
+        self.block_factors = np.zeros((num_blocks, 2, 2), dtype=self.dtype)
+        self.node_posterior = np.zeros((ts.num_nodes, 2), dtype=self.dtype)
         self.mutation_posterior = np.full((ts.num_mutations, 2), np.nan)
         self.mutation_phase = np.ones(ts.num_mutations)
         self.mutation_nodes = ts.mutations_node.copy()
@@ -271,8 +652,22 @@ class ExpectationPropagation:
         self.block_order = np.arange(num_blocks, dtype=np.int32)
         self.mutation_order = np.arange(ts.num_mutations, dtype=np.int32)
 
+        # batches of independent updates for multithreading, built on demand
+        self.edge_schedule = None
+        self.block_schedule = None
+
+        # edges attached to each node and residuals for prioritised updates,
+        # built on demand
+        self.node_edges = None
+        self.edge_residual = None
+
     @staticmethod
-    @numba_jit(_void(_i1r, _i1r, _i1r, _f2r, _f2r, _f2w, _f3w, _f1w, _f1w, _f, _f, _b))
+    @numba_jit(
+        [
+            _void(_i1r, _i1r, _i1r, _f2r, _f2r, _f2w, _f3w, _f1w, _f1w, _f, _f, _b),
+            _void(_i1r, _i1r, _i1r, _s2r, _f2r, _s2w, _s3w, _f1w, _f1w, _f, _f, _b),
+        ]
+    )
     def propagate_likelihood(
         edge_order,
         edges_parent,
@@ -317,120 +712,230 @@ class ExpectationPropagation:
         assert max_shape >= 1.0
         assert 0.0 < min_step < 1.0
 
-        def cavity_damping(x, y):
-            return _damp(x, y, min_step)
+        fixed = constraints[:, LOWER] == constraints[:, UPPER]
 
-        def posterior_damping(x):
-            return _rescale(x, max_shape)
+        for i in edge_order:
+            _propagate_edge(
+                i,
+                edges_parent,
+                edges_child,
+                likelihoods,
+                constraints,
+                fixed,
+                posterior,
+                factors,
+                lognorm,
+                scale,
+                max_shape,
+                min_step,
+                unphased,
+            )
+
+    @staticmethod
+    @numba_jit(parallel=True)
+    def propagate_likelihood_threaded(
+        batch_order,
+        batch_offsets,
+        edges_parent,
+        edges_child,
+        likelihoods,
+        constraints,
+        posterior,
+        factors,
+        lognorm,
+        scale,
+        max_shape,
+        min_step,
+        unphased,
+    ):
+        # Multithreaded equivalent of `propagate_likelihood`, where edges are
+        # visited in batches from `_edge_schedule`. Edges within a batch share no
+        # unfixed nodes, so are updated concurrently.
+        #
+        # :param numpy.ndarray batch_order: integer array of edges, ordered by batch
+        # :param numpy.ndarray batch_offsets: integer array of offsets into
+        #     `batch_order` for the start of each batch
+        #
+        # Other parameters are as in `propagate_likelihood`.
+        #
+        # Unlike the other kernels this is compiled on first use rather than
+        # from explicit signatures, because compiling a parallel kernel starts
+        # numba's thread pool, after which forked processes (e.g. the
+        # multiprocessing pools used by the discrete-time methods) hang.
 
-        def leafward_projection(x, y, z):
-            if unphased:
-                return approx.sideways_projection(x, y, z)
-            return approx.leafward_projection(x, y, z)
+        assert constraints.shape == posterior.shape
+        assert edges_child.size == edges_parent.size
+        assert factors.shape == (edges_parent.size, 2, 2)
+        assert likelihoods.shape == (edges_parent.size, 2)
+        assert batch_offsets[-1] == batch_order.size
+        assert max_shape >= 1.0
+        assert 0.0 < min_step < 1.0
 
-        def rootward_projection(x, y, z):
-            if unphased:
-                return approx.sideways_projection(x, y, z)
-            return approx.rootward_projection(x, y, z)
+        fixed = constraints[:, LOWER] == constraints[:, UPPER]
 
-        def gamma_projection(x, y, z):
-            if unphased:
-                return approx.unphased_projection(x, y, z)
-            return approx.gamma_projection(x, y, z)
+        for b in range(batch_offsets.size - 1):
+            for k in prange(batch_offsets[b], batch_offsets[b + 1]):
+                _propagate_edge(
+                    batch_order[k],
+                    edges_parent,
+                    edges_child,
+                    likelihoods,
+                    constraints,
+                    fixed,
+                    posterior,
+                    factors,
+                    lognorm,
+                    scale,
+                    max_shape,
+                    min_step,
+                    unphased,
+                )
+
+    @staticmethod
+    @numba_jit(
+        [
+            _i(
+                _i1r, _i1r, _i1r, _i1r, _i1r, _i1r, _f2r, _f2r,
+                _f2w, _f3w, _f1w, _f1w, _f1w, _f, _f, _i, _f,
+            ),
+            _i(
+                _i1r, _i1r, _i1r, _i1r, _i1r, _i1r, _s2r, _f2r,
+                _s2w, _s3w, _f1w, _f1w, _f1w, _f, _f, _i, _f,
+            ),
+        ]
+    )  # fmt: skip
+    def propagate_likelihood_residual(
+        sweep_order,
+        edge_order,
+        node_edges,
+        node_offsets,
+        edges_parent,
+        edges_child,
+        likelihoods,
+        constraints,
+        posterior,
+        factors,
+        lognorm,
+        scale,
+        residual,
+        max_shape,
+        min_step,
+        max_updates,
+        tolerance,
+    ):
+        # Residual-prioritised equivalent of `propagate_likelihood`. The residual
+        # of an edge is the largest relative change in its factors when it was
+        # last updated, raised whenever an update to a neighbouring edge changes
+        # the posterior of a shared node (and so the cavity of the edge). After a
+        # pass through `sweep_order`, edges in `edge_order` are updated in order
+        # of decreasing residual until none exceed `tolerance` or the total
+        # number of updates reaches `max_updates`.
+        #
+        # :param numpy.ndarray sweep_order: integer array of edges to update in
+        #     order, before any prioritised updates
+        # :param numpy.ndarray edge_order: integer array of edges that may be
+        #     selected for prioritised updates
+        # :param numpy.ndarray node_edges: integer array of the edges in
+        #     `edge_order` attached to each node, sorted by node
+        # :param numpy.ndarray node_offsets: integer array of offsets into
+        #     `node_edges` for the start of each node
+        # :param numpy.ndarray residual: array of dimension `[num_edges]`
+        #     containing the residual for each edge, updated in-place.
+        # :param int max_updates: the maximum number of updates in total.
+        # :param float tolerance: edges with residuals that do not exceed this
+        #     value are not updated.
+        #
+        # Other parameters are as in `propagate_likelihood`. Returns the number
+        # of updates.
 
-        def twin_projection(x, y):
-            assert unphased, "Invalid update"
-            return approx.twin_projection(x, y)
+        assert constraints.shape == posterior.shape
+        assert edges_child.size == edges_parent.size
+        assert factors.shape == (edges_parent.size, 2, 2)
+        assert likelihoods.shape == (edges_parent.size, 2)
+        assert residual.size == edges_parent.size
+        assert node_offsets.size == posterior.shape[0] + 1
+        assert max_shape >= 1.0
+        assert 0.0 < min_step < 1.0
+        assert tolerance >= 0.0
 
         fixed = constraints[:, LOWER] == constraints[:, UPPER]
 
-        for i in edge_order:
+        last = np.empty((2, 2, 2))  # last message and posterior for each node
+        num_updates = 0
+        queue = [(-residual[i], i) for i in edge_order[:0]]
+        prioritise = False
+        k = 0
+        while True:
+            if k < sweep_order.size:
+                i = sweep_order[k]
+                k += 1
+            else:
+                if not prioritise:  # start prioritised updates
+                    prioritise = True
+                    queue = [
+                        (-residual[i], i)
+                        for i in np.unique(edge_order)
+                        if residual[i] > tolerance
+                    ]
+                    heapq.heapify(queue)
+                if len(queue) == 0 or num_updates >= max_updates:
+                    break
+                priority, i = heapq.heappop(queue)
+                if -priority != residual[i]:  # stale entry
+                    continue
             p, c = edges_parent[i], edges_child[i]
-            if fixed[p] and fixed[c]:
-                continue
-            elif fixed[p] and not fixed[c]:
-                # in practice this should only occur if a sample is the
-                # ancestor of another sample
-                child_message = factors[i, LEAFWARD] * scale[c]
-                child_delta = cavity_damping(posterior[c], child_message)
-                child_cavity = posterior[c] - child_delta * child_message
-                edge_likelihood = child_delta * likelihoods[i]
-                parent_age = constraints[p, LOWER]
-                lognorm[i], posterior[c] = leafward_projection(
-                    parent_age,
-                    child_cavity,
-                    edge_likelihood,
-                )
-                factors[i, LEAFWARD] *= 1.0 - child_delta
-                factors[i, LEAFWARD] += (posterior[c] - child_cavity) / scale[c]
-                child_eta = posterior_damping(posterior[c])
-                posterior[c] *= child_eta
-                scale[c] *= child_eta
-            elif fixed[c] and not fixed[p]:
-                # in practice this should only occur if a sample has age
-                # greater than zero
-                parent_message = factors[i, ROOTWARD] * scale[p]
-                parent_delta = cavity_damping(posterior[p], parent_message)
-                parent_cavity = posterior[p] - parent_delta * parent_message
-                edge_likelihood = parent_delta * likelihoods[i]
-                child_age = constraints[c, LOWER]
-                lognorm[i], posterior[p] = rootward_projection(
-                    child_age,
-                    parent_cavity,
-                    edge_likelihood,
+            for u, n in ((ROOTWARD, p), (LEAFWARD, c)):
+                for v in range(2):
+                    last[u, 0, v] = factors[i, u, v] * scale[n]
+                    last[u, 1, v] = posterior[n, v]
+            _propagate_edge(
+                i,
+                edges_parent,
+                edges_child,
+                likelihoods,
+                constraints,
+                fixed,
+                posterior,
+                factors,
+                lognorm,
+                scale,
+                max_shape,
+                min_step,
+                False,
+            )
+            num_updates += 1
+            residual[i] = 0.0
+            for u, n in ((ROOTWARD, p), (LEAFWARD, c)):
+                if fixed[n]:
+                    continue
+                z0, z1 = posterior[n, 0], posterior[n, 1]
+                change = _relative_change(
+                    factors[i, u, 0] * scale[n],
+                    factors[i, u, 1] * scale[n],
+                    last[u, 0, 0],
+                    last[u, 0, 1],
+                    z0,
+                    z1,
                 )
-                factors[i, ROOTWARD] *= 1.0 - parent_delta
-                factors[i, ROOTWARD] += (posterior[p] - parent_cavity) / scale[p]
-                parent_eta = posterior_damping(posterior[p])
-                posterior[p] *= parent_eta
-                scale[p] *= parent_eta
-            else:
-                if p == c:  # singleton block with single parent
-                    parent_message = factors[i, ROOTWARD] * scale[p]
-                    parent_delta = cavity_damping(posterior[p], parent_message)
-                    parent_cavity = posterior[p] - parent_delta * parent_message
-                    edge_likelihood = parent_delta * likelihoods[i]
-                    child_age = constraints[c, LOWER]
-                    lognorm[i], posterior[p] = \
-                        twin_projection(parent_cavity, edge_likelihood)  # fmt: skip
-                    factors[i, ROOTWARD] *= 1.0 - parent_delta
-                    factors[i, ROOTWARD] += (posterior[p] - parent_cavity) / scale[p]
-                    parent_eta = posterior_damping(posterior[p])
-                    posterior[p] *= parent_eta
-                    scale[p] *= parent_eta
-                else:
-                    # lower-bound cavity
-                    parent_message = factors[i, ROOTWARD] * scale[p]
-                    child_message = factors[i, LEAFWARD] * scale[c]
-                    parent_delta = cavity_damping(posterior[p], parent_message)
-                    child_delta = cavity_damping(posterior[c], child_message)
-                    delta = min(parent_delta, child_delta)
-
-                    parent_cavity = posterior[p] - delta * parent_message
-                    child_cavity = posterior[c] - delta * child_message
-                    edge_likelihood = delta * likelihoods[i]
-
-                    # match moments and update factors
-                    lognorm[i], posterior[p], posterior[c] = gamma_projection(
-                        parent_cavity,
-                        child_cavity,
-                        edge_likelihood,
-                    )
-                    factors[i, ROOTWARD] *= 1.0 - delta
-                    factors[i, ROOTWARD] += (posterior[p] - parent_cavity) / scale[p]
-                    factors[i, LEAFWARD] *= 1.0 - delta
-                    factors[i, LEAFWARD] += (posterior[c] - child_cavity) / scale[c]
-
-                    # upper-bound posterior
-                    parent_eta = posterior_damping(posterior[p])
-                    child_eta = posterior_damping(posterior[c])
-                    posterior[p] *= parent_eta
-                    posterior[c] *= child_eta
-                    scale[p] *= parent_eta
-                    scale[c] *= child_eta
+                residual[i] = max(residual[i], change)
+                change = _relative_change(z0, z1, last[u, 1, 0], last[u, 1, 1], z0, z1)
+                for j in node_edges[node_offsets[n] : node_offsets[n + 1]]:
+                    if j != i and change > residual[j]:
+                        residual[j] = change
+                        if prioritise and change > tolerance:
+                            heapq.heappush(queue, (-change, j))
+            if prioritise and residual[i] > tolerance:
+                heapq.heappush(queue, (-residual[i], i))
+
+        return num_updates
 
     @staticmethod
-    @numba_jit(_void(_b1r, _f2w, _f3w, _f1w, _f, _i, _f))
+    @numba_jit(
+        [
+            _void(_b1r, _f2w, _f3w, _f1w, _f, _i, _f),
+            _void(_b1r, _s2w, _s3w, _f1w, _f, _i, _f),
+        ]
+    )
     def propagate_prior(free, posterior, factors, scale, max_shape, em_maxitt, em_reltol):
         # Update approximating factors for global prior.
         #
@@ -480,7 +985,10 @@ class ExpectationPropagation:
 
     @staticmethod
     @numba_jit(
-        _void(_i1r, _f2w, _f1w, _i1r, _i1r, _i1r, _f2r, _f2r, _f2r, _f3r, _f1r, _b)
+        [
+            _void(_i1r, _f2w, _f1w, _i1r, _i1r, _i1r, _f2r, _f2r, _f2r, _f3r, _f1r, _b),
+            _void(_i1r, _f2w, _f1w, _i1r, _i1r, _i1r, _s2r, _f2r, _s2r, _s3r, _f1r, _b),
+        ]
     )
     def propagate_mutations(
         mutations_order,
@@ -520,9 +1028,6 @@ class ExpectationPropagation:
         # :param bool unphased: if True, edges are treated as blocks of unphased
         #     singletons in contemporary individuals
 
-        # TODO: scale should be 1.0, can we delete
-        # TODO: we don't seem to need to damp?
-
         # TODO: assert more stuff here?
         assert mutations_phase.size == mutations_edge.size
         assert mutations_posterior.shape == (mutations_phase.size, 2)
@@ -531,88 +1036,78 @@ class ExpectationPropagation:
         assert factors.shape == (edges_parent.size, 2, 2)
         assert likelihoods.shape == (edges_parent.size, 2)
 
-        def leafward_projection(x, y, z):
-            if unphased:
-                return approx.mutation_sideways_projection(x, y, z)
-            return approx.mutation_leafward_projection(x, y, z)
-
-        def rootward_projection(x, y, z):
-            if unphased:
-                return approx.mutation_sideways_projection(x, y, z)
-            return approx.mutation_rootward_projection(x, y, z)
+        fixed = constraints[:, LOWER] == constraints[:, UPPER]
 
-        def gamma_projection(x, y, z):
-            if unphased:
-                return approx.mutation_unphased_projection(x, y, z)
-            return approx.mutation_gamma_projection(x, y, z)
+        for m in mutations_order:
+            _propagate_mutation(
+                m,
+                mutations_posterior,
+                mutations_phase,
+                mutations_edge,
+                edges_parent,
+                edges_child,
+                likelihoods,
+                constraints,
+                fixed,
+                posterior,
+                factors,
+                scale,
+                unphased,
+            )
 
-        def fixed_projection(x, y):
-            if unphased:
-                return approx.mutation_block_projection(x, y)
-            return approx.mutation_edge_projection(x, y)
+    @staticmethod
+    @numba_jit(parallel=True)
+    def propagate_mutations_threaded(
+        mutations_order,
+        mutations_posterior,
+        mutations_phase,
+        mutations_edge,
+        edges_parent,
+        edges_child,
+        likelihoods,
+        constraints,
+        posterior,
+        factors,
+        scale,
+        unphased,
+    ):
+        # Multithreaded equivalent of `propagate_mutations`. Each mutation only
+        # writes its own row of the outputs, so all are updated concurrently.
+        # Compiled on first use, as for `propagate_likelihood_threaded`.
 
-        twin_projection = approx.mutation_twin_projection
+        assert mutations_phase.size == mutations_edge.size
+        assert mutations_posterior.shape == (mutations_phase.size, 2)
+        assert constraints.shape == posterior.shape
+        assert edges_child.size == edges_parent.size
+        assert factors.shape == (edges_parent.size, 2, 2)
+        assert likelihoods.shape == (edges_parent.size, 2)
 
         fixed = constraints[:, LOWER] == constraints[:, UPPER]
 
-        for m in mutations_order:
-            i = mutations_edge[m]
-            if i == tskit.NULL:  # skip mutations above root
-                continue
-            p, c = edges_parent[i], edges_child[i]
-            if fixed[p] and fixed[c]:
-                child_age = constraints[c, 0]
-                parent_age = constraints[p, 0]
-                mutations_phase[m], mutations_posterior[m] = \
-                    fixed_projection(parent_age, child_age)  # fmt: skip
-            elif fixed[p] and not fixed[c]:
-                child_message = factors[i, LEAFWARD] * scale[c]
-                child_delta = 1.0  # hopefully we don't need to damp
-                child_cavity = posterior[c] - child_delta * child_message
-                edge_likelihood = child_delta * likelihoods[i]
-                parent_age = constraints[p, LOWER]
-                mutations_phase[m], mutations_posterior[m] = leafward_projection(
-                    parent_age,
-                    child_cavity,
-                    edge_likelihood,
-                )
-            elif fixed[c] and not fixed[p]:
-                parent_message = factors[i, ROOTWARD] * scale[p]
-                parent_delta = 1.0  # hopefully we don't need to damp
-                parent_cavity = posterior[p] - parent_delta * parent_message
-                edge_likelihood = parent_delta * likelihoods[i]
-                child_age = constraints[c, LOWER]
-                mutations_phase[m], mutations_posterior[m] = rootward_projection(
-                    child_age,
-                    parent_cavity,
-                    edge_likelihood,
-                )
-            else:
-                if p == c:  # singleton block with single parent
-                    parent_message = factors[i, ROOTWARD] * scale[p]
-                    parent_delta = 1.0  # hopefully we don't need to damp
-                    parent_cavity = posterior[p] - parent_delta * parent_message
-                    edge_likelihood = parent_delta * likelihoods[i]
-                    child_age = constraints[c, LOWER]
-                    mutations_phase[m], mutations_posterior[m] = \
-                        twin_projection(parent_cavity, edge_likelihood)  # fmt: skip
-                else:
-                    parent_message = factors[i, ROOTWARD] * scale[p]
-                    child_message = factors[i, LEAFWARD] * scale[c]
-                    parent_delta = 1.0  # hopefully we don't need to damp
-                    child_delta = 1.0  # hopefully we don't need to damp
-                    delta = min(parent_delta, child_delta)
-                    parent_cavity = posterior[p] - delta * parent_message
-                    child_cavity = posterior[c] - delta * child_message
-                    edge_likelihood = delta * likelihoods[i]
-                    mutations_phase[m], mutations_posterior[m] = gamma_projection(
-                        parent_cavity,
-                        child_cavity,
-                        edge_likelihood,
-                    )
+        for k in prange(mutations_order.size):
+            _propagate_mutation(
+                mutations_order[k],
+                mutations_posterior,
+                mutations_phase,
+                mutations_edge,
+                edges_parent,
+                edges_child,
+                likelihoods,
+                constraints,
+                fixed,
+                posterior,
+                factors,
+                scale,
+                unphased,
+            )
 
     @staticmethod
-    @numba_jit(_void(_i1r, _i1r, _i2r, _f3w, _f3w, _f3w, _f1w))
+    @numba_jit(
+        [
+            _void(_i1r, _i1r, _i2r, _f3w, _f3w, _f3w, _f1w),
+            _void(_i1r, _i1r, _i2r, _s3w, _s3w, _s3w, _f1w),
+        ]
+    )
     def rescale_factors(
         edges_parent,
         edges_child,
@@ -633,6 +1128,184 @@ class ExpectationPropagation:
         node_factors[:, CONSTRNT] *= scale[:, np.newaxis]
         scale[:] = 1.0
 
+    def initialize_posteriors(self, mean, variance):
+        """
+        Warm-start the EP algorithm from approximate posterior moments of node
+        ages, e.g. those from a previous run of tsdate on a similar tree sequence.
+        The gamma posterior of each unfixed node is split evenly between the
+        messages on adjacent edges and singleton blocks, so that messages and
+        posteriors remain consistent. Nodes with missing or invalid moments are
+        left uninitialised.
+
+        :param numpy.ndarray mean: the posterior mean age of each node
+        :param numpy.ndarray variance: the posterior variance in age of each node
+        """
+        num_nodes = self.node_posterior.shape[0]
+        mean = np.asarray(mean, dtype=np.float64)
+        variance = np.asarray(variance, dtype=np.float64)
+        if mean.shape != (num_nodes,) or variance.shape != (num_nodes,):
+            raise ValueError(
+                f"Initial posterior moments must be given for all {num_nodes} nodes"
+            )
+        free = self.node_constraints[:, LOWER] != self.node_constraints[:, UPPER]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            natural = np.column_stack([mean**2 / variance - 1, mean / variance])
+        valid = np.logical_and.reduce(
+            [free, np.isfinite(natural).all(axis=1), mean > 0, variance > 0]
+        )
+
+        # number of messages into each node
+        edge_phased = np.full(self.edge_parents.size, False)
+        edge_phased[self.edge_order] = True
+        block_one, block_two = self.block_nodes
+        block_distinct = block_one != block_two
+        degree = np.zeros(num_nodes)
+        np.add.at(degree, self.edge_parents[edge_phased], 1)
+        np.add.at(degree, self.edge_children[edge_phased], 1)
+        np.add.at(degree, block_one, 1)
+        np.add.at(degree, block_two[block_distinct], 1)
+        valid = np.logical_and(valid, degree > 0)
+
+        message = np.zeros((num_nodes, 2))
+        message[valid] = natural[valid] / degree[valid, np.newaxis]
+        self.edge_factors[:] = 0.0
+        parents = self.edge_parents[edge_phased]
+        children = self.edge_children[edge_phased]
+        self.edge_factors[edge_phased, ROOTWARD] = message[parents]
+        self.edge_factors[edge_phased, LEAFWARD] = message[children]
+        self.block_factors[:] = 0.0
+        self.block_factors[:, ROOTWARD] = message[block_one]
+        self.block_factors[block_distinct, LEAFWARD] = message[block_two[block_distinct]]
+        self.node_factors[:] = 0.0
+        self.node_posterior[:] = 0.0
+        self.node_posterior[valid] = natural[valid]
+        self.node_scale[:] = 1.0
+        self.edge_residual = None
+        logger.info(f"Initialised posteriors for {np.sum(valid)} nodes")
+
+    def schedule(self):
+        # Partition edge and block traversal orders into batches of updates that
+        # can be run concurrently (see `_edge_schedule`)
+        fixed = self.node_constraints[:, LOWER] == self.node_constraints[:, UPPER]
+        self.block_schedule = _edge_schedule(
+            self.block_order,
+            self.block_nodes[ROOTWARD],
+            self.block_nodes[LEAFWARD],
+            fixed,
+        )
+        self.edge_schedule = _edge_schedule(
+            self.edge_order,
+            self.edge_parents,
+            self.edge_children,
+            fixed,
+        )
+        num_updates = self.edge_order.size
+        num_batches = self.edge_schedule[1].size - 1
+        logger.info(
+            f"Scheduled {num_updates} edge updates in {num_batches} batches "
+            f"(mean batch size {num_updates / max(num_batches, 1):.1f})"
+        )
+
+    def _raise_residuals(self, last_posterior):
+        # Raise the residuals of edges attached to nodes with posteriors that
+        # have changed since `last_posterior`, e.g. from updates to blocks
+        posterior = np.asarray(self.node_posterior, dtype=np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            change = np.abs(posterior - last_posterior)
+            change[:, 0] /= posterior[:, 0] + 1
+            change[:, 1] /= posterior[:, 1]
+        change = np.max(change, axis=1)
+        change[~np.isfinite(change)] = 0.0
+        np.maximum(self.edge_residual, change[self.edge_parents], out=self.edge_residual)
+        np.maximum(self.edge_residual, change[self.edge_children], out=self.edge_residual)
+
+    # mutable arrays that together determine the state of the EP algorithm
+    _checkpoint_arrays = (
+        "node_factors",
+        "edge_factors",
+        "block_factors",
+        "node_posterior",
+        "node_scale",
+        "edge_logconst",
+        "block_logconst",
+    )
+
+    def save_checkpoint(self, path, iterations):
+        """
+        Save the state of the EP algorithm to a ``.npz`` file, after a given
+        number of completed iterations. The file is written atomically, so
+        that an interrupted save does not corrupt an existing checkpoint.
+
+        :param str path: the file to write
+        :param int iterations: the number of completed EP iterations
+        """
+        arrays = {name: getattr(self, name) for name in self._checkpoint_arrays}
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as file:
+            np.savez(
+                file,
+                version=CHECKPOINT_VERSION,
+                num_nodes=self.node_posterior.shape[0],
+                num_edges=self.edge_factors.shape[0],
+                num_blocks=self.block_factors.shape[0],
+                mutation_rate=self.mutation_rate,
+                singletons_phased=self.singletons_phased,
+                dtype=np.dtype(self.dtype).str,
+                iterations=iterations,
+                mean_edge_logconst=np.array(self.mean_edge_logconst),
+                max_relative_change=np.array(self.max_relative_change),
+                **arrays,
+            )
+        os.replace(tmp_path, path)
+        logger.debug(f"Saved EP checkpoint after {iterations} iterations to {path}")
+
+    def load_checkpoint(self, path):
+        """
+        Restore the state of the EP algorithm from a file written by
+        :meth:`save_checkpoint`, checking that it was created for a tree
+        sequence with the same numbers of nodes, edges and singleton blocks,
+        and with the same mutation rate, singleton phasing and precision.
+
+        :param str path: the file to read
+        :return: the number of EP iterations completed in the checkpoint
+        :rtype: int
+        """
+        with np.load(path) as data:
+            version = int(data["version"])
+            if version != CHECKPOINT_VERSION:
+                raise ValueError(
+                    f"Checkpoint format version {version} is not supported "
+                    f"(expected version {CHECKPOINT_VERSION})"
+                )
+            for name, expected in (
+                ("mutation_rate", float(self.mutation_rate)),
+                ("singletons_phased", bool(self.singletons_phased)),
+                ("dtype", np.dtype(self.dtype).str),
+            ):
+                value = type(expected)(data[name])
+                if value != expected:
+                    raise ValueError(
+                        f"Checkpoint does not match the parameters: {name} is "
+                        f"{value} in the checkpoint but {expected} here"
+                    )
+            for name, expected in (
+                ("num_nodes", self.node_posterior.shape[0]),
+                ("num_edges", self.edge_factors.shape[0]),
+                ("num_blocks", self.block_factors.shape[0]),
+            ):
+                if int(data[name]) != expected:
+                    raise ValueError(
+                        f"Checkpoint does not match the tree sequence: {name} is "
+                        f"{int(data[name])} in the checkpoint but {expected} here"
+                    )
+            for name in self._checkpoint_arrays:
+                getattr(self, name)[:] = data[name]
+            self.mean_edge_logconst = list(data["mean_edge_logconst"])
+            self.max_relative_change = list(data["max_relative_change"])
+            iterations = int(data["iterations"])
+        logger.info(f"Resumed from EP checkpoint after {iterations} iterations")
+        return iterations
+
     def iterate(
         self,
         *,
@@ -641,39 +1314,107 @@ class ExpectationPropagation:
         em_maxitt=10,
         em_reltol=1e-8,
         regularise=True,
+        num_threads=None,
+        residual_tolerance=None,
+        max_edge_updates=None,
         check_valid=False,  # for debugging
     ):
-        logger.debug("Passing through singleton blocks")
-        self.propagate_likelihood(
-            self.block_order,
-            self.block_nodes[ROOTWARD],
-            self.block_nodes[LEAFWARD],
-            self.block_likelihoods,
-            self.node_constraints,
-            self.node_posterior,
-            self.block_factors,
-            self.block_logconst,
-            self.node_scale,
-            max_shape,
-            min_step,
-            USE_BLOCK_LIKELIHOOD,
-        )
+        # Returns the number of edge updates. If `residual_tolerance` is given,
+        # every edge is updated in the first iteration, but thereafter edges are
+        # updated in order of decreasing residual (see
+        # `propagate_likelihood_residual`), with at most `max_edge_updates`
+        # updates per iteration.
+        threaded = num_threads is not None and num_threads >= 1
+        prioritised = residual_tolerance is not None
+        if prioritised and threaded:
+            raise ValueError("Prioritised edge updates cannot be multithreaded")
+        if prioritised:
+            if self.node_edges is None:
+                self.node_edges = _node_edges(
+                    self.edge_order,
+                    self.edge_parents,
+                    self.edge_children,
+                    self.node_posterior.shape[0],
+                )
+            if self.edge_residual is None:
+                self.edge_residual = np.zeros(self.edge_parents.size)
+                sweep_order = self.edge_order
+            else:
+                sweep_order = self.edge_order[:0]
+            if max_edge_updates is None:
+                max_edge_updates = self.edge_order.size
+            last_posterior = np.asarray(self.node_posterior, dtype=np.float64)
+            block_sweep = functools.partial(self.propagate_likelihood, self.block_order)
+            edge_sweep = functools.partial(
+                self.propagate_likelihood_residual,
+                sweep_order,
+                self.edge_order,
+                *self.node_edges,
+            )
+        elif threaded:
+            if self.edge_schedule is None:
+                self.schedule()
+            block_sweep = functools.partial(
+                self.propagate_likelihood_threaded, *self.block_schedule
+            )
+            edge_sweep = functools.partial(
+                self.propagate_likelihood_threaded, *self.edge_schedule
+            )
+        else:
+            block_sweep = functools.partial(self.propagate_likelihood, self.block_order)
+            edge_sweep = functools.partial(self.propagate_likelihood, self.edge_order)
+
+        with numba_threads(num_threads if threaded else None):
+            logger.debug("Passing through singleton blocks")
+            block_sweep(
+                self.block_nodes[ROOTWARD],
+                self.block_nodes[LEAFWARD],
+                self.block_likelihoods,
+                self.node_constraints,
+                self.node_posterior,
+                self.block_factors,
+                self.block_logconst,
+                self.node_scale,
+                max_shape,
+                min_step,
+                USE_BLOCK_LIKELIHOOD,
+            )
 
-        logger.debug("Rootward + leafward pass through edges")
-        self.propagate_likelihood(
-            self.edge_order,
-            self.edge_parents,
-            self.edge_children,
-            self.edge_likelihoods,
-            self.node_constraints,
-            self.node_posterior,
-            self.edge_factors,
-            self.edge_logconst,
-            self.node_scale,
-            max_shape,
-            min_step,
-            USE_EDGE_LIKELIHOOD,
-        )
+            if prioritised:
+                logger.debug("Prioritised pass through edges")
+                self._raise_residuals(last_posterior)
+                num_updates = edge_sweep(
+                    self.edge_parents,
+                    self.edge_children,
+                    self.edge_likelihoods,
+                    self.node_constraints,
+                    self.node_posterior,
+                    self.edge_factors,
+                    self.edge_logconst,
+                    self.node_scale,
+                    self.edge_residual,
+                    max_shape,
+                    min_step,
+                    max_edge_updates,
+                    residual_tolerance,
+                )
+                last_posterior = np.asarray(self.node_posterior, dtype=np.float64)
+            else:
+                logger.debug("Rootward + leafward pass through edges")
+                edge_sweep(
+                    self.edge_parents,
+                    self.edge_children,
+                    self.edge_likelihoods,
+                    self.node_constraints,
+                    self.node_posterior,
+                    self.edge_factors,
+                    self.edge_logconst,
+                    self.node_scale,
+                    max_shape,
+                    min_step,
+                    USE_EDGE_LIKELIHOOD,
+                )
+                num_updates = self.edge_order.size
 
         if regularise:
             logger.debug("Exponential regularization on roots")
@@ -687,6 +1428,9 @@ class ExpectationPropagation:
                 em_reltol,
             )
 
+        if prioritised:
+            self._raise_residuals(last_posterior)
+
         logger.debug("Absorbing scaling term into the factors")
         self.rescale_factors(
             self.edge_parents,
@@ -709,6 +1453,8 @@ class ExpectationPropagation:
                 self.block_factors,
             )
 
+        return num_updates
+
     def rescale(
         self,
         *,
@@ -727,6 +1473,7 @@ class ExpectationPropagation:
             self.mutation_blocks,
             self.block_edges,
         )
+        likelihoods = np.asarray(likelihoods, dtype=np.float64)
         nodes_time, _ = self.node_moments()
         rescaled_nodes_time = nodes_time.copy()
         for _ in np.arange(rescale_iterations):  # estimate time rescaling
@@ -746,7 +1493,7 @@ class ExpectationPropagation:
             rescaled_breaks, rescaled_nodes_time[unique], nodes_time[unique]
         )
         self.node_posterior[:] = piecewise_scale_posterior(
-            self.node_posterior,
+            np.asarray(self.node_posterior, dtype=np.float64),
             original_breaks,
             rescaled_breaks,
             quantile_width,
@@ -768,64 +1515,125 @@ class ExpectationPropagation:
         regularise,
         rescale_segsites,
         min_step=0.1,
+        ep_tolerance=None,
+        checkpoint=None,
+        checkpoint_interval=1,
+        resume=False,
+        num_threads=None,
+        residual_tolerance=None,
+        max_edge_updates=None,
         progress=None,
     ):
-        # Run multiple rounds of expectation propagation, and return stats
+        # Run multiple rounds of expectation propagation, and return stats. If
+        # `ep_tolerance` is given, iteration halts early once the largest
+        # relative change in posterior means of unfixed nodes falls below it.
+        # If `checkpoint` is given, the EP state is saved to this file every
+        # `checkpoint_interval` iterations, and if `resume` is True and the file
+        # exists, iteration restarts from the saved state. If `residual_tolerance`
+        # is given, edges are updated in order of their residuals rather than
+        # in a fixed order, with at most `max_edge_updates` per iteration.
         self.mean_edge_logconst = []  # Undocumented: can be used to assess convergence
-        nodes_timing = time.time()
-        for _ in tqdm(
-            np.arange(ep_iterations),
-            desc="Expectation Propagation",
-            disable=not progress,
-        ):
-            self.iterate(
-                max_shape=max_shape,
-                min_step=min_step,
-                regularise=regularise,
-            )
-            self.mean_edge_logconst.append(np.mean(self.edge_logconst))
-
-        nodes_timing -= time.time()
+        self.max_relative_change = []  # Undocumented: as above
+        self.edge_updates = []  # Undocumented: number of edge updates per iteration
+        self.ep_iterations = 0
+        if resume and checkpoint is not None and os.path.exists(checkpoint):
+            self.ep_iterations = self.load_checkpoint(checkpoint)
+        with self.instrumentation.stage("node_posteriors"):
+            free = self.node_constraints[:, LOWER] != self.node_constraints[:, UPPER]
+            node_mean = self._posterior_mean(free)
+            if ep_tolerance is not None and len(self.max_relative_change) > 0:
+                if self.max_relative_change[-1] < ep_tolerance:
+                    ep_iterations = self.ep_iterations  # resumed after convergence
+            for _ in tqdm(
+                np.arange(self.ep_iterations, ep_iterations),
+                desc="Expectation Propagation",
+                disable=not progress,
+            ):
+                num_updates = self.iterate(
+                    max_shape=max_shape,
+                    min_step=min_step,
+                    regularise=regularise,
+                    num_threads=num_threads,
+                    residual_tolerance=residual_tolerance,
+                    max_edge_updates=max_edge_updates,
+                )
+                self.edge_updates.append(num_updates)
+                self.ep_iterations += 1
+                self.mean_edge_logconst.append(np.mean(self.edge_logconst))
+                last_mean, node_mean = node_mean, self._posterior_mean(free)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    change = np.abs(node_mean - last_mean) / np.abs(node_mean)
+                change[~np.isfinite(last_mean)] = np.inf  # previously uninitialised
+                change = np.max(change, initial=0.0, where=np.isfinite(node_mean))
+                self.max_relative_change.append(change)
+                converged = ep_tolerance is not None and change < ep_tolerance
+                if checkpoint is not None and (
+                    converged
+                    or self.ep_iterations == ep_iterations
+                    or self.ep_iterations % checkpoint_interval == 0
+                ):
+                    self.save_checkpoint(checkpoint, self.ep_iterations)
+                if converged:
+                    break
+            if len(self.max_relative_change) > 0:
+                logger.info(
+                    f"Ran {self.ep_iterations} EP iterations, final maximum relative "
+                    f"change in posterior means was {self.max_relative_change[-1]:.2e}"
+                )
+            logger.info(f"Made {sum(self.edge_updates)} edge updates")
+        nodes_timing = self.instrumentation.time("node_posteriors")
         skipped_edges = np.sum(np.isnan(self.edge_logconst))
+        self.instrumentation.count("ep_iterations", self.ep_iterations)
+        self.instrumentation.count("edge_updates", sum(self.edge_updates))
+        self.instrumentation.count("skipped_edges", skipped_edges)
+        self.instrumentation.record("max_relative_change", self.max_relative_change)
+        self.instrumentation.record("mean_edge_logconst", self.mean_edge_logconst)
+        self.instrumentation.record("edge_updates", self.edge_updates)
         logger.info(f"Skipped {skipped_edges} edges with invalid factors")
-        logger.info(f"Calculated node posteriors in {abs(nodes_timing):.2f} seconds")
-
-        muts_timing = time.time()
-        mutations_phased = self.mutation_blocks == tskit.NULL
-        logger.debug("Passing through unphased singletons")
-        self.propagate_mutations(  # unphased singletons
-            self.mutation_order[~mutations_phased],
-            self.mutation_posterior,
-            self.mutation_phase,
-            self.mutation_blocks,
-            self.block_nodes[ROOTWARD],
-            self.block_nodes[LEAFWARD],
-            self.block_likelihoods,
-            self.node_constraints,
-            self.node_posterior,
-            self.block_factors,
-            self.node_scale,
-            USE_BLOCK_LIKELIHOOD,
-        )
-        logger.debug("Passing through phased mutations")
-        self.propagate_mutations(  # phased mutations
-            self.mutation_order[mutations_phased],
-            self.mutation_posterior,
-            self.mutation_phase,
-            self.mutation_edges,
-            self.edge_parents,
-            self.edge_children,
-            self.edge_likelihoods,
-            self.node_constraints,
-            self.node_posterior,
-            self.edge_factors,
-            self.node_scale,
-            USE_EDGE_LIKELIHOOD,
-        )
-        muts_timing -= time.time()
+        logger.info(f"Calculated node posteriors in {nodes_timing:.2f} seconds")
+
+        with self.instrumentation.stage("mutation_posteriors"):
+            mutations_phased = self.mutation_blocks == tskit.NULL
+            threaded = num_threads is not None and num_threads >= 1
+            propagate_mutations = self.propagate_mutations
+            if threaded:
+                propagate_mutations = self.propagate_mutations_threaded
+            with numba_threads(num_threads if threaded else None):
+                logger.debug("Passing through unphased singletons")
+                propagate_mutations(  # unphased singletons
+                    self.mutation_order[~mutations_phased],
+                    self.mutation_posterior,
+                    self.mutation_phase,
+                    self.mutation_blocks,
+                    self.block_nodes[ROOTWARD],
+                    self.block_nodes[LEAFWARD],
+                    self.block_likelihoods,
+                    self.node_constraints,
+                    self.node_posterior,
+                    self.block_factors,
+                    self.node_scale,
+                    USE_BLOCK_LIKELIHOOD,
+                )
+                logger.debug("Passing through phased mutations")
+                propagate_mutations(  # phased mutations
+                    self.mutation_order[mutations_phased],
+                    self.mutation_posterior,
+                    self.mutation_phase,
+                    self.mutation_edges,
+                    self.edge_parents,
+                    self.edge_children,
+                    self.edge_likelihoods,
+                    self.node_constraints,
+                    self.node_posterior,
+                    self.edge_factors,
+                    self.node_scale,
+                    USE_EDGE_LIKELIHOOD,
+                )
+        muts_timing = self.instrumentation.time("mutation_posteriors")
         skipped_muts = np.sum(np.isnan(self.mutation_posterior[:, 0]))
+        self.instrumentation.count("skipped_mutations", skipped_muts)
         logger.info(f"Skipped {skipped_muts} mutations with invalid posteriors")
-        logger.info(f"Calculated mutation posteriors in {abs(muts_timing):.2f} seconds")
+        logger.info(f"Calculated mutation posteriors in {muts_timing:.2f} seconds")
 
         singletons = self.mutation_blocks != tskit.NULL
         switched_blocks = self.mutation_blocks[singletons]
@@ -838,22 +1646,29 @@ class ExpectationPropagation:
         self.mutation_nodes[singletons] = self.edge_children[switched_edges]
         switched = self.mutation_phase < 0.5
         self.mutation_phase[switched] = 1 - self.mutation_phase[switched]
+        self.instrumentation.count("switched_singletons", np.sum(switched))
         logger.info(f"Switched phase of {np.sum(switched)} singletons")
 
         if rescale_intervals > 0 and rescale_iterations > 0:
-            rescale_timing = time.time()
-            self.rescale(
-                rescale_intervals=rescale_intervals,
-                rescale_iterations=rescale_iterations,
-                rescale_segsites=rescale_segsites,
-                progress=progress,
-            )
-            rescale_timing -= time.time()
-            logger.info(f"Timescale rescaled in {abs(rescale_timing):.2f} seconds")
+            with self.instrumentation.stage("rescaling"):
+                self.rescale(
+                    rescale_intervals=rescale_intervals,
+                    rescale_iterations=rescale_iterations,
+                    rescale_segsites=rescale_segsites,
+                    progress=progress,
+                )
+            rescale_timing = self.instrumentation.time("rescaling")
+            logger.info(f"Timescale rescaled in {rescale_timing:.2f} seconds")
+
+    def _posterior_mean(self, nodes):
+        # Posterior mean of ages for the selected (unfixed) nodes
+        alpha, beta = self.node_posterior[nodes].astype(np.float64).T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (alpha + 1) / beta
 
     def node_moments(self):
         # Posterior mean and variance of node ages (equivalent to node_posteriors)
-        alpha, beta = self.node_posterior.T
+        alpha, beta = np.asarray(self.node_posterior, dtype=np.float64).T
         nodes_mn = np.ascontiguousarray(self.node_constraints[:, 0])
         nodes_va = np.zeros(nodes_mn.size)
         free = self.node_constraints[:, 0] != self.node_constraints[:, 1]
@@ -931,6 +1746,203 @@ class ExpectationPropagation:
         return data
 
 
+def genomic_windows(sequence_length, window_size, window_overlap):
+    """
+    Split a genome into consecutive windows of length ``window_size``, and
+    extend each window by ``window_overlap`` on either side (truncated at the
+    ends of the sequence).
+
+    :return: Two arrays with a row per window, giving the ``(left, right)``
+        coordinates of the non-overlapping "core" of each window and of the
+        extended window, respectively.
+    """
+    breaks = np.arange(0.0, sequence_length, window_size)
+    breaks = np.append(breaks, sequence_length)
+    core = np.column_stack((breaks[:-1], breaks[1:]))
+    extended = core + np.array([-window_overlap, window_overlap])
+    np.clip(extended, 0.0, sequence_length, out=extended)
+    return core, extended
+
+
+def _window_tree_sequence(ts, left, right):
+    # Restrict a tree sequence to a genomic interval, dropping nodes without
+    # edges in the interval. Returns the new tree sequence along with the IDs
+    # of its nodes and mutations in the original tree sequence.
+    tables = ts.dump_tables()
+    tables.keep_intervals([[left, right]], simplify=False, record_provenance=False)
+    connected = np.full(ts.num_nodes, False)
+    connected[tables.edges.parent] = True
+    connected[tables.edges.child] = True
+    nodes = np.flatnonzero(connected).astype(np.int32)
+    position = ts.sites_position[ts.mutations_site]
+    mutations = np.flatnonzero(
+        np.logical_and.reduce(
+            (position >= left, position < right, connected[ts.mutations_node])
+        )
+    )
+    tables.subset(
+        nodes,
+        record_provenance=False,
+        reorder_populations=False,
+        remove_unreferenced=False,
+    )
+    return tables.tree_sequence(), nodes, mutations
+
+
+def _infer_window(window, *, init_params, infer_params):
+    # Run EP on a single window, returning the natural parameters of node and
+    # mutation posteriors, and the span of each node within the window core
+    window_ts, core, initial_posteriors = window
+    fit = ExpectationPropagation(window_ts, **init_params)
+    if initial_posteriors is not None:
+        fit.initialize_posteriors(
+            initial_posteriors["mean"], initial_posteriors["variance"]
+        )
+    fit.infer(**infer_params)
+    left, right = core
+    edges_left = np.maximum(window_ts.edges_left, left)
+    edges_right = np.minimum(window_ts.edges_right, right)
+    span = np.clip(edges_right - edges_left, 0.0, None)
+    node_span = np.bincount(window_ts.edges_parent, span, window_ts.num_nodes)
+    node_span += np.bincount(window_ts.edges_child, span, window_ts.num_nodes)
+    return (
+        np.asarray(fit.node_posterior, dtype=np.float64),
+        node_span,
+        fit.mutation_posterior,
+        fit.mutation_nodes,
+    )
+
+
+def _map_windows(f, windows, num_processes):
+    # Date windows in a pool of worker processes, or sequentially. Workers are
+    # spawned rather than forked, as numba's thread pool is not fork-safe, and
+    # at most `num_processes` windows are queued ahead of the results consumed
+    # so that windows are only built (by the `windows` generator) as needed.
+    if num_processes is not None and num_processes > 1:
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(processes=num_processes) as pool:
+            pending = collections.deque()
+            for window in windows:
+                pending.append(pool.apply_async(f, (window,)))
+                if len(pending) > num_processes:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+    else:
+        yield from map(f, windows)
+
+
+def windowed_posteriors(
+    ts,
+    *,
+    window_size,
+    window_overlap,
+    mutation_rate,
+    allow_unary=None,
+    singletons_phased=True,
+    single_precision=False,
+    initial_posteriors=None,
+    num_processes=None,
+    progress=None,
+    **infer_params,
+):
+    """
+    Run expectation propagation independently on overlapping genomic windows of
+    a tree sequence, so that only the factors for a single window need to be
+    held in memory by each worker.
+
+    The posteriors for nodes that appear in more than one window are
+    reconciled by averaging their natural parameters across windows, weighted
+    by the span of the node's edges within the core (non-overlapping part) of
+    each window. Mutation posteriors are taken from the window whose core
+    contains the mutation.
+
+    :param ~tskit.TreeSequence ts: the tree sequence to date.
+    :param float window_size: the length of genome in the core of each window.
+    :param float window_overlap: the length of flanking sequence added to
+        either side of each window.
+    :param int num_processes: the number of worker processes used to date
+        windows in parallel. Windows are dated sequentially in the current
+        process unless this is > 1.
+    :param \\**infer_params: other parameters passed to
+        :meth:`ExpectationPropagation.infer`.
+    :return: The posterior means and variances of node ages, the posterior
+        means and variances of mutation ages, and the nodes below mutations.
+    """
+    core, extended = genomic_windows(ts.sequence_length, window_size, window_overlap)
+    windows = []  # only the indexes into `ts` are retained for each window
+
+    def build_windows():
+        for (core_left, core_right), (left, right) in zip(core, extended):
+            window_ts, nodes, mutations = _window_tree_sequence(ts, left, right)
+            init = None if initial_posteriors is None else initial_posteriors[nodes]
+            windows.append(((core_left, core_right), nodes, mutations))
+            yield window_ts, (core_left, core_right), init
+
+    f = functools.partial(
+        _infer_window,
+        init_params=dict(
+            mutation_rate=mutation_rate,
+            allow_unary=allow_unary,
+            singletons_phased=singletons_phased,
+            single_precision=single_precision,
+        ),
+        infer_params=infer_params,
+    )
+
+    window_timing = time.time()
+    node_natural = np.zeros((ts.num_nodes, 2))
+    node_weight = np.zeros(ts.num_nodes)
+    node_unweighted = np.zeros((ts.num_nodes, 2))
+    node_count = np.zeros(ts.num_nodes)
+    mutation_posterior = np.full((ts.num_mutations, 2), np.nan)
+    mutation_nodes = ts.mutations_node.copy()
+    mutation_position = ts.sites_position[ts.mutations_site]
+    results = _map_windows(f, build_windows(), num_processes)
+    for i, result in enumerate(
+        tqdm(results, total=core.shape[0], desc="Genomic windows", disable=not progress)
+    ):
+        (left, right), nodes, mutations = windows[i]
+        windows[i] = None
+        posterior, span, mut_posterior, mut_nodes = result
+        node_natural[nodes] += span[:, np.newaxis] * posterior
+        node_weight[nodes] += span
+        node_unweighted[nodes] += posterior
+        node_count[nodes] += 1
+        position = mutation_position[mutations]
+        in_core = np.logical_and(position >= left, position < right)
+        mutation_posterior[mutations[in_core]] = mut_posterior[in_core]
+        in_core &= mut_nodes != tskit.NULL
+        mutation_nodes[mutations[in_core]] = nodes[mut_nodes[in_core]]
+    window_timing -= time.time()
+    logger.info(
+        f"Dated {len(windows)} genomic windows in {abs(window_timing):.2f} seconds"
+    )
+
+    # span-weighted average of natural parameters, falling back to an
+    # unweighted average for nodes with no span in any window core
+    weighted = node_weight > 0
+    node_natural[weighted] /= node_weight[weighted, np.newaxis]
+    unweighted = np.logical_and(~weighted, node_count > 0)
+    node_natural[unweighted] = \
+        node_unweighted[unweighted] / node_count[unweighted, np.newaxis]  # fmt: skip
+
+    alpha, beta = node_natural.T
+    nodes_mn = ts.nodes_time.copy()
+    nodes_va = np.zeros(ts.num_nodes)
+    free = np.full(ts.num_nodes, True)
+    free[list(ts.samples())] = False
+    nodes_mn[free] = (alpha[free] + 1) / beta[free]
+    nodes_va[free] = nodes_mn[free] / beta[free]
+    alpha, beta = mutation_posterior.T
+    muts_mn = np.full(ts.num_mutations, np.nan)
+    muts_va = np.full(ts.num_mutations, np.nan)
+    free = np.isfinite(alpha)
+    muts_mn[free] = (alpha[free] + 1) / beta[free]
+    muts_va[free] = muts_mn[free] / beta[free]
+    return nodes_mn, nodes_va, muts_mn, muts_va, mutation_nodes
+
+
 # NB: used for debugging
 # def date(
 #     ts,